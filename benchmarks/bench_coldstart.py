@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+""" Cold start benchmark: the zipapp built by "make zipapp" against the installed entry point and sources
+    without bytecode, as on a freshly provisioned host """
+import os
+import sys
+import time
+import shutil
+import pathlib
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def drop_caches():
+    """ Drop the page cache so every run reads files from disk, needs root """
+    os.sync()
+    with open('/proc/sys/vm/drop_caches', 'w') as f:
+        f.write('3\n')
+
+
+def measure(label, cmd, args, env=None):
+    times = []
+    for _ in range(args.runs):
+        if args.drop_caches:
+            drop_caches()
+        start = time.perf_counter()
+        subprocess.run(cmd + args.command, env=env, check=True, stdout=subprocess.DEVNULL)
+        times.append(time.perf_counter() - start)
+    print(f'{label:<24} min {min(times) * 1000:7.1f} ms  median {statistics.median(times) * 1000:7.1f} ms')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--runs', type=int, default=20, help='Number of runs of each variant')
+    parser.add_argument('--pyz', default=str(ROOT / 'dist' / 'dotref.pyz'), help='Path to the zipapp')
+    parser.add_argument('--entry-point', default=shutil.which('dotref'),
+        help='Path to the installed dotref script (default: dotref found in PATH)')
+    parser.add_argument('--drop-caches', action='store_true', help='Drop the page cache before every run')
+    parser.add_argument('command', nargs='*', default=['version'], help='dotref arguments (default: version)')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.pyz):
+        sys.exit(f'{args.pyz} not found, run "make zipapp" first')
+
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # A copy without __pycache__, like a checkout or a package installed with --no-compile
+        shutil.copytree(str(ROOT / 'dotref'), os.path.join(tmpdir, 'dotref'),
+            ignore=shutil.ignore_patterns('__pycache__'))
+        measure('source, no bytecode', [sys.executable, '-c', 'import dotref; dotref.main()'], args,
+            dict(env, PYTHONPATH=tmpdir))
+
+    if args.entry_point:
+        measure('entry point', [args.entry_point], args, env)
+    else:
+        print('entry point              skipped, dotref is not installed')
+
+    measure('zipapp', [sys.executable, args.pyz], args, env)
+
+
+if __name__ == '__main__':
+    main()
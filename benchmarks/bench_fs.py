@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+""" File system benchmark: status and sync of a large home on an in-memory file system with latency """
+import sys
+import time
+import pathlib
+import argparse
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import dotref  # noqa: E402
+
+
+def generate(fs, entries):
+    fs.makedirs('/src')
+    fs.makedirs('/home/user')
+    links = []
+    for i in range(entries):
+        fs.write_bytes(f'/src/file{i}', b'')
+        links.append(dotref.LinkAction('bench', {'src': f'/src/file{i}', 'dst': f'/home/user/.file{i}'}))
+    return links
+
+
+def measure(label, fs, fn):
+    fs.counts.clear()
+    start = time.perf_counter()
+    results = fn()
+    elapsed = time.perf_counter() - start
+    print(f'{label:<8} {elapsed * 1000:9.1f} ms  {fs.total:8} ops  {fs.total / len(results):5.2f} ops/entry')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--entries', type=int, default=100000, help='Number of link entries')
+    parser.add_argument('-l', '--latency', type=float, default=0.0,
+        help='Seconds of latency injected before every file system operation, e.g. 0.0005 for NFS')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of concurrent operations')
+    args = parser.parse_args()
+
+    fs = dotref.LatencyFileSystem(dotref.MemoryFileSystem())
+    links = generate(fs.inner, args.entries)
+    fs.latency = args.latency
+
+    ctx = dotref.ApplyContext(fs=fs, engine=dotref.AsyncEngine(args.jobs) if args.jobs > 1 else None)
+    for label, command in (('status', dotref.ActionType.STATUS), ('sync', dotref.ActionType.SYNC),
+            ('resync', dotref.ActionType.SYNC)):
+        measure(label, fs, lambda: ctx.engine.run(lambda a: a.apply(command, ctx), links))
+
+
+if __name__ == '__main__':
+    main()
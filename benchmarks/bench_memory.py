@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+""" Memory benchmark: load, merge and check a large generated profile hierarchy """
+import os
+import sys
+import json
+import time
+import pathlib
+import tempfile
+import shutil
+import argparse
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent))
+
+import dotref  # noqa: E402
+
+
+def generate(tmpdir, entries, depth):
+    names = [f'level{i}' for i in range(depth)]
+    per_level = entries // depth
+    for i, name in enumerate(names):
+        profile = {
+            'vars': {f'var{i}_{j}': f'value{j}' for j in range(100)},
+            'link': [{'src': f'src/{i}/{j}', 'dst': f'~/dst/{i}/{j}'} for j in range(per_level)],
+        }
+        if i + 1 < depth:
+            profile['extends'] = [names[i + 1]]
+        with open(tmpdir / f'{name}.json', 'w') as f:
+            json.dump(profile, f)
+    return names
+
+
+def measure(label, fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f'{label:<24} {elapsed * 1000:9.1f} ms  '
+        f'current {current / 2**20:8.2f} MiB  peak {peak / 2**20:8.2f} MiB')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--entries', type=int, default=50000, help='Total number of link entries')
+    parser.add_argument('--depth', type=int, default=5, help='Depth of the profile hierarchy')
+    args = parser.parse_args()
+
+    tmpdir = pathlib.Path(tempfile.mkdtemp())
+    try:
+        names = generate(tmpdir, args.entries, args.depth)
+
+        def load():
+            profiles = {p.name: p for p in map(dotref.Profile, (tmpdir / f'{n}.json' for n in names))}
+            for p in profiles.values():
+                p.parents = [profiles[e] for e in p.extends]
+            return profiles
+
+        profiles = measure('load', load)
+        merged = measure('merge', profiles[names[0]].merged)
+        measure('results', lambda: [dotref.ActionResult(dotref.ActionState.OK,
+            pathlib.Path(link.src), pathlib.Path(link.dst)) for link in merged.link])
+        print(f'{len(merged.link)} merged link entries, {len(merged.vars)} variables '
+            f'({os.path.basename(sys.executable)} {sys.version.split()[0]})')
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
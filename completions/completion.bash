@@ -4,10 +4,10 @@ _dotref()
     cur="${COMP_WORDS[COMP_CWORD]}"
 
     if [ $COMP_CWORD -eq 1 ]; then
-        COMPREPLY=($(compgen -W '-h --help init sync unlink status profiles version' -- $cur))
+        COMPREPLY=($(compgen -W '-h --help init sync unlink status switch rollback push gc profiles version' -- $cur))
     else
         case ${COMP_WORDS[1]} in
-            init|sync|unlink|status|profiles)
+            init|sync|unlink|status|switch|rollback|push|gc|profiles)
                 _dotref_opt_complete
                 ;;
         esac
@@ -15,6 +15,18 @@ _dotref()
     fi
 }
 
+_dotref_dir_args()
+{
+    local i
+    for (( i=2; i < COMP_CWORD - 1; i++ )); do
+        case ${COMP_WORDS[i]} in
+            -d|--dotdir|-s|--statefile)
+                echo "${COMP_WORDS[i]} ${COMP_WORDS[i+1]}"
+                ;;
+        esac
+    done
+}
+
 _dotref_opt_complete()
 {
     local cur
@@ -22,14 +34,20 @@ _dotref_opt_complete()
 
     if [ $COMP_CWORD -ge 2 ]; then
         case ${COMP_WORDS[COMP_CWORD-1]} in
-            -d|--dotdir)
+            -d|--dotdir|--root)
                 COMPREPLY=($(compgen -d -- $cur))
                 ;;
-            -s|--statefile|-p|--profile)
+            -s|--statefile|--jsonl|--metrics-file)
                 COMPREPLY=($(compgen -f -- $cur))
                 ;;
+            --ssh)
+                COMPREPLY=($(compgen -c -- $cur))
+                ;;
+            -p|--profile)
+                COMPREPLY=($(compgen -W "$(dotref __complete profiles $(_dotref_dir_args) 2>/dev/null)" -- $cur))
+                ;;
             *)
-                COMPREPLY=($(compgen -W '-v --verbose -s --statefile -d --dotdir -p --profile' -- $cur))
+                COMPREPLY=($(compgen -W '-v --verbose -s --statefile -d --dotdir -p --profile -j --jobs --fail-fast --jsonl --metrics-file --store --ssh --remote-dir -q --quiet --exit-code --git --schedule --splay --delete --root --depth --exclude' -- $cur))
                 ;;
         esac
     fi
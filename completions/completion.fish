@@ -1,19 +1,51 @@
-set -l commands -h --help init sync unlink status profiles version
+set -l commands -h --help init sync unlink status switch rollback push gc profiles version
 
 set -l h -s h -l help      -d 'Print help message and exit'
 set -l v -s v -l verbose   -d 'Produce more verbose output'
-set -l d -s d -l dotdir    -d 'Directory containing profiles' -rF
+set -l d -s d -l dotdir    -d 'Directory containing profiles, repeat to layer' -rF
 set -l s -s s -l statefile -d 'Dotref state file' -rF
-set -l p -s p -l profile   -d 'Name of the profile to use' -rF
+set -l j -s j -l jobs      -d 'Number of concurrent file system operations' -x
+set -l f -l fail-fast      -d 'Stop at the first conflict'
+set -l o -l jsonl          -d 'Write results as JSON lines to a file' -rF
+set -l m -l metrics-file   -d 'Write Prometheus metrics to a file' -rF
+set -l q -s q -l quiet    -d 'Only check the fingerprint, print nothing'
+set -l e -l exit-code      -d 'Exit with status 1 when out of sync'
+set -l g -l git            -d 'Only check entries changed in git since the last sync'
+set -l c -l schedule       -d 'Spread periodic runs per host, back off and skip unchanged'
+set -l w -l splay          -d 'Window of the per-host delay in seconds' -x
+set -l x -l delete         -d 'Remove orphaned links'
+set -l r -l root           -d 'Directory to scan' -xa '(__fish_complete_directories)'
+set -l n -l depth          -d 'Maximum scan depth' -x
+set -l X -l exclude        -d 'Directory glob to skip' -x
+set -l S -l store          -d 'Keep rendered templates in a content-addressed store'
+set -l H -l ssh            -d 'SSH command used by push' -x
+set -l R -l remote-dir     -d 'Directory for link sources on remote hosts' -x
+set -l p -s p -l profile   -d 'Name of the profile to use' -xa '(__fish_dotref_profiles)'
+
+function __fish_dotref_profiles
+    set -l tokens (commandline -opc)
+    set -l args
+    for i in (seq (math (count $tokens) - 1))
+        switch $tokens[$i]
+            case -d --dotdir -s --statefile
+                set -a args $tokens[$i] $tokens[(math $i + 1)]
+        end
+    end
+    dotref __complete profiles $args 2>/dev/null
+end
 
 complete -c dotref -f
 
 complete -c dotref -n "not __fish_seen_subcommand_from $commands" -a "$commands"
 
-for line in 'init:     p d s v' \
-            'sync:     d s v'   \
-            'unlink:   d s v'   \
-            'status:   d s v'   \
+for line in 'init:     p d s v S' \
+            'sync:     d s v j f o m e g c w' \
+            'unlink:   d s v j f o m' \
+            'status:   d s v j f o m q e g' \
+            'switch:   p d s v j f o m' \
+            'rollback: d s v'   \
+            'push:     p d s v H R' \
+            'gc:       d s v j x r n X' \
             'profiles: p d v'
     set -l command (echo "$line" | cut -d: -f1)
 
@@ -7,6 +7,27 @@ import string
 import json
 import enum
 import copy
+import time
+import collections.abc
+import locale
+import mmap
+import contextlib
+import threading
+import io
+import fnmatch
+import codecs
+import re
+import errno
+import stat
+import posixpath
+
+# Modules that only some commands need (asyncio, concurrent.futures, subprocess, tarfile, ...) are imported
+# where they are used, every command pays for the imports above on each start
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __version__ = '1.2.4'
 
@@ -60,15 +81,52 @@ class Logger:
         return color if self.colored else ''
 
     def print_tree(self, root, get_name, get_children, child_prefix='+-- '):
-        self.out(get_name(root), True)
-        self.__print_tree(root, get_name, get_children, '', child_prefix)
-
-    def __print_tree(self, node, get_name, get_children, prefix, child_prefix):
-        child_count = len(get_children(node))
-        for i, child in enumerate(get_children(node)):
-            self.out(prefix + child_prefix + get_name(child), True)
-            p = prefix + ('|' if i < child_count - 1 else ' ').ljust(len(child_prefix))
-            self.__print_tree(child, get_name, get_children, p, child_prefix)
+        """ Print the tree with an explicit stack, so deep trees don't hit the recursion limit """
+        stack = [(root, '', '')]
+        while stack:
+            node, line_prefix, prefix = stack.pop()
+            self.out(line_prefix + get_name(node), True)
+            children = get_children(node)
+            for i in reversed(range(len(children))):
+                p = prefix + ('|' if i < len(children) - 1 else ' ').ljust(len(child_prefix))
+                stack.append((children[i], prefix + child_prefix, p))
+
+
+class ActionResult:
+    """ Result of applying a single action, with lazily cached string forms of its paths """
+
+    __slots__ = ('state', 'left', 'right', '_left_str', '_parts')
+
+    def __init__(self, state, left, right=None):
+        self.state = state
+        self.left = left
+        self.right = right
+        self._left_str = None
+        self._parts = None
+
+    def __iter__(self):
+        return iter((self.state, self.left, self.right))
+
+    def __getitem__(self, index):
+        return (self.state, self.left, self.right)[index]
+
+    def __repr__(self):
+        return f'ActionResult({self.state}, {self.left!r}, {self.right!r})'
+
+    @property
+    def left_str(self):
+        if self._left_str is None:
+            self._left_str = str(self.left)
+        return self._left_str
+
+    def parts(self):
+        """ (parent, name) string pairs of the left and right paths used for printing, names that are not
+            paths (like hook names) have no parent """
+        if self._parts is None:
+            self._parts = tuple(None if p is None else
+                (str(p.parent), p.name) if isinstance(p, pathlib.PurePath) else ('', str(p))
+                for p in (self.left, self.right))
+        return self._parts
 
 
 class ActionType(enum.Enum):
@@ -90,56 +148,2112 @@ class ActionState(enum.Enum):
     UNLINKED = (5, Logger.GREEN)
     DIFFERS  = (6, Logger.YELLOW)
     RENDERED = (7, Logger.GREEN)
+    RESTORED = (8, Logger.GREEN)
+    COPIED   = (9, Logger.GREEN)
+    ORPHANED = (10, Logger.YELLOW)
+    RAN      = (11, Logger.GREEN)
+    FAILED   = (12, Logger.RED)
 
     def str(self, log):
         return log.colorize(('[' + self.name + ']').ljust(10), self.value[1])
 
 
+def read_umask():
+    """ os.umask() can only read the umask by replacing it, done once before any thread starts """
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+
+UMASK = read_umask()
+
+
+def atomic_write(filename, data, sync=False, mode=None):
+    """ Write str or bytes to a uniquely named temporary file and atomically rename it over filename. The
+        file gets mode, or keeps the mode of the file it replaces, a new one gets the default of the umask """
+    import tempfile
+    if mode is None:
+        try:
+            mode = filename.stat().st_mode & 0o7777
+        except OSError:
+            mode = 0o666 & ~UMASK
+    fd, tmp = tempfile.mkstemp(dir=str(filename.parent), prefix='.' + filename.name + '.', suffix='.tmp')
+    try:
+        # mkstemp() creates the file with mode 0600
+        os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode() if isinstance(data, str) else data)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
 class StateFile:
     """ Sate file that keeps dotref state and config for a given repository """
 
     def __init__(self, filename):
         self.filename = filename
+        self.dir = filename.with_suffix('.d')
+        self.lockfile = filename.with_name(filename.name + '.lock')
+        self.load()
+
+    @contextlib.contextmanager
+    def lock(self, exclusive=False):
+        """ Advisory lock: any number of shared holders or a single exclusive one. Shared holders only read,
+            so without write access to the dotdir they open an existing lock file read-only or go unlocked """
+        if fcntl is None:
+            yield
+            return
 
+        try:
+            f = open(self.lockfile, 'a')
+        except OSError as e:
+            if exclusive:
+                raise OSError(f'Can\'t create the lock file "{self.lockfile}" ({e.strerror}), '
+                    'this command needs write access to the directory of the state file') from e
+            try:
+                f = open(self.lockfile, 'r')
+            except OSError:
+                yield
+                return
+
+        with f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def load(self):
         json_state = None
-        if filename.is_file():
-            with open(filename, 'r') as f:
+        if self.filename.is_file():
+            with open(self.filename, 'r') as f:
                 json_state = json.load(f)
 
         self.profile = None
+        self.store = False
 
         if json_state and 'profile' in json_state:
             if not isinstance(json_state['profile'], str):
                 raise TypeError('Name of the current profile in the state file must be a string')
             self.profile = json_state['profile']
 
+        if json_state and 'store' in json_state:
+            if not isinstance(json_state['store'], bool):
+                raise TypeError('"store" setting in the state file must be a boolean')
+            self.store = json_state['store']
+
     def save(self):
-        with open(self.filename, 'w') as f:
-            f.write(json.dumps(self.to_json()))
+        atomic_write(self.filename, json.dumps(self.to_json()), sync=True)
 
     def to_json(self):
-        return {'profile': self.profile} if self.profile else {}
+        result = {'profile': self.profile} if self.profile else {}
+        if self.store:
+            result['store'] = True
+        return result
+
+
+def file_equals(path, data, chunk_size=1 << 20):
+    """ Compare file content with bytes using a read-only memory map, without decoding """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size != len(data):
+            return False
+        if size == 0:
+            return True
+
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(data)
+            for offset in range(0, size, chunk_size):
+                if mapped[offset:offset + chunk_size] != view[offset:offset + chunk_size]:
+                    return False
+    return True
+
+
+FICLONE = 0x40049409
+
+
+def copy_file(src, dst):
+    """ Copy file content trying FICLONE reflink, copy_file_range and sendfile before a plain copy """
+    import shutil
+    with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+        src_fd, dst_fd = src_file.fileno(), dst_file.fileno()
+
+        if fcntl is not None:
+            try:
+                fcntl.ioctl(dst_fd, FICLONE, src_fd)
+                return 'reflink'
+            except OSError:
+                pass
+
+        kernel_copies = []
+        if hasattr(os, 'copy_file_range'):
+            kernel_copies.append(('copy_file_range', lambda n: os.copy_file_range(src_fd, dst_fd, n)))
+        if hasattr(os, 'sendfile'):
+            kernel_copies.append(('sendfile', lambda n: os.sendfile(dst_fd, src_fd, None, n)))
+
+        size = os.fstat(src_fd).st_size
+        for method, fn in kernel_copies:
+            try:
+                if copy_in_kernel(fn, size):
+                    return method
+            except OSError:
+                pass
+            os.lseek(src_fd, 0, os.SEEK_SET)
+            os.lseek(dst_fd, 0, os.SEEK_SET)
+            os.ftruncate(dst_fd, 0)
+
+        shutil.copyfileobj(src_file, dst_file)
+        return 'copy'
+
+
+def copy_in_kernel(fn, size):
+    """ Repeatedly call an in-kernel copy function, returns False if it stops making progress """
+    copied = 0
+    while copied < size:
+        n = fn(size - copied)
+        if n == 0:
+            return False
+        copied += n
+    return True
+
+
+def files_equal(a, b, chunk_size=1 << 20):
+    """ Byte-by-byte comparison of two files of the same size """
+    with open(a, 'rb') as fa, open(b, 'rb') as fb:
+        while True:
+            ca, cb = fa.read(chunk_size), fb.read(chunk_size)
+            if ca != cb:
+                return False
+            if not ca:
+                return True
+
+
+TEMPLATE_PATTERN = re.compile(rb'''
+    \$(?:
+        (?P<escaped>\$) |
+        (?P<named>[_a-z][_a-z0-9]*) |
+        {(?P<braced>[_a-z][_a-z0-9]*)} |
+        (?P<invalid>)
+    )''', re.IGNORECASE | re.VERBOSE)
+
+
+def render_template(data, vars):
+    """ string.Template substitution done on bytes, so templates are never decoded, vars maps to bytes.
+        Line endings are normalized to LF first, like the universal newlines of text mode reads """
+    def convert(m):
+        name = m.group('named') or m.group('braced')
+        if name is not None:
+            return vars[name.decode('ascii')]
+        if m.group('escaped') is not None:
+            return b'$'
+        lines = data[:m.start('invalid')].splitlines(True)
+        line, col = (len(lines), len(lines[-1])) if lines else (1, 1)
+        raise ValueError(f'Invalid placeholder in string: line {line}, col {col}')
+
+    data = data.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+    return TEMPLATE_PATTERN.sub(convert, data)
+
+
+class FileSystem:
+    """ File system backend used by actions, subclasses implement the primitive operations """
+
+    def stat(self, path):
+        raise NotImplementedError
+
+    def lstat(self, path):
+        raise NotImplementedError
+
+    def scandir(self, path):
+        """ List of entries with name attribute and is_dir()/is_symlink() methods like os.DirEntry """
+        raise NotImplementedError
+
+    def readlink(self, path):
+        raise NotImplementedError
+
+    def resolve(self, path):
+        """ Absolute pathlib.Path with symlinks resolved, the path doesn't have to exist """
+        raise NotImplementedError
+
+    def makedirs(self, path, mode=None):
+        raise NotImplementedError
+
+    def symlink(self, src, dst, is_dir=False):
+        raise NotImplementedError
+
+    def link(self, src, dst):
+        """ Hardlink """
+        raise NotImplementedError
+
+    def unlink(self, path):
+        raise NotImplementedError
+
+    def read_bytes(self, path):
+        raise NotImplementedError
+
+    def read_text(self, path):
+        raise NotImplementedError
+
+    def write_bytes(self, path, data):
+        raise NotImplementedError
+
+    def equals(self, path, data):
+        """ Whether the file content is data """
+        raise NotImplementedError
+
+    def same_content(self, a, b):
+        """ Whether two files of the same size have the same content """
+        raise NotImplementedError
+
+    def copy(self, src, dst):
+        """ Copy file content, returns the copy method used """
+        raise NotImplementedError
+
+    def chmod(self, path, mode):
+        raise NotImplementedError
+
+    def utime(self, path, ns):
+        raise NotImplementedError
+
+    def replace(self, src, dst):
+        raise NotImplementedError
+
+    def exists(self, path):
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def lexists(self, path):
+        try:
+            self.lstat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def is_dir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def is_file(self, path):
+        try:
+            return stat.S_ISREG(self.stat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def is_symlink(self, path):
+        try:
+            return stat.S_ISLNK(self.lstat(path).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+
+    def samefile(self, a, b):
+        sa, sb = self.stat(a), self.stat(b)
+        return (sa.st_ino, sa.st_dev) == (sb.st_ino, sb.st_dev)
+
+
+class OsFileSystem(FileSystem):
+    """ The real file system """
+
+    def stat(self, path):
+        return os.stat(path)
+
+    def lstat(self, path):
+        return os.lstat(path)
+
+    def scandir(self, path):
+        with os.scandir(path) as it:
+            return list(it)
+
+    def readlink(self, path):
+        return os.readlink(path)
+
+    def resolve(self, path):
+        return pathlib.Path(path).resolve()
+
+    def makedirs(self, path, mode=None):
+        if mode:
+            pathlib.Path(path).mkdir(parents=True, exist_ok=True, mode=mode)
+        else:
+            pathlib.Path(path).mkdir(parents=True, exist_ok=True)
+
+    def symlink(self, src, dst, is_dir=False):
+        os.symlink(src, dst, is_dir)
+
+    def link(self, src, dst):
+        os.link(src, dst)
+
+    def unlink(self, path):
+        os.unlink(path)
+
+    def read_bytes(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def read_text(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def write_bytes(self, path, data):
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def equals(self, path, data):
+        return file_equals(path, data)
+
+    def same_content(self, a, b):
+        return files_equal(a, b)
+
+    def copy(self, src, dst):
+        return copy_file(src, dst)
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def utime(self, path, ns):
+        os.utime(path, ns=ns)
+
+    def replace(self, src, dst):
+        os.replace(src, dst)
+
+
+class MemoryFileSystem(FileSystem):
+    """ In-memory file system for tests and benchmarks, relative paths start at the current directory """
+
+    class Node:
+        __slots__ = ('kind', 'data', 'mode', 'ino', 'atime_ns', 'mtime_ns')
+
+        def __init__(self, kind, data, mode, ino):
+            self.kind = kind
+            self.data = data
+            self.mode = mode
+            self.ino = ino
+            self.atime_ns = self.mtime_ns = MemoryFileSystem.now()
+
+    class DirEntry:
+        __slots__ = ('name', '_is_dir', '_is_symlink')
+
+        def __init__(self, name, is_dir, is_symlink):
+            self.name = name
+            self._is_dir = is_dir
+            self._is_symlink = is_symlink
+
+        def is_dir(self):
+            return self._is_dir
+
+        def is_symlink(self):
+            return self._is_symlink
+
+    KINDS = {'dir': stat.S_IFDIR, 'file': stat.S_IFREG, 'link': stat.S_IFLNK}
+    MAX_LINKS = 40
+
+    def __init__(self):
+        self.nodes = {'/': MemoryFileSystem.Node('dir', set(), 0o755, 1)}
+        self.next_ino = 2
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def now():
+        # time.time_ns() needs Python 3.7
+        return int(time.time() * 10**9)
+
+    def stat(self, path):
+        with self.lock:
+            return self.__stat(self.__node(path, True))
+
+    def lstat(self, path):
+        with self.lock:
+            return self.__stat(self.__node(path, False))
+
+    def scandir(self, path):
+        with self.lock:
+            real = self.__lookup(path, True)
+            node = self.__node(real, False)
+            if node.kind != 'dir':
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), str(path))
+            entries = []
+            for name in sorted(node.data):
+                child = posixpath.join(real, name)
+                is_symlink = self.nodes[child].kind == 'link'
+                entries.append(MemoryFileSystem.DirEntry(name, self.is_dir(child), is_symlink))
+            return entries
+
+    def readlink(self, path):
+        with self.lock:
+            node = self.__node(path, False)
+            if node.kind != 'link':
+                raise OSError(errno.EINVAL, os.strerror(errno.EINVAL), str(path))
+            return node.data
+
+    def resolve(self, path):
+        with self.lock:
+            try:
+                return pathlib.Path(self.__lookup(path, True))
+            except OSError:
+                return pathlib.Path(os.path.abspath(path))
+
+    def makedirs(self, path, mode=None):
+        with self.lock:
+            current = '/'
+            for name in MemoryFileSystem.__split(os.path.abspath(path)):
+                current = self.__lookup(posixpath.join(current, name), True)
+                node = self.nodes.get(current)
+                if node is None:
+                    self.__add(current, 'dir', set(), mode or 0o755)
+                elif node.kind != 'dir':
+                    raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(path))
+
+    def symlink(self, src, dst, is_dir=False):
+        with self.lock:
+            real = self.__lookup(dst, False)
+            if real in self.nodes:
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+            self.__add(real, 'link', str(src), 0o777)
+
+    def link(self, src, dst):
+        with self.lock:
+            node = self.__node(src, False)
+            if node.kind == 'dir':
+                raise PermissionError(errno.EPERM, os.strerror(errno.EPERM), str(src))
+            real = self.__lookup(dst, False)
+            if real in self.nodes:
+                raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+            self.__attach(real, node)
+
+    def unlink(self, path):
+        with self.lock:
+            real = self.__lookup(path, False)
+            node = self.__node(real, False)
+            if node.kind == 'dir':
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), str(path))
+            self.__remove(real)
+
+    def read_bytes(self, path):
+        with self.lock:
+            node = self.__node(path, True)
+            if node.kind != 'file':
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), str(path))
+            return node.data
+
+    def read_text(self, path):
+        """ Decoded like a text mode file, with universal newlines """
+        data = self.read_bytes(path).decode(locale.getpreferredencoding(False))
+        return data.replace('\r\n', '\n').replace('\r', '\n')
+
+    def write_bytes(self, path, data):
+        with self.lock:
+            real = self.__lookup(path, True)
+            node = self.nodes.get(real)
+            if node is None:
+                self.__add(real, 'file', bytes(data), 0o644)
+            elif node.kind != 'file':
+                raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), str(path))
+            else:
+                node.data = bytes(data)
+                node.mtime_ns = MemoryFileSystem.now()
+
+    def equals(self, path, data):
+        return self.read_bytes(path) == data
+
+    def same_content(self, a, b):
+        return self.read_bytes(a) == self.read_bytes(b)
+
+    def copy(self, src, dst):
+        self.write_bytes(dst, self.read_bytes(src))
+        return 'memory'
+
+    def chmod(self, path, mode):
+        with self.lock:
+            self.__node(path, True).mode = mode & 0o7777
+
+    def utime(self, path, ns):
+        with self.lock:
+            node = self.__node(path, True)
+            node.atime_ns, node.mtime_ns = ns
+
+    def replace(self, src, dst):
+        with self.lock:
+            src_real = self.__lookup(src, False)
+            node = self.__node(src_real, False)
+            dst_real = self.__lookup(dst, False)
+            existing = self.nodes.get(dst_real)
+            if existing is not None:
+                if existing.kind == 'dir':
+                    raise IsADirectoryError(errno.EISDIR, os.strerror(errno.EISDIR), str(dst))
+                self.__remove(dst_real)
+            self.__remove(src_real)
+            self.__attach(dst_real, node)
+
+    def __lookup(self, path, follow):
+        """ Absolute path with symlinks resolved, the last component only if follow is set """
+        pending = list(reversed(MemoryFileSystem.__split(os.path.abspath(path))))
+        current = '/'
+        links = 0
+        while pending:
+            name = pending.pop()
+            if name == '..':
+                current = posixpath.dirname(current)
+                continue
+            candidate = posixpath.join(current, name)
+            node = self.nodes.get(candidate)
+            if node is None:
+                if pending:
+                    raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(path))
+                return candidate
+            if node.kind == 'link' and (pending or follow):
+                links += 1
+                if links > MemoryFileSystem.MAX_LINKS:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), str(path))
+                if node.data.startswith('/'):
+                    current = '/'
+                pending.extend(reversed(MemoryFileSystem.__split(node.data)))
+                continue
+            if pending and node.kind != 'dir':
+                raise NotADirectoryError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), str(path))
+            current = candidate
+        return current
+
+    def __node(self, path, follow):
+        node = self.nodes.get(self.__lookup(path, follow))
+        if node is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), str(path))
+        return node
+
+    def __add(self, real, kind, data, mode):
+        node = MemoryFileSystem.Node(kind, data, mode, self.next_ino)
+        self.next_ino += 1
+        self.__attach(real, node)
+
+    def __attach(self, real, node):
+        parent = self.nodes.get(posixpath.dirname(real))
+        if parent is None or parent.kind != 'dir':
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), real)
+        parent.data.add(posixpath.basename(real))
+        parent.mtime_ns = MemoryFileSystem.now()
+        self.nodes[real] = node
+
+    def __remove(self, real):
+        parent = self.nodes[posixpath.dirname(real)]
+        parent.data.discard(posixpath.basename(real))
+        parent.mtime_ns = MemoryFileSystem.now()
+        del self.nodes[real]
+
+    @staticmethod
+    def __stat(node):
+        size = len(node.data) if node.kind != 'dir' else 4096
+        return os.stat_result((MemoryFileSystem.KINDS[node.kind] | node.mode, node.ino, 1, 1, 0, 0, size,
+            node.atime_ns // 10**9, node.mtime_ns // 10**9, node.mtime_ns // 10**9),
+            {'st_atime_ns': node.atime_ns, 'st_mtime_ns': node.mtime_ns})
+
+    @staticmethod
+    def __split(path):
+        return [c for c in path.split('/') if c and c != '.']
+
+
+class LatencyFileSystem(FileSystem):
+    """ Wraps another backend, counting primitive operations and sleeping before each of them """
+
+    def __init__(self, inner, latency=0.0, latencies=None):
+        self.inner = inner
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+
+    def stat(self, path):
+        return self.__call('stat', path)
+
+    def lstat(self, path):
+        return self.__call('lstat', path)
+
+    def scandir(self, path):
+        return self.__call('scandir', path)
+
+    def readlink(self, path):
+        return self.__call('readlink', path)
+
+    def resolve(self, path):
+        return self.__call('resolve', path)
+
+    def makedirs(self, path, mode=None):
+        return self.__call('makedirs', path, mode)
+
+    def symlink(self, src, dst, is_dir=False):
+        return self.__call('symlink', src, dst, is_dir)
+
+    def link(self, src, dst):
+        return self.__call('link', src, dst)
+
+    def unlink(self, path):
+        return self.__call('unlink', path)
+
+    def read_bytes(self, path):
+        return self.__call('read_bytes', path)
+
+    def read_text(self, path):
+        return self.__call('read_text', path)
+
+    def write_bytes(self, path, data):
+        return self.__call('write_bytes', path, data)
+
+    def equals(self, path, data):
+        return self.__call('equals', path, data)
+
+    def same_content(self, a, b):
+        return self.__call('same_content', a, b)
+
+    def copy(self, src, dst):
+        return self.__call('copy', src, dst)
+
+    def chmod(self, path, mode):
+        return self.__call('chmod', path, mode)
+
+    def utime(self, path, ns):
+        return self.__call('utime', path, ns)
+
+    def replace(self, src, dst):
+        return self.__call('replace', src, dst)
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def __call(self, op, *args):
+        with self.lock:
+            self.counts[op] += 1
+        delay = self.latencies.get(op, self.latency)
+        if delay:
+            time.sleep(delay)
+        return getattr(self.inner, op)(*args)
+
+
+class ObjectStore:
+    """ Content-addressed store of rendered files keyed by SHA-256 digest of their content. Objects are
+        read-only, destinations hardlinked to them share their inode and must not be edited in place.
+        Destinations that need other read permissions than the objects (like a 0600 ~/.netrc) get a copy """
+
+    MODE = 0o444
+
+    def __init__(self, path):
+        self.path = path
+
+    @staticmethod
+    def digest(data):
+        import hashlib
+        return hashlib.sha256(data).hexdigest()
+
+    def object_path(self, digest):
+        return self.path / digest[:2] / digest[2:]
+
+    def put(self, data, digest=None, fs=None):
+        """ Store data on the file system backend fs (the real one by default), returns its digest """
+        fs = fs or OsFileSystem()
+        digest = digest or ObjectStore.digest(data)
+        obj = self.object_path(digest)
+
+        # An object modified through a writable hardlink (by root, or from an older version) is replaced,
+        # destinations still sharing the modified inode then differ and get relinked by the next sync
+        if not fs.is_file(obj) or not fs.equals(obj, data):
+            fs.makedirs(obj.parent)
+            tmp = obj.with_name(f'.{obj.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+            fs.write_bytes(tmp, data)
+            fs.chmod(tmp, ObjectStore.MODE)
+            fs.replace(tmp, obj)
+        elif fs.stat(obj).st_mode & 0o7777 != ObjectStore.MODE:
+            fs.chmod(obj, ObjectStore.MODE)
+
+        return digest
+
+    def link(self, digest, dst, fs=None, mode=None):
+        """ Atomically replace dst with a hardlink, reflink or (as a last resort) a copy of the object. A
+            hardlink shares the read-only mode of the object, so it is only used when mode (the mode dst
+            should have) grants the same read and execute permissions, a copy gets mode itself """
+        fs = fs or OsFileSystem()
+        obj = self.object_path(digest)
+        tmp = dst.with_name('.' + dst.name + '.dotref-tmp')
+        if fs.lexists(tmp):
+            fs.unlink(tmp)
+
+        if mode is None or mode & ~0o222 == ObjectStore.MODE:
+            try:
+                fs.link(obj, tmp)
+                fs.replace(tmp, dst)
+                return
+            except OSError:
+                if fs.lexists(tmp):
+                    fs.unlink(tmp)
+
+        fs.copy(obj, tmp)
+        fs.chmod(tmp, ObjectStore.MODE if mode is None else mode)
+        fs.replace(tmp, dst)
+
+
+class Journal:
+    """ Prior state of every destination touched by a sync or unlink, saved as a numbered generation """
+
+    KEEP = 10
+
+    def __init__(self, statedir):
+        self.dir = statedir / 'generations'
+        self.store = ObjectStore(statedir / 'objects')
+        self.entries = []
+        self.recorded = set()
+        self.switched = False
+        self.profile = None
+
+    def writable(self):
+        """ Whether generations and file snapshots can be saved, checked before anything is changed """
+        import tempfile
+        try:
+            for directory in (self.dir, self.store.path):
+                directory.mkdir(parents=True, exist_ok=True)
+                with tempfile.TemporaryFile(dir=str(directory)):
+                    pass
+        except OSError:
+            return False
+        return True
+
+    def record_profile(self, profile):
+        """ Current profile before a switch, restored by rollback along with the files """
+        self.entries.append({'type': 'profile', 'profile': profile})
+
+    def record(self, path, fs=None):
+        """ Record the state of path on the file system backend fs, which keeps file snapshots as well """
+        fs = fs or OsFileSystem()
+        key = os.path.abspath(path)
+        if key in self.recorded:
+            return
+        self.recorded.add(key)
+
+        try:
+            mode = fs.lstat(path).st_mode
+        except (FileNotFoundError, NotADirectoryError):
+            mode = 0
+        if stat.S_ISLNK(mode):
+            entry = {'type': 'link', 'target': fs.readlink(path)}
+        elif stat.S_ISREG(mode):
+            entry = {'type': 'file', 'digest': self.store.put(fs.read_bytes(path), fs=fs),
+                    'mode': mode & 0o7777}
+        elif stat.S_ISDIR(mode):
+            entry = {'type': 'dir'}
+        else:
+            entry = {'type': 'absent'}
+
+        entry['path'] = key
+        self.entries.append(entry)
+
+    def commit(self):
+        if not self.entries:
+            return None
+
+        self.dir.mkdir(parents=True, exist_ok=True)
+        generations = self.generations()
+        number = generations[-1] + 1 if generations else 1
+        atomic_write(self.dir / f'{number}.json', json.dumps(self.entries))
+
+        for old in generations[:max(0, len(generations) + 1 - Journal.KEEP)]:
+            (self.dir / f'{old}.json').unlink()
+
+        return number
+
+    def generations(self):
+        if not self.dir.is_dir():
+            return []
+        return sorted(int(f.stem) for f in self.dir.glob('*.json') if f.stem.isdigit())
+
+    def rollback(self):
+        """ Restore the latest generation and drop it, returns list of action results. The profile a switch
+            changed from is left in the profile attribute and switched is set """
+        generations = self.generations()
+        if not generations:
+            raise ValueError('Nothing to roll back')
+
+        filename = self.dir / f'{generations[-1]}.json'
+        with open(filename, 'r') as f:
+            entries = json.load(f)
+
+        results = []
+        for entry in reversed(entries):
+            if entry['type'] == 'profile':
+                self.switched, self.profile = True, entry['profile']
+            else:
+                results.append(self.__restore(entry))
+        filename.unlink()
+        return results
+
+    def __restore(self, entry):
+        path = pathlib.Path(entry['path'])
+        kind = entry['type']
+
+        if kind == 'dir' and path.is_dir() and not path.is_symlink():
+            return ActionResult(ActionState.OK, path)
+
+        if kind == 'file':
+            data = self.store.object_path(entry['digest']).read_bytes()
+            if ObjectStore.digest(data) != entry['digest']:
+                return ActionResult(ActionState.CONFLICT, path)
+
+        if path.is_symlink() or path.is_file():
+            path.unlink()
+        elif path.is_dir():
+            try:
+                path.rmdir()
+            except OSError:
+                return ActionResult(ActionState.CONFLICT, path)
+
+        if kind == 'link':
+            os.symlink(entry['target'], path)
+        elif kind == 'file':
+            path.write_bytes(data)
+            os.chmod(path, entry['mode'])
+        elif kind == 'dir':
+            path.mkdir()
+
+        return ActionResult(ActionState.RESTORED, path)
+
+
+class SerialEngine:
+    """ Applies actions of a phase one by one in the calling thread """
+
+    def run(self, fn, actions, emit=None):
+        """ Apply fn to every action, results are passed to emit as they come or returned as a list """
+        results = []
+        for a in actions:
+            result = fn(a)
+            if emit:
+                emit(result)
+            else:
+                results.append(result)
+        return results
+
+
+class AsyncEngine:
+    """ Pipelines blocking file system calls of all actions in a phase through a bounded executor """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+
+    def run(self, fn, actions, emit=None):
+        """ Same as SerialEngine.run, results are emitted in the order of actions """
+        import asyncio
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.__run(loop, fn, actions, emit))
+        finally:
+            loop.close()
+
+    async def __run(self, loop, fn, actions, emit):
+        import asyncio
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            futures = [loop.run_in_executor(executor, fn, a) for a in actions]
+            results = []
+            try:
+                for future in futures:
+                    result = await future
+                    if emit:
+                        emit(result)
+                    else:
+                        results.append(result)
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                await asyncio.gather(*futures, return_exceptions=True)
+                raise
+            return results
+
+
+class ConflictError(Exception):
+    """ Conflict detected while running in fail-fast mode """
+
+
+class ResultSink:
+    """ Consumer of action results streamed by a ResultPipeline """
+
+    def begin(self, profile, command):
+        pass
+
+    def section(self, kind, header):
+        pass
+
+    def result(self, kind, result):
+        pass
+
+    def end_section(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ConsoleSink(ResultSink):
+    """ Prints results section by section, only a section is buffered to align columns """
+
+    def __init__(self, log):
+        self.log = log
+        self.header = None
+        self.results = []
+
+    def section(self, kind, header):
+        self.header = header
+        self.results = []
+
+    def result(self, kind, result):
+        self.results.append(result)
+
+    def end_section(self):
+        if self.results:
+            Profile.print_action_results(self.log, self.header, self.results)
+        self.results = []
+
+
+class JsonlSink(ResultSink):
+    """ Writes every result as a JSON line as soon as it's produced """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = None
+        self.prefix = {}
+
+    def begin(self, profile, command):
+        if self.file is None:
+            self.file = open(self.filename, 'w')
+        self.prefix = {'profile': profile, 'command': command.name.lower()}
+
+    def result(self, kind, result):
+        self.file.write(json.dumps(dict(self.prefix, kind=kind, state=result.state.name, src=result.left_str,
+            dst=str(result.right) if result.right is not None else None)) + '\n')
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+class CounterSink(ResultSink):
+    """ Counts results by kind and state on the fly """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def result(self, kind, result):
+        self.counts[(kind, result.state)] += 1
+
+    @property
+    def has_conflicts(self):
+        return any(state == ActionState.CONFLICT and n for (_, state), n in self.counts.items())
+
+    @property
+    def has_failures(self):
+        return any(state == ActionState.FAILED and n for (_, state), n in self.counts.items())
+
+    @property
+    def in_sync(self):
+        drift = (ActionState.CONFLICT, ActionState.MISSING, ActionState.DIFFERS, ActionState.FAILED)
+        return not any(state in drift and n for (_, state), n in self.counts.items())
+
+
+class FailFastSink(ResultSink):
+    """ Aborts the run on the first conflict """
+
+    def result(self, kind, result):
+        if result.state == ActionState.CONFLICT:
+            raise ConflictError(f'Conflict detected for "{result.right or result.left}", '
+                'stopping because of --fail-fast')
+
+
+class Metrics(ResultSink):
+    """ Run metrics in the Prometheus text format, meant for the node_exporter textfile collector """
+
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.durations = collections.Counter()
+        self.rendered_bytes = 0
+        self.profile = None
+        self.command = None
+        self.in_sync = None
+        self.operations = None
+        self.lock = threading.Lock()
+        self.io = Metrics.__read_io()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[name] += time.perf_counter() - start
+
+    def begin(self, profile, command):
+        self.profile = profile
+        self.command = command.name.lower()
+
+    def result(self, kind, result):
+        self.counts[(self.profile, kind, result.state)] += 1
+
+    def add_rendered(self, size):
+        with self.lock:
+            self.rendered_bytes += size
+
+    def render(self):
+        lines = [
+            '# HELP dotref_entries Number of profile entries by kind and state in the last run',
+            '# TYPE dotref_entries gauge',
+        ]
+        for profile, kind in sorted({(p, k) for p, k, _ in self.counts}):
+            for state in ActionState:
+                lines.append(f'dotref_entries{{command="{self.command}",profile="{Metrics.escape(profile)}",'
+                    f'kind="{kind}",state="{state.name}"}} {self.counts[(profile, kind, state)]}')
+
+        if self.in_sync is not None:
+            lines += [
+                '# HELP dotref_in_sync Whether the last run found every entry in sync',
+                '# TYPE dotref_in_sync gauge',
+                f'dotref_in_sync{{command="{self.command}",profile="{Metrics.escape(self.profile)}"}} '
+                f'{int(self.in_sync)}',
+            ]
+
+        lines += [
+            '# HELP dotref_phase_duration_seconds Wall clock time spent in each phase of the last run',
+            '# TYPE dotref_phase_duration_seconds gauge',
+        ]
+        lines += [f'dotref_phase_duration_seconds{{phase="{name}"}} {seconds:.6f}'
+            for name, seconds in sorted(self.durations.items())]
+
+        lines += [
+            '# HELP dotref_rendered_bytes Bytes of template output rendered in the last run',
+            '# TYPE dotref_rendered_bytes gauge',
+            f'dotref_rendered_bytes {self.rendered_bytes}',
+        ]
+
+        if self.operations is not None:
+            lines += [
+                '# HELP dotref_fs_operations File system operations (stat, lstat, readlink, symlink, ...) '
+                'issued by entries in the last run',
+                '# TYPE dotref_fs_operations gauge',
+            ]
+            lines += [f'dotref_fs_operations{{op="{op}"}} {count}'
+                for op, count in sorted(self.operations.items())]
+
+        io = Metrics.__read_io()
+        if io and self.io:
+            lines += [
+                '# HELP dotref_io_syscalls Read and write system calls of the last run from /proc/self/io',
+                '# TYPE dotref_io_syscalls gauge',
+                f'dotref_io_syscalls{{op="read"}} {io["syscr"] - self.io["syscr"]}',
+                f'dotref_io_syscalls{{op="write"}} {io["syscw"] - self.io["syscw"]}',
+            ]
+
+        lines += [
+            '# HELP dotref_last_run_timestamp_seconds Time the last run finished',
+            '# TYPE dotref_last_run_timestamp_seconds gauge',
+            f'dotref_last_run_timestamp_seconds {time.time():.3f}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        # Read by the node exporter, usually running as another user
+        atomic_write(pathlib.Path(filename), self.render(), mode=0o644)
+
+    @staticmethod
+    def escape(value):
+        """ Label value escaped for the text format """
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    @staticmethod
+    def __read_io():
+        """ Per-process I/O counters, only available on Linux """
+        try:
+            with open('/proc/self/io', 'r') as f:
+                return {k: int(v) for k, v in (line.split(':') for line in f)}
+        except (OSError, ValueError):
+            return None
+
+
+class ResultPipeline:
+    """ Dispatches streamed results to sinks, always counting them """
+
+    def __init__(self, sinks):
+        self.counter = CounterSink()
+        self.sinks = [self.counter] + list(sinks)
+        self.kind = None
+
+    def begin(self, profile, command):
+        for sink in self.sinks:
+            sink.begin(profile, command)
+
+    def section(self, kind, header):
+        self.kind = kind
+        for sink in self.sinks:
+            sink.section(kind, header)
+
+    def emit(self, results):
+        """ Accepts a single result or a list of results """
+        for result in (results if isinstance(results, list) else [results]):
+            for sink in self.sinks:
+                sink.result(self.kind, result)
+
+    def end_section(self):
+        for sink in self.sinks:
+            sink.end_section()
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+    @property
+    def has_conflicts(self):
+        return self.counter.has_conflicts
+
+    @property
+    def has_failures(self):
+        return self.counter.has_failures
+
+    @property
+    def in_sync(self):
+        return self.counter.in_sync
+
+
+class TreeCache:
+    """ Cache of directory listings keyed by directory mtime, optionally persisted between runs """
+
+    def __init__(self, filename=None, fs=None):
+        self.filename = filename
+        self.fs = fs or OsFileSystem()
+        self.entries = None
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def listdir(self, path):
+        """ Sorted list of (name, is_dir) pairs """
+        key = os.path.abspath(path)
+        mtime = self.fs.stat(key).st_mtime_ns
+
+        with self.lock:
+            cached = self.__load().get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        listing = sorted([e.name, e.is_dir()] for e in self.fs.scandir(key))
+
+        with self.lock:
+            self.entries[key] = [mtime, listing]
+            self.dirty = True
+        return listing
+
+    def save(self):
+        if self.filename and self.dirty:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(self.filename, json.dumps(self.entries))
+            self.dirty = False
+
+    def __load(self):
+        if self.entries is None:
+            self.entries = {}
+            if self.filename and self.filename.is_file():
+                try:
+                    with open(self.filename, 'r') as f:
+                        entries = json.load(f)
+                    if isinstance(entries, dict):
+                        self.entries = entries
+                except ValueError:
+                    pass
+        return self.entries
+
+
+class Fingerprint:
+    """ Aggregate fingerprint of managed destinations, their sources and profiles for quick drift checks """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def matches(self, profile):
+        """ Compare the stored fingerprint with the current state, stopping at the first difference """
+        try:
+            with open(self.filename, 'r') as f:
+                fingerprint = json.load(f)
+            if fingerprint.get('profile') != profile:
+                return False
+            # A malformed item makes the fingerprint stale rather than failing the check
+            for kind, name, signature in fingerprint['items']:
+                if Fingerprint.signature(kind, name) != signature:
+                    return False
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            return False
+        return True
+
+    def save(self, profile, items):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.filename, json.dumps({'profile': profile,
+            'items': [[kind, name, Fingerprint.signature(kind, name)] for kind, name in items]}))
+
+    def clear(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def applies(merged):
+        """ Output of command variables can change at any time without changing any fingerprinted file """
+        return not (merged.template and any(v.command for v in merged.vars))
+
+    @staticmethod
+    def collect(merged, tree):
+        """ (kind, name) items describing everything a status of the merged profile depends on """
+        def path(p):
+            return ('path', os.path.abspath(os.path.expanduser(p)))
+
+        items = [path(p.filename) for p in merged.ancestors()]
+        items += [path(c.name) for c in merged.create]
+        for link in merged.link:
+            if link.recursive or link.is_pattern():
+                pairs = link.expand(tree)
+                top = pathlib.Path(link.src).parent if link.is_pattern() else pathlib.Path(link.src)
+                dirs = {os.path.abspath(top)} | {os.path.abspath(src.parent) for src, _ in pairs}
+                items += [('dir', d) for d in sorted(dirs)]
+                items += [path(dst) for _, dst in pairs]
+            else:
+                items += [path(link.src), path(link.dst)]
+        items += [path(p) for entry in merged.copy + merged.template for p in (entry.src, entry.dst)]
+        items += [('env', v.env) for v in merged.vars if v.env]
+        return items
+
+    @staticmethod
+    def signature(kind, name):
+        if kind == 'env':
+            return os.environ.get(name)
+        try:
+            st = os.lstat(name)
+        except OSError:
+            return None
+        if kind == 'dir':
+            return st.st_mtime_ns
+        if stat.S_ISDIR(st.st_mode):
+            return [st.st_mode]
+        if stat.S_ISLNK(st.st_mode):
+            return [st.st_mode, os.readlink(name)]
+        return [st.st_mode, st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class GitState:
+    """ Repository HEAD and dirty files at the last successful sync, used to skip untouched entries """
+
+    def __init__(self, filename, repo):
+        self.filename = filename
+        self.repo = repo
+
+    def save(self, profile, env):
+        import subprocess
+        try:
+            head = self.__git('rev-parse', '--verify', 'HEAD').strip()
+            dirty = self.__changed_since(self.toplevel(), head)
+        except (OSError, subprocess.CalledProcessError):
+            return
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.filename, json.dumps({'profile': profile, 'env': env, 'head': head,
+            'dirty': sorted(dirty)}))
+
+    def clear(self):
+        try:
+            os.unlink(self.filename)
+        except FileNotFoundError:
+            pass
+
+    def changes(self, profile, env):
+        """ (changed, tracked) sets of absolute real paths, None when a full check is needed """
+        import subprocess
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            if state.get('profile') != profile or state.get('env') != env:
+                return None
+            toplevel = self.toplevel()
+            tracked = []
+            for line in self.__git('-C', toplevel, 'ls-files', '-z', '--stage').split('\0'):
+                if line:
+                    mode, path = line.split(' ', 1)[0], line.split('\t', 1)[1]
+                    if mode == '160000':
+                        return None
+                    tracked.append(path)
+            changed = self.__changed_since(toplevel, state['head']) | set(state['dirty'])
+        except (OSError, ValueError, AttributeError, KeyError, TypeError, subprocess.CalledProcessError):
+            return None
+        return ({os.path.join(toplevel, p) for p in changed}, {os.path.join(toplevel, p) for p in tracked})
+
+    @staticmethod
+    def unchanged(merged, changes):
+        """ Keys of link, copy and template entries whose sources and defining profiles are untouched """
+        changed, tracked = changes
+        changed_dirs = {d for p in changed for d in GitState.__parents(p)}
+        tracked_dirs = {d for p in tracked for d in GitState.__parents(p)}
+
+        def untouched(path, is_dir=False):
+            path = os.path.realpath(path)
+            if is_dir:
+                return path in tracked_dirs and path not in changed_dirs and path not in changed
+            return path in tracked and path not in changed
+
+        changed_profiles = {p.name for p in merged.ancestors() if not untouched(p.filename)}
+        keys = set()
+        for entry in merged.link + merged.copy:
+            if entry.profile in changed_profiles:
+                continue
+            if isinstance(entry, LinkAction) and entry.is_pattern():
+                is_unchanged = untouched(pathlib.Path(entry.src).parent, True)
+            elif isinstance(entry, LinkAction) and entry.recursive:
+                is_unchanged = untouched(entry.src, True)
+            else:
+                is_unchanged = untouched(entry.src)
+            if is_unchanged:
+                keys.add(entry.key())
+
+        if not changed_profiles and not any(v.command for v in merged.vars):
+            keys.update(t.key() for t in merged.template if untouched(t.src))
+        return keys
+
+    def toplevel(self):
+        """ Root of the working tree containing repo, raises OSError or CalledProcessError outside of one """
+        return os.path.realpath(self.__git('rev-parse', '--show-toplevel').strip())
+
+    def __changed_since(self, toplevel, head):
+        """ Paths changed in the working tree since the commit and untracked paths, relative to toplevel """
+        changed = self.__git('-C', toplevel, 'diff', '--name-only', '-z', '--no-renames', head, '--')
+        untracked = self.__git('-C', toplevel, 'ls-files', '-z', '--others', '--exclude-standard')
+        return {p for p in changed.split('\0') + untracked.split('\0') if p}
+
+    def __git(self, *args):
+        import subprocess
+        return subprocess.run(['git', '-C', str(self.repo)] + list(args), check=True, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL).stdout.decode('utf-8', 'surrogateescape')
+
+    @staticmethod
+    def __parents(path):
+        parent = os.path.dirname(path)
+        while parent != path:
+            yield parent
+            path, parent = parent, os.path.dirname(parent)
+
+
+class Schedule:
+    """ Spreads periodic syncs of many hosts over time and backs off after failed or unusually slow runs.
+        Hosts sharing the state directory (over NFS) keep separate state, one failing host doesn't hold
+        back the others """
+
+    HISTORY = 10
+    MAX_SKIP = 15
+
+    def __init__(self, statedir, splay, host=None):
+        import socket
+        self.host = host or socket.gethostname()
+        self.filename = statedir / f'schedule.{self.host}.json'
+        self.splay = splay
+        self.runs = []
+        self.skip = 0
+
+    def delay(self, host=None):
+        """ Deterministic per-host offset in [0, splay), the same on every run so hosts stay spread out """
+        import hashlib
+        digest = hashlib.sha256((host or self.host).encode()).digest()
+        return self.splay * int.from_bytes(digest[:8], 'big') / (1 << 64)
+
+    def load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                state = json.load(f)
+            self.runs = [(float(r['duration']), bool(r['ok'])) for r in state['runs']][-Schedule.HISTORY:]
+            self.skip = int(state['skip'])
+        except (OSError, ValueError, TypeError, KeyError):
+            self.runs, self.skip = [], 0
+
+    def save(self):
+        self.filename.parent.mkdir(parents=True, exist_ok=True)
+        atomic_write(self.filename, json.dumps({'skip': self.skip,
+            'runs': [{'duration': d, 'ok': ok} for d, ok in self.runs]}))
+
+    def due(self):
+        """ False while backing off, every call consumes one skipped run """
+        self.load()
+        if self.skip <= 0:
+            return True
+        self.skip -= 1
+        self.save()
+        return False
+
+    def record(self, duration, ok):
+        """ Remember the run and work out how many of the next scheduled runs to skip """
+        previous = sorted(d for d, ok in self.runs if ok)
+        self.runs = (self.runs + [(duration, ok)])[-Schedule.HISTORY:]
+
+        failures = 0
+        for _, run_ok in reversed(self.runs):
+            if run_ok:
+                break
+            failures += 1
+        # Skip 1, 3, 7, ... runs after consecutive failures, and at least one when most recent runs failed
+        # or the last one took more than twice as long as usual, which usually means an overloaded server
+        self.skip = min((1 << failures) - 1, Schedule.MAX_SKIP)
+        if len(self.runs) >= 4 and 2 * sum(not run_ok for _, run_ok in self.runs) > len(self.runs):
+            self.skip = max(self.skip, 1)
+        if ok and len(previous) >= 3 and duration > 2 * previous[len(previous) // 2]:
+            self.skip = max(self.skip, 1)
+        self.save()
+
+
+class HookRunner(ResultSink):
+    """ Runs pre hooks before sync and post hooks whose watched entries changed during it. Hooks not
+        ordered with "after" run in parallel, hooks with the same inputs as on their last successful run
+        are skipped """
+
+    CHANGED = (ActionState.CREATED, ActionState.LINKED, ActionState.COPIED, ActionState.RENDERED)
+
+    def __init__(self, filename=None, jobs=8):
+        self.filename = filename
+        self.jobs = jobs
+        self.changed = []
+
+    def begin(self, profile, command):
+        self.changed = []
+
+    def result(self, kind, result):
+        if kind != 'hooks' and result.state in HookRunner.CHANGED:
+            path = result.right if result.right is not None else result.left
+            self.changed.append(os.path.abspath(os.path.expanduser(str(path))))
+
+    def run(self, when, merged, ctx, log):
+        """ ActionResult of every triggered hook in profile order """
+        import concurrent.futures
+        hooks = [h for h in merged.hooks if h.when == when]
+        changed = {h.name: [p for p in self.changed if h.watches(p)] for h in hooks}
+        if when == 'post':
+            hooks = [h for h in hooks if changed[h.name]]
+        if not hooks:
+            return []
+
+        cache = self.__load()
+        names = {h.name for h in hooks}
+        pending, running, states = list(hooks), {}, {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            while pending or running:
+                ready = [h for h in pending if all(a in states or a not in names for a in h.after)]
+                if not ready and not running:
+                    raise ProfileError('Hooks wait for each other: ' + ', '.join(h.name for h in pending))
+
+                for hook in ready:
+                    pending.remove(hook)
+                    if any(states.get(a) == ActionState.FAILED for a in hook.after):
+                        log.err(f'Hook "{hook.name}" skipped, a hook it runs after has failed')
+                        states[hook.name] = ActionState.FAILED
+                        continue
+                    digest = HookRunner.__digest(hook, merged, ctx.tree)
+                    if cache.get(f'{merged.name}:{hook.name}') == digest:
+                        states[hook.name] = ActionState.OK
+                        continue
+                    env = dict(os.environ, DOTREF_PROFILE=merged.name,
+                        DOTREF_CHANGED='\n'.join(changed[hook.name]))
+                    running[executor.submit(HookRunner.__execute, hook, env, log)] = (hook, digest)
+
+                if running:
+                    done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        hook, digest = running.pop(future)
+                        states[hook.name] = future.result()
+                        if states[hook.name] == ActionState.RAN:
+                            cache[f'{merged.name}:{hook.name}'] = digest
+
+        self.__save(cache)
+        return [ActionResult(states[h.name], h.name) for h in hooks]
+
+    @staticmethod
+    def __execute(hook, env, log):
+        import signal
+        import subprocess
+        try:
+            proc = subprocess.Popen(hook.command, shell=True, env=env, stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        except OSError as e:
+            log.err(f'Hook "{hook.name}" failed to start: {e}')
+            return ActionState.FAILED
+
+        try:
+            output = proc.communicate(timeout=hook.timeout)[0]
+        except subprocess.TimeoutExpired:
+            # Kill the whole session, otherwise children of the shell keep the output pipe open
+            if hasattr(os, 'killpg'):
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                proc.kill()
+            proc.communicate()
+            log.err(f'Hook "{hook.name}" timed out after {hook.timeout} seconds')
+            return ActionState.FAILED
+
+        if proc.returncode:
+            output = output.decode(errors='replace').rstrip()
+            log.err(f'Hook "{hook.name}" failed with exit code {proc.returncode}' +
+                (f':\n{output}' if output else ''))
+            return ActionState.FAILED
+        return ActionState.RAN
+
+    @staticmethod
+    def __digest(hook, merged, tree):
+        """ Key of the hook inputs: its command and the stat signatures of everything it watches in the merged
+            profile, followed through symlinks. Listings come from the tree cache, no file is read """
+        import hashlib
+        paths = [c.name for c in merged.create] + [e.dst for e in merged.copy + merged.template]
+        for link in merged.link:
+            pairs = link.expand(tree) if link.recursive or link.is_pattern() else [(link.src, link.dst)]
+            paths += [str(dst) for _, dst in pairs]
+        paths = sorted({os.path.abspath(os.path.expanduser(p)) for p in paths})
+
+        digest = hashlib.sha256(hook.command.encode())
+        for path in (p for p in paths if hook.watches(p)):
+            real = os.path.realpath(path)
+            signature = Fingerprint.signature('dir' if os.path.isdir(real) else 'path', real)
+            digest.update(json.dumps([path, real, signature]).encode() + b'\0')
+        return digest.hexdigest()
+
+    def __load(self):
+        try:
+            with open(self.filename, 'r') as f:
+                cache = json.load(f)
+            return cache if isinstance(cache, dict) else {}
+        except (OSError, TypeError, ValueError):
+            return {}
+
+    def __save(self, cache):
+        if self.filename:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(self.filename, json.dumps(cache))
+
+
+class SymlinkScanner:
+    """ Parallel os.scandir walk collecting symlinks, limited in depth and pruning excluded directories """
+
+    PRUNE = ('.cache', 'node_modules', '.git', '.hg', '.svn', '__pycache__', '.venv', 'venv', '.tox', '.npm',
+        '.cargo', '.rustup', '.gradle', '.m2', '.local/share/Trash', 'snap')
+
+    def __init__(self, depth=6, excludes=(), jobs=8):
+        self.depth = depth
+        self.excludes = list(SymlinkScanner.PRUNE) + list(excludes)
+        self.jobs = jobs
+        self.prune = set()
+
+    def scan(self, roots, prune=()):
+        """ Sorted (link, absolute target) pairs, directories in prune are not entered """
+        import concurrent.futures
+        self.prune = {os.path.abspath(p) for p in prune}
+        found = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            pending = {executor.submit(self.__scan_dir, os.path.abspath(root), '', 0) for root in roots}
+            while pending:
+                done, pending = concurrent.futures.wait(pending,
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    links, dirs = future.result()
+                    found += links
+                    pending |= {executor.submit(self.__scan_dir, *d) for d in dirs}
+        return sorted(found)
+
+    def __scan_dir(self, path, rel, depth):
+        links, dirs = [], []
+        try:
+            with os.scandir(path) as it:
+                for e in it:
+                    if e.is_symlink():
+                        try:
+                            links.append((e.path, os.path.normpath(os.path.join(path, os.readlink(e.path)))))
+                        except OSError:
+                            pass
+                    elif depth < self.depth and e.is_dir(follow_symlinks=False):
+                        child = rel + '/' + e.name if rel else e.name
+                        if not self.__excluded(e.path, e.name, child):
+                            dirs.append((e.path, child, depth + 1))
+        except OSError:
+            pass
+        return links, dirs
+
+    def __excluded(self, path, name, rel):
+        return path in self.prune or \
+            any(fnmatch.fnmatchcase(name, g) or fnmatch.fnmatchcase(rel, g) for g in self.excludes)
+
+
+class TemplateRenderer:
+    """ Renders templates in a process pool once the bytes rendered in-process show that the pool is worth
+        its startup, the caller still writes files and reports results in profile order """
+
+    THRESHOLD = 1 << 20
+
+    def __init__(self, jobs=1, threshold=THRESHOLD):
+        self.jobs = jobs
+        self.threshold = threshold
+        self.executor = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.templates = []
+
+    def start(self, templates, command, vars, fs):
+        """ Remember the templates of the phase, nothing is read or submitted until rendered() is called """
+        self.templates = list(templates) if self.jobs > 1 else []
+        self.requested = set()
+        self.size = 0
+        self.vars = vars
+        self.fs = fs
+
+    def rendered(self, size):
+        """ Size of a template rendered in-process, past the threshold the remaining ones go to the pool """
+        with self.lock:
+            if not self.templates or self.executor:
+                return
+            self.size += size
+            todo = [t for t in self.templates if t.key() not in self.requested]
+            if self.size < self.threshold or len(todo) < 2:
+                return
+            self.templates = []
+
+            import concurrent.futures
+            try:
+                self.executor = concurrent.futures.ProcessPoolExecutor(min(self.jobs, len(todo)))
+            except (OSError, NotImplementedError):
+                return
+
+            self.values = {}
+            for t in todo:
+                try:
+                    text = self.fs.read_bytes(t.src)
+                except OSError:
+                    # Let the in-process path report missing templates
+                    continue
+                encoding = t.get_encoding()
+                if encoding not in self.values:
+                    self.values[encoding] = EncodedVariables(self.vars, encoding).known()
+                future = self.executor.submit(render_template, text, dict(self.values[encoding]))
+                self.pending[t.key()] = (future, text, encoding)
+
+    def result(self, template):
+        """ Rendered bytes of a submitted template or None if it has to be rendered in-process """
+        with self.lock:
+            if self.templates:
+                self.requested.add(template.key())
+            entry = self.pending.pop(template.key(), None)
+        if entry is None:
+            return None
+
+        future, text, encoding = entry
+        while True:
+            try:
+                return future.result()
+            except KeyError as e:
+                # Workers only get variables evaluated so far, evaluate the missing one here and retry
+                name = e.args[0] if e.args else None
+                with self.lock:
+                    values = self.values[encoding]
+                    if name in values:
+                        raise TemplateVarError(str(e))
+                    try:
+                        values[name] = EncodedVariables(self.vars, encoding)[name]
+                    except KeyError as missing:
+                        raise TemplateVarError(str(missing))
+                    values = dict(values)
+                future = self.executor.submit(render_template, text, values)
+
+    def close(self):
+        for future, _, _ in self.pending.values():
+            future.cancel()
+        self.pending = {}
+        self.templates = []
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
+
+
+class ApplyContext:
+    """ State shared by all actions during a single run """
+
+    def __init__(self, store=None, journal=None, engine=None, tree=None, sinks=None, metrics=None, fs=None,
+            renderer=None, hooks=None):
+        self.store = store
+        self.journal = journal
+        self.engine = engine or SerialEngine()
+        self.fs = fs or OsFileSystem()
+        self.tree = tree or TreeCache(fs=self.fs)
+        self.sinks = sinks or []
+        self.metrics = metrics
+        self.renderer = renderer or TemplateRenderer()
+        self.hooks = hooks or HookRunner()
+        self.lock = threading.Lock()
+
+    def phase(self, name):
+        # contextlib.suppress() without arguments is a no-op context manager, nullcontext needs Python 3.7
+        return self.metrics.phase(name) if self.metrics else contextlib.suppress()
+
+    def record(self, path):
+        if self.journal:
+            with self.lock:
+                self.journal.record(path, self.fs)
+
+    def record_missing_parents(self, path):
+        if self.journal:
+            with self.lock:
+                missing = []
+                while not self.fs.lexists(path) and path != path.parent:
+                    missing.append(path)
+                    path = path.parent
+                for p in reversed(missing):
+                    self.journal.record(p, self.fs)
+
+
+class ProfileIndex:
+    """ Persisted index of the profile names of every layer, each layer refreshed on its own mtime change.
+        A read-only index (used by shell completion) never writes, a stale layer is only rescanned """
+
+    VERSION = 3
+
+    def __init__(self, dotdirs, statefile, readonly=False):
+        self.dotdirs = dotdirs
+        self.statefile = statefile
+        self.filename = statefile.with_suffix('.d') / 'index.json'
+        self.readonly = readonly
+
+    def layers(self):
+        """ Profiles of each layer in precedence order, rescanning only the layers that have changed """
+        if not self.readonly:
+            # Before the layers are stat'ed, creating the state directory changes the mtime of the first one
+            try:
+                self.filename.parent.mkdir(exist_ok=True)
+            except OSError:
+                pass
+        try:
+            with open(self.filename, 'r') as f:
+                index = json.load(f)
+            cached = {layer['dir']: layer for layer in index['layers']} \
+                if index.get('version') == ProfileIndex.VERSION else {}
+        except (OSError, ValueError, AttributeError, KeyError, TypeError):
+            cached = {}
+
+        layers, dirty = [], False
+        for dotdir in self.dotdirs:
+            key = os.path.abspath(dotdir)
+            try:
+                mtime = dotdir.stat().st_mtime_ns
+            except FileNotFoundError:
+                mtime = None
+            layer = cached.get(key)
+            if not layer or layer.get('mtime') != mtime:
+                profiles = self.__scan(dotdir) if mtime is not None else {}
+                layer = {'dir': key, 'mtime': mtime, 'profiles': profiles}
+                dirty = True
+            layers.append(layer)
+
+        if (dirty or len(cached) != len(layers)) and not self.readonly:
+            try:
+                atomic_write(self.filename, json.dumps({'version': ProfileIndex.VERSION, 'layers': layers}))
+            except OSError:
+                # Read-only dotdir, the layers are rescanned next time
+                pass
+        return [layer['profiles'] for layer in layers]
+
+    def load(self):
+        """ Combined namespace: a profile of a higher precedence layer hides the same named ones below it """
+        profiles = {}
+        for layer in reversed(self.layers()):
+            profiles.update(layer)
+        return {name: p for name, p in profiles.items() if not p.get('broken')}
+
+    def __scan(self, dotdir):
+        profiles = {}
+        for f in dotdir.glob('*.json'):
+            if f.name == self.statefile.name or f.name.startswith('.') or not f.is_file():
+                continue
+            try:
+                with open(f, 'r') as pf:
+                    json.load(pf)
+            except (OSError, ValueError):
+                profiles[f.stem] = {'broken': True}
+                continue
+            profiles[f.stem] = {}
+        return profiles
+
+
+class ProfileSet(collections.abc.Mapping):
+    """ Combined profile namespace of layered dotdirs, profiles are parsed on first access only
+
+        The first dotdir has the highest precedence. A profile extending its own name continues to the
+        same named profile of a lower layer, relative sources of lower layers are resolved against the
+        repository containing that layer. """
+
+    def __init__(self, dotdirs, statefile):
+        self.dotdirs = dotdirs
+        self.layers = ProfileIndex(dotdirs, statefile).layers()
+        self.names = sorted({name for layer in self.layers for name in layer})
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        layer = self.__find(name, 0)
+        if layer is None:
+            raise KeyError(name)
+        profile = self.__load(layer, name)
+        Profile.resolve([profile])
+        return profile
+
+    def __contains__(self, name):
+        return self.__find(name, 0) is not None
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __find(self, name, start):
+        return next((i for i in range(start, len(self.layers)) if name in self.layers[i]), None)
+
+    def __load(self, layer, name):
+        """ Parse the profile and everything it extends across layers, without recursion """
+        pending, loaded, parents = [(layer, name)], dict(self.loaded), {}
+        while pending:
+            key = pending.pop()
+            if key in loaded:
+                continue
+            i, current = key
+            profile = Profile(self.dotdirs[i] / f'{current}.json')
+            if i:
+                profile.rebase(os.path.dirname(os.path.abspath(self.dotdirs[i])))
+            loaded[key] = profile
+
+            parents[key] = []
+            for parent in profile.extends:
+                found = self.__find(parent, i + 1 if parent == current else 0)
+                if found is None:
+                    raise ProfileError(f'Profile "{current}" extends "{parent}" but it does not exist')
+                parents[key].append((found, parent))
+            pending.extend(parents[key])
+
+        for key, keys in parents.items():
+            loaded[key].parents = [loaded[k] for k in keys]
+        self.loaded = loaded
+        return loaded[(layer, name)]
 
 
 class ProfileEntry:
     """ Generic profile entry: a variable or action """
 
+    __slots__ = ('profile',)
+
     def __init__(self, profile_name):
         self.profile = profile_name
 
 
 class Variable(ProfileEntry):
-    """ "vars" entry """
+    """ "vars" entry: either a literal string or a derived variable object """
+
+    __slots__ = ('name', 'value', 'env', 'command', 'default', 'ttl', 'derived')
 
     def __init__(self, profile_name, name, value):
         super().__init__(profile_name)
         self.name = name
-        self.value = value
+        self.value = None
+        self.env = None
+        self.command = None
+        self.default = None
+        self.ttl = None
+        self.derived = False
+
+        if isinstance(value, str):
+            self.value = value
+            return
+
+        if not isinstance(value, dict):
+            raise TypeError('Variable value must be a string or an object')
+
+        sources = [k for k in ('value', 'env', 'command') if k in value]
+        if len(sources) != 1:
+            raise TypeError(f'Variable "{name}" must have exactly one of "value", "env" or "command" fields')
+
+        for field in ('value', 'env', 'command', 'default'):
+            if field in value and not isinstance(value[field], str):
+                raise TypeError(f'"{field}" field of variable "{name}" must be a string')
+
+        if 'ttl' in value:
+            if 'command' not in value:
+                raise TypeError(f'"ttl" field of variable "{name}" is only allowed with "command"')
+            if not isinstance(value['ttl'], int) or isinstance(value['ttl'], bool) or value['ttl'] < 0:
+                raise TypeError(f'"ttl" field of variable "{name}" must be a non-negative integer')
+            self.ttl = value['ttl']
+
+        self.derived = True
+        self.value = value.get('value')
+        self.env = value.get('env')
+        self.command = value.get('command')
+        self.default = value.get('default')
+
+    def definition(self):
+        return (self.value, self.env, self.command, self.default, self.ttl, self.derived)
+
+    def describe(self):
+        if not self.derived:
+            return self.value
+        elif self.value is not None:
+            return f'value: {self.value}'
+        elif self.env is not None:
+            return f'env: {self.env}'
+        else:
+            return f'command: {self.command}' + (f' (ttl {self.ttl}s)' if self.ttl is not None else '')
+
+
+class VarCache:
+    """ Persistent cache of command variable outputs with per-variable TTL """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = None
+        self.dirty = False
+
+    def get(self, command, ttl):
+        entry = self.__load().get(command)
+        if entry and time.time() - entry['time'] < ttl:
+            return entry['value']
+        return None
+
+    def put(self, command, value):
+        self.__load()[command] = {'value': value, 'time': time.time()}
+        self.dirty = True
+
+    def save(self):
+        if self.dirty:
+            self.filename.parent.mkdir(parents=True, exist_ok=True)
+            atomic_write(self.filename, json.dumps(self.entries))
+            self.dirty = False
+
+    def __load(self):
+        if self.entries is None:
+            self.entries = {}
+            if self.filename.is_file():
+                try:
+                    with open(self.filename, 'r') as f:
+                        entries = json.load(f)
+                    if isinstance(entries, dict):
+                        self.entries = entries
+                except ValueError:
+                    pass
+        return self.entries
+
+
+class Variables(collections.abc.Mapping):
+    """ Lazily evaluated and memoized variables used for template substitution """
+
+    def __init__(self, variables, cache=None):
+        self.defs = {v.name: v for v in variables}
+        self.cache = cache
+        self.values = {}
+        self.encodings = {}
+        self.evaluating = set()
+        self.lock = threading.RLock()
+
+    def __getitem__(self, name):
+        if name in self.values:
+            return self.values[name]
+
+        var = self.defs[name]
+        with self.lock:
+            if name in self.values:
+                return self.values[name]
+
+            if name in self.evaluating:
+                raise ValueError(f'Variable "{name}" references itself')
+
+            self.evaluating.add(name)
+            try:
+                value = self.__evaluate(var)
+            finally:
+                self.evaluating.discard(name)
+
+            self.values[name] = value
+            return value
+
+    def __iter__(self):
+        return iter(self.defs)
+
+    def __len__(self):
+        return len(self.defs)
+
+    def known(self):
+        """ Values available without evaluating anything: literals and already evaluated variables """
+        values = {name: var.value for name, var in self.defs.items() if not var.derived}
+        values.update(self.values)
+        return values
+
+    def __evaluate(self, var):
+        if not var.derived:
+            return var.value
+        elif var.value is not None:
+            return string.Template(var.value).substitute(self)
+        elif var.env is not None:
+            value = os.environ.get(var.env, var.default)
+            if value is None:
+                raise ValueError(f'Environment variable "{var.env}" for variable "{var.name}" is not set')
+            return value
+        else:
+            return self.__run(var)
+
+    def __run(self, var):
+        import subprocess
+        if self.cache and var.ttl:
+            value = self.cache.get(var.command, var.ttl)
+            if value is not None:
+                return value
+
+        try:
+            value = subprocess.run(var.command, shell=True, check=True, stdout=subprocess.PIPE,
+                    universal_newlines=True).stdout.rstrip('\n')
+        except (OSError, subprocess.CalledProcessError) as e:
+            if var.default is None:
+                raise ValueError(f'Command for variable "{var.name}" failed: {str(e)}') from e
+            return var.default
+
+        if self.cache and var.ttl:
+            self.cache.put(var.command, value)
+        return value
+
+
+class EncodedVariables(collections.abc.Mapping):
+    """ Variable values as bytes, each one encoded once per run and encoding """
+
+    def __init__(self, variables, encoding):
+        self.variables = variables
+        self.encoding = encoding
+        # Variables keep encoded values for the whole run, other mappings only for this object
+        self.values = variables.encodings.setdefault(encoding, {}) if isinstance(variables, Variables) else {}
+
+    def __getitem__(self, name):
+        value = self.values.get(name)
+        if value is None:
+            value = self.values[name] = self.variables[name].encode(self.encoding)
+        return value
+
+    def __iter__(self):
+        return iter(self.variables)
+
+    def __len__(self):
+        return len(self.variables)
+
+    def known(self):
+        """ Encoded values available without evaluating anything """
+        known = self.variables.known() if isinstance(self.variables, Variables) else self.variables
+        return {name: self.values.get(name) or value.encode(self.encoding) for name, value in known.items()}
 
 
 class CreateAction(ProfileEntry):
     """ "create" directory """
 
+    __slots__ = ('name', 'mode')
+
     def __init__(self, profile_name, json_action):
         super().__init__(profile_name)
         self.mode = None
@@ -157,13 +2271,37 @@ class CreateAction(ProfileEntry):
 
         self.name = json_action['name']
 
-    def apply(self, command):
+    def key(self):
+        return ('create', self.name)
+
+    @staticmethod
+    def parents_first(actions):
+        """ Actions reordered so that every directory is created before the entries nested in it, otherwise
+            creating a child would create the parent with the default mode first """
+        paths = [os.path.abspath(os.path.expanduser(a.name)) for a in actions]
+        ordered, done = [], set()
+
+        def add(i):
+            done.add(i)
+            for j, path in enumerate(paths):
+                if j not in done and paths[i].startswith(path + os.sep):
+                    add(j)
+            ordered.append(actions[i])
+
+        for i in range(len(actions)):
+            if i not in done:
+                add(i)
+        return ordered
+
+    def apply(self, command, ctx=None):
+        ctx = ctx or ApplyContext()
+        fs = ctx.fs
         state = None
         orig_path = pathlib.Path(self.name)
         target = orig_path.expanduser()
 
-        if target.exists():
-            if target.is_dir():
+        if fs.exists(target):
+            if fs.is_dir(target):
                 state = ActionState.OK
             else:
                 state = ActionState.CONFLICT
@@ -171,20 +2309,20 @@ class CreateAction(ProfileEntry):
             if command == ActionType.STATUS:
                 state = ActionState.MISSING
             elif command == ActionType.SYNC:
-                if self.mode:
-                    target.mkdir(parents=True, exist_ok=True, mode=self.mode)
-                else:
-                    target.mkdir(parents=True, exist_ok=True)
+                ctx.record_missing_parents(target)
+                fs.makedirs(target, self.mode)
                 state = ActionState.CREATED
             else:
                 state = ActionState.OK
 
-        return (state, orig_path, None)
+        return ActionResult(state, orig_path)
 
 
 class SrcDstAction(ProfileEntry):
     """ abstract action that has src and dst fields """
 
+    __slots__ = ('src', 'dst')
+
     def __init__(self, type, profile_name, json_action):
         super().__init__(profile_name)
 
@@ -203,27 +2341,125 @@ class SrcDstAction(ProfileEntry):
     def __eq__(self, other):
         return (self.src, self.dst) == (other.src, other.dst)
 
+    def __hash__(self):
+        return hash((self.src, self.dst))
+
+    def key(self):
+        return (type(self).__name__, self.src, self.dst)
+
 
 class LinkAction(SrcDstAction):
-    """ "link" file/directory """
+    """ "link" file/directory, or each file matching a pattern or inside a directory tree """
+
+    __slots__ = ('recursive',)
 
     def __init__(self, profile_name, json_action):
         super().__init__('link', profile_name, json_action)
+        self.recursive = json_action.get('recursive', False)
+
+        if not isinstance(self.recursive, bool):
+            raise TypeError('"link.recursive" field must be a boolean')
+
+        if LinkAction.__has_magic(str(pathlib.Path(self.src).parent)):
+            raise TypeError('Only the last component of a "link.src" pattern can contain wildcards')
+
+    def key(self):
+        # A switch between a plain and a recursive link of the same paths must relink them
+        return super().key() + (self.recursive, self.is_pattern())
 
-    def apply(self, command):
+    def is_pattern(self):
+        return LinkAction.__has_magic(pathlib.Path(self.src).name)
+
+    def expand(self, tree):
+        """ List of (src, dst) path pairs this entry links, with directory listings from the tree cache """
+        src = pathlib.Path(self.src)
+        dst = pathlib.Path(self.dst)
+
+        if self.is_pattern():
+            hidden = src.name.startswith('.')
+            tops = [(src.parent / name, dst / name, is_dir) for name, is_dir in tree.listdir(src.parent)
+                    if fnmatch.fnmatchcase(name, src.name) and (hidden or not name.startswith('.'))]
+        elif not tree.fs.is_dir(src):
+            raise ValueError(f'The source directory to link recursively "{self.src}" does not exist')
+        else:
+            tops = [(src, dst, True)]
+
+        pairs = []
+        for top_src, top_dst, is_dir in tops:
+            if self.recursive and is_dir:
+                LinkAction.__walk(tree, top_src, top_dst, pairs)
+            else:
+                pairs.append((top_src, top_dst))
+        return pairs
+
+    def results(self, command, ctx=None):
+        """ Apply the entry, returns a list of results with one per file for pattern and recursive links """
+        ctx = ctx or ApplyContext()
+        if not self.recursive and not self.is_pattern():
+            return [self.apply(command, ctx)]
+
+        scans = {}
+        results = []
+        for orig_src, orig_dst in self.expand(ctx.tree):
+            dst = orig_dst.expanduser()
+            parent = str(dst.parent)
+            if parent not in scans:
+                scans[parent] = LinkAction.__scan(ctx.fs, parent)
+            entry = scans[parent].get(dst.name)
+
+            if entry is None:
+                if command == ActionType.SYNC:
+                    ctx.record_missing_parents(dst.parent)
+                    ctx.fs.makedirs(dst.parent)
+                else:
+                    state = ActionState.MISSING if command == ActionType.STATUS else ActionState.OK
+                    results.append(ActionResult(state, orig_src, orig_dst))
+                    continue
+            elif command != ActionType.UNLINK and entry.is_symlink() and \
+                    ctx.fs.readlink(dst) == str(ctx.fs.resolve(orig_src)):
+                results.append(ActionResult(ActionState.OK, orig_src, orig_dst))
+                continue
+
+            results.append(self.__apply_paths(command, ctx, orig_src, orig_dst))
+        return results
+
+    def apply(self, command, ctx=None):
+        ctx = ctx or ApplyContext()
+        return self.__apply_paths(command, ctx, pathlib.Path(self.src), pathlib.Path(self.dst))
+
+    @staticmethod
+    def __has_magic(path):
+        return any(c in path for c in '*?[')
+
+    @staticmethod
+    def __walk(tree, src, dst, pairs):
+        for name, is_dir in tree.listdir(src):
+            if is_dir:
+                LinkAction.__walk(tree, src / name, dst / name, pairs)
+            else:
+                pairs.append((src / name, dst / name))
+
+    @staticmethod
+    def __scan(fs, path):
+        try:
+            return {e.name: e for e in fs.scandir(path)}
+        except (FileNotFoundError, NotADirectoryError):
+            return {}
+
+    def __apply_paths(self, command, ctx, orig_src, orig_dst):
+        fs = ctx.fs
         state = None
-        orig_src = pathlib.Path(self.src)
-        src = orig_src.resolve()
-        orig_dst = pathlib.Path(self.dst)
+        src = fs.resolve(orig_src)
         dst = orig_dst.expanduser()
 
-        if not src.exists():
-            raise ValueError(f'The source file or directory to link "{self.src}" does not exist')
+        if not fs.exists(src):
+            raise ValueError(f'The source file or directory to link "{orig_src}" does not exist')
 
-        if dst.exists():
-            if dst.samefile(src):
+        if fs.exists(dst):
+            if fs.samefile(dst, src):
                 if command == ActionType.UNLINK:
-                    dst.unlink()
+                    ctx.record(dst)
+                    fs.unlink(dst)
                     state = ActionState.UNLINKED
                 else:
                     state = ActionState.OK
@@ -231,61 +2467,228 @@ class LinkAction(SrcDstAction):
                 state = ActionState.CONFLICT
         else:
             if command == ActionType.SYNC:
-                dst.symlink_to(src, src.is_dir())
+                ctx.record(dst)
+                fs.symlink(src, dst, fs.is_dir(src))
                 state = ActionState.LINKED
             elif command == ActionType.UNLINK:
                 state = ActionState.OK
             else:
                 state = ActionState.MISSING
-        return (state, orig_src, orig_dst)
+        return ActionResult(state, orig_src, orig_dst)
+
+
+class CopyAction(SrcDstAction):
+    """ "copy" file as-is, preserving its mode """
+
+    __slots__ = ()
+
+    def __init__(self, profile_name, json_action):
+        super().__init__('copy', profile_name, json_action)
+
+    def apply(self, command, ctx=None):
+        ctx = ctx or ApplyContext()
+        fs = ctx.fs
+        src = pathlib.Path(self.src)
+        orig_dst = pathlib.Path(self.dst)
+        dst = orig_dst.expanduser()
+
+        try:
+            src_stat = fs.stat(src)
+        except FileNotFoundError:
+            raise ValueError(f'The source file to copy "{self.src}" does not exist')
+
+        if fs.lexists(dst):
+            if fs.is_symlink(dst) or not fs.is_file(dst):
+                return ActionResult(ActionState.CONFLICT, src, orig_dst)
+
+            dst_stat = fs.stat(dst)
+            if CopyAction.__identical(fs, src, src_stat, dst, dst_stat):
+                if command == ActionType.UNLINK:
+                    ctx.record(dst)
+                    fs.unlink(dst)
+                    return ActionResult(ActionState.UNLINKED, src, orig_dst)
+                elif command == ActionType.SYNC and (src_stat.st_mode ^ dst_stat.st_mode) & 0o7777:
+                    ctx.record(dst)
+                    fs.chmod(dst, src_stat.st_mode & 0o7777)
+                    return ActionResult(ActionState.COPIED, src, orig_dst)
+                return ActionResult(ActionState.OK, src, orig_dst)
+            elif command != ActionType.SYNC:
+                return ActionResult(ActionState.DIFFERS, src, orig_dst)
+        elif command != ActionType.SYNC:
+            state = ActionState.OK if command == ActionType.UNLINK else ActionState.MISSING
+            return ActionResult(state, src, orig_dst)
+
+        ctx.record(dst)
+        tmp = dst.with_name('.' + dst.name + '.dotref-tmp')
+        try:
+            fs.copy(src, tmp)
+            fs.chmod(tmp, src_stat.st_mode & 0o7777)
+            fs.utime(tmp, (src_stat.st_atime_ns, src_stat.st_mtime_ns))
+            fs.replace(tmp, dst)
+        except BaseException:
+            if fs.lexists(tmp):
+                fs.unlink(tmp)
+            raise
+
+        return ActionResult(ActionState.COPIED, src, orig_dst)
+
+    @staticmethod
+    def __identical(fs, src, src_stat, dst, dst_stat):
+        if src_stat.st_size != dst_stat.st_size:
+            return False
+        if src_stat.st_mtime_ns == dst_stat.st_mtime_ns:
+            return True
+        return fs.same_content(src, dst)
 
 
 class TemplateAction(SrcDstAction):
-    """ "template" entry """
+    """ "template" entry, rendered on bytes with variables encoded using its encoding """
+
+    __slots__ = ('encoding',)
 
     def __init__(self, profile_name, json_action):
         super().__init__('template', profile_name, json_action)
+        self.encoding = json_action.get('encoding')
+
+        if self.encoding is not None:
+            if not isinstance(self.encoding, str):
+                raise TypeError('"template.encoding" field must be a string')
+            try:
+                codecs.lookup(self.encoding)
+            except LookupError:
+                raise TypeError(f'Unknown "template.encoding": {self.encoding}')
+            if '$'.encode(self.encoding, 'replace') != b'$':
+                raise TypeError(f'"template.encoding" must be ASCII compatible, {self.encoding} is not')
 
-    def apply(self, command, vars):
+    def key(self):
+        return super().key() + (self.encoding,)
+
+    def get_encoding(self):
+        return self.encoding or locale.getpreferredencoding(False)
+
+    def apply(self, command, vars, ctx=None, data=None):
+        ctx = ctx or ApplyContext()
+        fs = ctx.fs
         src = pathlib.Path(self.src)
         orig_dst = pathlib.Path(self.dst)
         dst = orig_dst.expanduser()
-        dst_exists = dst.exists()
+        dst_exists = fs.exists(dst)
 
         if dst_exists:
-            if not dst.is_file():
-                return (ActionState.CONFLICT, src, orig_dst)
+            if not fs.is_file(dst):
+                return ActionResult(ActionState.CONFLICT, src, orig_dst)
         elif command != ActionType.SYNC:
-            return (ActionState.OK if command == ActionType.UNLINK else ActionState.MISSING, src, orig_dst)
+            state = ActionState.OK if command == ActionType.UNLINK else ActionState.MISSING
+            return ActionResult(state, src, orig_dst)
 
-        with open(src, 'r') as src_file:
-            tpl = string.Template(src_file.read())
+        if data is None:
+            data = self.render(vars, fs)
+            ctx.renderer.rendered(len(data))
+        if ctx.metrics:
+            ctx.metrics.add_rendered(len(data))
 
-            try:
-                rendered = tpl.substitute(vars)
-            except KeyError as e:
-                raise TemplateVarError(str(e))
+        if ctx.store:
+            return self.__apply_stored(command, data, ctx, dst_exists, src, orig_dst)
+
+        if dst_exists:
+            if fs.equals(dst, data):
+                if command == ActionType.UNLINK:
+                    ctx.record(dst)
+                    fs.unlink(dst)
+                    return ActionResult(ActionState.UNLINKED, src, orig_dst)
+                else:
+                    return ActionResult(ActionState.OK, src, orig_dst)
+            elif command != ActionType.SYNC:
+                return ActionResult(ActionState.DIFFERS, src, orig_dst)
+
+        ctx.record(dst)
+        fs.write_bytes(dst, data)
+
+        return ActionResult(ActionState.RENDERED, src, orig_dst)
+
+    def render(self, vars, fs=None):
+        """ Render the template without decoding it, only variable values are encoded """
+        data = (fs or OsFileSystem()).read_bytes(self.src)
+
+        try:
+            return render_template(data, EncodedVariables(vars, self.get_encoding()))
+        except KeyError as e:
+            raise TemplateVarError(str(e))
+
+    def __apply_stored(self, command, data, ctx, dst_exists, src, orig_dst):
+        store = ctx.store
+        dst = orig_dst.expanduser()
+        digest = ObjectStore.digest(data)
+        # The content is compared rather than the inode, a hardlink edited in place changes the object too
+
+        if dst_exists:
+            if ctx.fs.equals(dst, data):
+                if command == ActionType.UNLINK:
+                    ctx.record(dst)
+                    ctx.fs.unlink(dst)
+                    return ActionResult(ActionState.UNLINKED, src, orig_dst)
+                return ActionResult(ActionState.OK, src, orig_dst)
+            elif command != ActionType.SYNC:
+                return ActionResult(ActionState.DIFFERS, src, orig_dst)
 
-            with open(dst, 'r+' if dst_exists else 'w') as dst_file:
-                if dst_exists:
-                    dst_content = dst_file.read()
-                    if rendered == dst_content:
-                        if command == ActionType.UNLINK:
-                            dst.unlink()
-                            return (ActionState.UNLINKED, src, orig_dst)
-                        else:
-                            return (ActionState.OK, src, orig_dst)
-                    elif command != ActionType.SYNC:
-                        return (ActionState.DIFFERS, src, orig_dst)
+        mode = ctx.fs.stat(dst).st_mode & 0o777 if dst_exists else 0o666 & ~UMASK
+        ctx.record(dst)
+        store.put(data, digest, ctx.fs)
+        store.link(digest, dst, ctx.fs, mode)
+        return ActionResult(ActionState.RENDERED, src, orig_dst)
 
-                    dst_file.seek(0)
 
-                dst_file.write(rendered)
+class Hook(ProfileEntry):
+    """ "hooks" entry: a shell command run before sync, or after it when watched entries have changed """
 
-                if dst_exists:
-                    dst_file.truncate()
+    __slots__ = ('name', 'command', 'when', 'watch', 'timeout', 'after')
 
-                return (ActionState.RENDERED, src, orig_dst)
+    TIMEOUT = 60
+
+    def __init__(self, profile_name, json_hook):
+        super().__init__(profile_name)
+
+        if not isinstance(json_hook, dict):
+            raise TypeError('"hooks" element must be an object')
+
+        for field in ('name', 'command'):
+            if field not in json_hook or not isinstance(json_hook[field], str):
+                raise TypeError(f'"hooks" must have "{field}" field of type string')
+
+        self.name = json_hook['name']
+        self.command = json_hook['command']
+        self.when = json_hook.get('when', 'post')
+        self.watch = json_hook.get('watch', [])
+        self.timeout = json_hook.get('timeout', Hook.TIMEOUT)
+        self.after = json_hook.get('after', [])
+
+        if self.when not in ('pre', 'post'):
+            raise TypeError('"hooks.when" field must be either "pre" or "post"')
+
+        for field in ('watch', 'after'):
+            value = getattr(self, field)
+            if not isinstance(value, list) or not all(isinstance(v, str) for v in value):
+                raise TypeError(f'"hooks.{field}" field must be a list of strings')
+
+        if isinstance(self.timeout, bool) or not isinstance(self.timeout, (int, float)) or self.timeout <= 0:
+            raise TypeError('"hooks.timeout" field must be a positive number of seconds')
+
+    def watches(self, path):
+        """ Whether an absolute path, one of its parents or children matches a watched pattern """
+        if not self.watch:
+            return True
+        for pattern in (os.path.abspath(os.path.expanduser(w)) for w in self.watch):
+            if pattern.startswith(path + os.sep):
+                return True
+            current = path
+            while True:
+                if fnmatch.fnmatchcase(current, pattern):
+                    return True
+                parent = os.path.dirname(current)
+                if parent == current:
+                    break
+                current = parent
+        return False
 
 
 class Profile:
@@ -293,7 +2696,9 @@ class Profile:
 
     def __init__(self, filename):
         self.name = filename.with_suffix('').name
+        self.filename = filename
         self.parents = []
+        self._ancestors = None
 
         try:
             with open(filename, 'r') as f:
@@ -303,57 +2708,227 @@ class Profile:
                 self.vars = self.__parse_vars(json_profile)
                 self.create = self.__parse_create(json_profile)
                 self.link = self.__parse_link(json_profile)
+                self.copy = self.__parse_copy(json_profile)
                 self.template = self.__parse_template(json_profile)
+                self.hooks = self.__parse_hooks(json_profile)
         except Exception as e:
             raise ProfileError(f'Failed to load profile "{self.name}": {str(e)}') from e
 
     def merged(self):
-        result = copy.deepcopy(self)
-
-        for parent in self.parents:
-            pm = parent.merged()
-            result.vars.extend([v for v in pm.vars if not any(rv.name == v.name for rv in result.vars)])
-            result.create.extend([c for c in pm.create
-                if not any(rc.name == c.name for rc in result.create)])
-            result.link.extend([link for link in pm.link if link not in result.link])
-            result.template.extend([t for t in pm.template if t not in result.template])
+        """ Merged view of this profile and its ancestors; entries are shared, not copied """
+        result = copy.copy(self)
+        result.vars = list(self.vars)
+        result.create = list(self.create)
+        result.link = list(self.link)
+        result.copy = list(self.copy)
+        result.template = list(self.template)
+        result.hooks = list(self.hooks)
+
+        var_names = {v.name for v in result.vars}
+        create_names = {c.name for c in result.create}
+        links = set(result.link)
+        copies = set(result.copy)
+        templates = set(result.template)
+        hook_names = {h.name for h in result.hooks}
+
+        for ancestor in self.ancestors()[1:]:
+            Profile.__merge_entries(result.vars, var_names, ancestor.vars, lambda v: v.name)
+            Profile.__merge_entries(result.create, create_names, ancestor.create, lambda c: c.name)
+            Profile.__merge_entries(result.link, links, ancestor.link, lambda link: link)
+            Profile.__merge_entries(result.copy, copies, ancestor.copy, lambda c: c)
+            Profile.__merge_entries(result.template, templates, ancestor.template, lambda t: t)
+            Profile.__merge_entries(result.hooks, hook_names, ancestor.hooks, lambda h: h.name)
 
         return result
 
+    def rebase(self, root):
+        """ Resolve relative sources against a directory other than the current one """
+        for entry in self.link + self.copy + self.template:
+            if not os.path.isabs(entry.src) and not entry.src.startswith('~'):
+                entry.src = os.path.join(root, entry.src)
+
+    def ancestors(self):
+        """ This profile followed by its ancestors in depth-first order, each one listed once """
+        if self._ancestors is None:
+            Profile.resolve([self])
+        return self._ancestors
+
+    @staticmethod
+    def resolve(profiles):
+        """ Compute and memoize ancestor lists without recursion, fails on inheritance cycles """
+        for root in profiles:
+            stack = [(root, iter(root.parents))]
+            on_stack = {root}
+            while stack:
+                profile, parents = stack[-1]
+                parent = next((p for p in parents if p._ancestors is None), None)
+                if parent is None:
+                    stack.pop()
+                    on_stack.discard(profile)
+                    if profile._ancestors is None:
+                        profile._ancestors = Profile.__linearize(profile)
+                elif parent in on_stack:
+                    names = [p.name for p, _ in stack]
+                    cycle = names[names.index(parent.name):] + [parent.name]
+                    raise ProfileError(f'Profile "{parent.name}" inherits from itself: {" -> ".join(cycle)}')
+                else:
+                    stack.append((parent, iter(parent.parents)))
+                    on_stack.add(parent)
+
+    @staticmethod
+    def __linearize(profile):
+        """ Combine the already resolved ancestor lists of the parents, keeping the first occurrence """
+        result = [profile]
+        seen = {profile}
+        for parent in profile.parents:
+            for ancestor in parent._ancestors:
+                if ancestor not in seen:
+                    seen.add(ancestor)
+                    result.append(ancestor)
+        return tuple(result)
+
+    @staticmethod
+    def __merge_entries(entries, seen, parent_entries, key):
+        for entry in parent_entries:
+            k = key(entry)
+            if k not in seen:
+                seen.add(k)
+                entries.append(entry)
+
+    def switch(self, old, log, cache=None, ctx=None):
+        """ Switch from another profile touching only entries that differ between the merged profiles """
+        log.out(f'Profile: {log.muted(old.name) + " -> " if old else ""}{log.hl(self.name)}', True)
+        ctx = ctx or ApplyContext()
+        with ctx.phase('merge'):
+            merged = self.merged()
+            old_merged = old.merged() if old else None
+
+        old_entries = {e.key(): e for e in Profile.__actions(old_merged)} if old_merged else {}
+        new_keys = {e.key() for e in Profile.__actions(merged)}
+
+        same_vars = (old_merged is not None and
+            Profile.__var_definitions(old_merged) == Profile.__var_definitions(merged))
+        keep = {k for k in new_keys if k in old_entries and (k[0] != TemplateAction.__name__ or same_vars)}
+
+        pipeline = ResultPipeline([ConsoleSink(log)] + ctx.sinks + [ctx.hooks])
+        pipeline.begin(self.name, ActionType.SYNC)
+        try:
+            Profile.__run_hooks(pipeline, ctx, merged, 'pre', log)
+            with ctx.phase('apply'):
+                if old_merged:
+                    pipeline.section('removed', 'Removed')
+                    try:
+                        ctx.engine.run(lambda a: a.results(ActionType.UNLINK, ctx),
+                            [e for e in old_merged.link if e.key() not in new_keys], pipeline.emit)
+                        ctx.engine.run(lambda a: a.apply(ActionType.UNLINK, ctx),
+                            [e for e in old_merged.copy if e.key() not in new_keys], pipeline.emit)
+                        old_vars = Variables(old_merged.vars, cache)
+                        ctx.engine.run(lambda a: a.apply(ActionType.UNLINK, old_vars, ctx),
+                            [e for e in old_merged.template if e.key() not in new_keys], pipeline.emit)
+                    finally:
+                        pipeline.end_section()
+
+                vars = Variables(merged.vars, cache)
+                Profile.__run_phases(pipeline, ctx, ActionType.SYNC, vars,
+                    [c for c in merged.create if c.key() not in keep],
+                    [link for link in merged.link if link.key() not in keep],
+                    [c for c in merged.copy if c.key() not in keep],
+                    [t for t in merged.template if t.key() not in keep])
+            Profile.__run_hooks(pipeline, ctx, merged, 'post', log)
+        finally:
+            pipeline.close()
+
+        log.out(f'\n{log.hl("switch")} completed successfully, {len(keep)} shared entries left untouched ' +
+            ('but conflicts were detected' if pipeline.has_conflicts else
+             'and no conflicts were detected'), True)
+        return pipeline
+
+    @staticmethod
+    def __run_phases(pipeline, ctx, command, vars, create, link, copy, template):
+        """ Stream results of create, link, copy and template phases (in this order) into the pipeline """
+        phases = (
+            ('create', 'Create', create, lambda a: a.apply(command, ctx)),
+            ('link', 'Link', link, lambda a: a.results(command, ctx)),
+            ('copy', 'Copy', copy, lambda a: a.apply(command, ctx)),
+            ('template', 'Template', template, lambda a: a.apply(command, vars, ctx, ctx.renderer.result(a))),
+        )
+        for kind, header, actions, fn in phases:
+            if actions:
+                pipeline.section(kind, header)
+                try:
+                    if kind == 'create':
+                        # Nested directories depend on each other and there are only a few of them
+                        SerialEngine().run(fn, CreateAction.parents_first(actions), pipeline.emit)
+                        continue
+                    if kind == 'template':
+                        ctx.renderer.start(actions, command, vars, ctx.fs)
+                    ctx.engine.run(fn, actions, pipeline.emit)
+                finally:
+                    if kind == 'template':
+                        ctx.renderer.close()
+                    pipeline.end_section()
+
+    @staticmethod
+    def __run_hooks(pipeline, ctx, merged, when, log):
+        with ctx.phase('hooks'):
+            results = ctx.hooks.run(when, merged, ctx, log)
+        if results:
+            pipeline.section('hooks', 'Pre hooks' if when == 'pre' else 'Hooks')
+            try:
+                pipeline.emit(results)
+            finally:
+                pipeline.end_section()
+
+    @staticmethod
+    def __actions(merged):
+        return merged.create + merged.link + merged.copy + merged.template
+
+    @staticmethod
+    def __var_definitions(merged):
+        return {v.name: v.definition() for v in merged.vars}
+
     def pretty_print(self, log):
         log.print_tree(self, lambda p: log.hl(p.name) if p.name == self.name else log.muted(p.name),
                 lambda p: p.parents)
 
         merged = self.merged()
-        merged.__pretty_print_entries(log, merged.vars, 'Variables', lambda v: v.name, lambda v: v.value)
+        merged.__pretty_print_entries(log, merged.vars, 'Variables', lambda v: v.name, lambda v: v.describe())
         merged.__pretty_print_entries(log, merged.create, 'Create', lambda c: c.name,
                 lambda c: oct(c.mode) if c.mode else 'default mode')
         merged.__pretty_print_entries(log, merged.link, 'Link', lambda l: l.src, lambda l: l.dst)
+        merged.__pretty_print_entries(log, merged.copy, 'Copy', lambda c: c.src, lambda c: c.dst)
         merged.__pretty_print_entries(log, merged.template, 'Template', lambda t: t.src, lambda t: t.dst)
+        merged.__pretty_print_entries(log, merged.hooks, 'Hooks', lambda h: h.name, lambda h: h.command)
 
-    def action(self, command, log):
+    def action(self, command, log, cache=None, ctx=None, unchanged=None):
+        """ Apply the command to all entries, except for the ones with keys in unchanged """
         log.out(f'Profile: {log.hl(self.name)}', True)
-        has_conflicts = False
-        merged = self.merged()
-
-        if merged.create and command != ActionType.UNLINK:
-            results = [a.apply(command) for a in merged.create]
-            has_conflicts = any(r[0] == ActionState.CONFLICT for r in results)
-            Profile.__print_action_results(log, 'Create', results)
-
-        if merged.link:
-            results = [a.apply(command) for a in merged.link]
-            has_conflicts = has_conflicts or any(r[0] == ActionState.CONFLICT for r in results)
-            Profile.__print_action_results(log, 'Link', results)
+        ctx = ctx or ApplyContext()
+        with ctx.phase('merge'):
+            merged = self.merged()
 
-        if merged.template:
-            vars = {v.name: v.value for v in merged.vars}
-            results = [a.apply(command, vars) for a in merged.template]
-            has_conflicts = has_conflicts or any(r[0] == ActionState.CONFLICT for r in results)
-            Profile.__print_action_results(log, 'Template', results)
+        skip = unchanged or set()
+        pipeline = ResultPipeline([ConsoleSink(log)] + ctx.sinks + [ctx.hooks])
+        pipeline.begin(self.name, command)
+        try:
+            if command == ActionType.SYNC:
+                Profile.__run_hooks(pipeline, ctx, merged, 'pre', log)
+            with ctx.phase('apply'):
+                Profile.__run_phases(pipeline, ctx, command, Variables(merged.vars, cache),
+                    merged.create if command != ActionType.UNLINK else [],
+                    [e for e in merged.link if e.key() not in skip],
+                    [e for e in merged.copy if e.key() not in skip],
+                    [e for e in merged.template if e.key() not in skip])
+            if command == ActionType.SYNC:
+                Profile.__run_hooks(pipeline, ctx, merged, 'post', log)
+        finally:
+            pipeline.close()
 
-        log.out(f'\n{log.hl(command.name.lower())} completed successfully ' +
-            ('but conflicts were detected' if has_conflicts else 'and no conflicts were detected'), True)
+        skipped = f', {len(skip)} unchanged entries skipped' if unchanged is not None else ''
+        log.out(f'\n{log.hl(command.name.lower())} completed successfully{skipped} ' +
+            ('but conflicts were detected' if pipeline.has_conflicts else
+             'and no conflicts were detected'), True)
+        return pipeline
 
     def __pretty_print_entries(self, log, entries, header, get_name, get_val):
         if entries:
@@ -364,20 +2939,23 @@ class Profile:
                 log.out(log.muted(f' ({e.profile})') if e.profile != self.name else '', True)
 
     @staticmethod
-    def __print_action_results(log, header, results):
+    def print_action_results(log, header, results):
         log.out(log.title(f'\n{header}:'), True)
-        left_width = max([len(str(r[1])) for r in results]) + 1
+        left_width = max([len(r.left_str) for r in results]) + 1
 
-        for state, left, right in results:
-            log.out('    ' + state.str(log) + ' ' + Profile.__print_path(log, left, left_width))
+        for r in results:
+            left, right = r.parts()
+            log.out('    ' + r.state.str(log) + ' ' + Profile.__print_path(log, left, left_width))
             if right:
                 log.out(' ->  ' + Profile.__print_path(log, right, None))
             log.out('', True)
 
     @staticmethod
-    def __print_path(log, path, width):
-        plain_len = len(str(path.parent) + os.sep + path.name)
-        highlighted = str(path.parent) + os.sep + log.hl(path.name)
+    def __print_path(log, parts, width):
+        parent, name = parts
+        parent = parent + os.sep if parent else ''
+        plain_len = len(parent) + len(name)
+        highlighted = parent + log.hl(name)
         return highlighted + (' ' * (width + 2 - plain_len) if width else '')
 
     @staticmethod
@@ -401,8 +2979,8 @@ class Profile:
                 raise TypeError('"vars" field must be an object')
 
             for name, value in variables.items():
-                if not isinstance(name, str) or not isinstance(value, str):
-                    raise TypeError('Variable name and value must be strings')
+                if not isinstance(name, str) or not isinstance(value, (str, dict)):
+                    raise TypeError('Variable name must be a string and value must be a string or an object')
                 result.append(Variable(self.name, name, value))
         return result
 
@@ -422,6 +3000,14 @@ class Profile:
             return [LinkAction(self.name, link) for link in links]
         return []
 
+    def __parse_copy(self, json_profile):
+        copies = json_profile.get('copy')
+        if copies:
+            if not isinstance(copies, list):
+                raise TypeError('"copy" must be a list of objects')
+            return [CopyAction(self.name, c) for c in copies]
+        return []
+
     def __parse_template(self, json_profile):
         templates = json_profile.get('template')
         if templates:
@@ -430,20 +3016,220 @@ class Profile:
             return [TemplateAction(self.name, template) for template in templates]
         return []
 
+    def __parse_hooks(self, json_profile):
+        hooks = json_profile.get('hooks')
+        if hooks:
+            if not isinstance(hooks, list):
+                raise TypeError('"hooks" must be a list of objects')
+            return [Hook(self.name, hook) for hook in hooks]
+        return []
+
+
+class RemotePush:
+    """ Applies a merged profile on remote hosts by shipping a pre-rendered bundle over SSH """
+
+    APPLIER = r'''
+import io, os, sys, json, shutil, tarfile
+root = os.path.expanduser(sys.argv[1])
+tar = tarfile.open(fileobj=io.BytesIO(sys.stdin.buffer.read()), mode='r:gz')
+plan = json.loads(tar.extractfile('plan.json').read().decode())
+results = []
+
+def remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.unlink(path)
+
+for c in plan['create']:
+    path = os.path.expanduser(c['name'])
+    if os.path.exists(path):
+        state = 'OK' if os.path.isdir(path) else 'CONFLICT'
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        os.mkdir(path, c['mode'] if c['mode'] is not None else 0o777)
+        state = 'CREATED'
+    results.append(['create', state, c['name'], None])
+
+staging = os.path.join(root, '.staging')
+remove(staging)
+os.makedirs(staging)
+members = [m for m in tar.getmembers() if m.name.startswith('links/')]
+if hasattr(tarfile, 'data_filter'):
+    tar.extractall(staging, members, filter='data')
+else:
+    tar.extractall(staging, members)
+
+for l in plan['link']:
+    target = os.path.join(root, l['key'])
+    remove(target)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.rename(os.path.join(staging, l['key']), target)
+    dst = os.path.expanduser(l['dst'])
+    if os.path.exists(dst):
+        state = 'OK' if os.path.samefile(dst, target) else 'CONFLICT'
+    elif os.path.lexists(dst):
+        state = 'CONFLICT'
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(dst)), exist_ok=True)
+        os.symlink(target, dst, os.path.isdir(target))
+        state = 'LINKED'
+    results.append(['link', state, l['src'], l['dst']])
+remove(staging)
+
+for t in plan['copy'] + plan['template']:
+    data = tar.extractfile(t['key']).read()
+    dst = os.path.expanduser(t['dst'])
+    if os.path.lexists(dst) and not os.path.isfile(dst):
+        state = 'CONFLICT'
+    else:
+        state = 'RENDERED'
+        if os.path.exists(dst):
+            with open(dst, 'rb') as f:
+                if f.read() == data:
+                    state = 'OK'
+        if state == 'RENDERED':
+            with open(dst, 'wb') as f:
+                f.write(data)
+        if 'mode' in t and state != 'CONFLICT' and os.stat(dst).st_mode & 0o7777 != t['mode']:
+            os.chmod(dst, t['mode'])
+            state = 'RENDERED'
+    if 'mode' in t:
+        results.append(['copy', 'COPIED' if state == 'RENDERED' else state, t['src'], t['dst']])
+    else:
+        results.append(['template', state, t['src'], t['dst']])
+
+sys.stdout.write(json.dumps(results))
+'''
+
+    SECTIONS = (('create', 'Create'), ('link', 'Link'), ('copy', 'Copy'), ('template', 'Template'))
+
+    def __init__(self, ssh, remote_dir, remote_python='python3'):
+        import shlex
+        self.ssh = shlex.split(ssh)
+        self.remote_dir = remote_dir
+        self.remote_python = remote_python
+
+    @staticmethod
+    def bundle(merged, vars):
+        """ Render all templates once and pack them with link sources and the plan into a tar.gz """
+        import hashlib
+        import tarfile
+        plan = {'create': [], 'link': [], 'copy': [], 'template': []}
+        buf = io.BytesIO()
+
+        with tarfile.open(fileobj=buf, mode='w:gz') as tar:
+            for c in merged.create:
+                plan['create'].append({'name': c.name, 'mode': c.mode})
+
+            tree = TreeCache()
+            for link in merged.link:
+                pairs = link.expand(tree) if link.recursive or link.is_pattern() else [(link.src, link.dst)]
+                for orig_src, dst in pairs:
+                    src = pathlib.Path(orig_src).resolve()
+                    if not src.exists():
+                        raise ValueError(f'The source file or directory to link "{orig_src}" does not exist')
+                    key = 'links/' + hashlib.sha256(str(src).encode()).hexdigest()[:16] + '-' + src.name
+                    tar.add(str(src), arcname=key)
+                    plan['link'].append({'src': str(orig_src), 'dst': str(dst), 'key': key})
+
+            for i, c in enumerate(merged.copy):
+                key = f'copies/{i}'
+                src = pathlib.Path(c.src)
+                if not src.is_file():
+                    raise ValueError(f'The source file to copy "{c.src}" does not exist')
+                tar.add(str(src), arcname=key)
+                plan['copy'].append({'src': c.src, 'dst': c.dst, 'key': key,
+                    'mode': src.stat().st_mode & 0o7777})
+
+            for i, t in enumerate(merged.template):
+                key = f'templates/{i}'
+                RemotePush.__add_bytes(tar, key, t.render(vars))
+                plan['template'].append({'src': t.src, 'dst': t.dst, 'key': key})
+
+            RemotePush.__add_bytes(tar, 'plan.json', json.dumps(plan).encode())
+
+        return buf.getvalue()
+
+    def push(self, host, bundle):
+        """ Ship the bundle to a single host over one SSH connection, returns list of (kind, result) """
+        import shlex
+        import subprocess
+        remote_command = ' '.join(shlex.quote(a) for a in
+                [self.remote_python, '-c', RemotePush.APPLIER, self.remote_dir])
+        proc = subprocess.run(self.ssh + [host, remote_command], input=bundle,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        if proc.returncode != 0:
+            raise ValueError(f'Push to "{host}" failed: ' +
+                (proc.stderr.decode(errors='replace').strip() or f'exit code {proc.returncode}'))
+
+        return [(kind, ActionResult(ActionState[state], pathlib.Path(left),
+                    pathlib.Path(right) if right else None))
+                for kind, state, left, right in json.loads(proc.stdout.decode())]
+
+    @staticmethod
+    def __add_bytes(tar, name, data):
+        import tarfile
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(data))
+
 
 class Dotref:
     """ Main Dotref application """
 
     def __init__(self, log, args):
         self.log = log
-        self.dotdir = pathlib.Path(args.dotdir)
+        self.dotdirs = [pathlib.Path(d) for d in args.dotdir or ['dotref']]
+        self.dotdir = self.dotdirs[0]
         self.profile = args.profile
-
-        self.statefile = StateFile(self.dotdir / args.statefile)
-        self.profs = self.__load_profiles()
+        self.store = args.store
+        self.jobs = args.jobs
+        self.hosts = args.hosts
+        self.fail_fast = args.fail_fast
+        self.jsonl = args.jsonl
+        self.metrics_file = args.metrics_file
+        self.ssh = args.ssh
+        self.remote_dir = args.remote_dir
+        self.quiet = args.quiet
+        self.check_exit_code = args.exit_code or args.quiet
+        self.exit_code = 0
+        self.in_sync = False
+        self.failed = False
+
+        self.metrics = Metrics() if self.metrics_file else None
+        with self.__phase('load'):
+            self.statefile = StateFile(self.dotdir / args.statefile)
+        self.fingerprint = Fingerprint(self.statefile.dir / 'fingerprint.json')
+        self.git = args.git
+        self.gc_delete = args.delete
+        self.gc_roots = args.root or ['~']
+        self.gc_depth = args.depth
+        self.gc_excludes = args.exclude or []
+        self.git_state = GitState(self.statefile.dir / 'git.json', self.dotdir)
+        self.schedule = Schedule(self.statefile.dir, args.splay) if args.schedule else None
+        self.__profs = None
+
+    @property
+    def profs(self):
+        """ Profiles are loaded on first use, the quick status check doesn't need them """
+        if self.__profs is None:
+            with self.__phase('load'):
+                self.__profs = ProfileSet(self.dotdirs, self.statefile.filename)
+        return self.__profs
+
+    EXCLUSIVE = ('init', 'sync', 'unlink', 'rollback', 'switch', 'gc')
 
     def do(self, command):
-        getattr(self, command)()
+        if self.schedule and command == 'sync':
+            # Wait before taking the lock, so manual commands aren't blocked meanwhile
+            time.sleep(self.schedule.delay())
+        with self.statefile.lock(command in Dotref.EXCLUSIVE):
+            with self.__phase('load'):
+                self.statefile.load()
+            getattr(self, command)()
 
     def init(self):
         if not self.profile:
@@ -453,43 +3239,209 @@ class Dotref:
             raise ValueError(f'Profile "{self.profile}" not found')
 
         self.statefile.profile = self.profile
+        self.statefile.store = self.store
         self.statefile.save()
+        self.fingerprint.clear()
+        self.git_state.clear()
         self.log.out(f'Successfully initialized to use profile {self.log.hl(self.profile)}', True)
 
     def sync(self):
-        self.__execute_command(ActionType.SYNC)
+        if self.schedule:
+            self.__scheduled_sync()
+        else:
+            self.__execute_command(ActionType.SYNC)
 
     def unlink(self):
         self.__execute_command(ActionType.UNLINK)
 
     def status(self):
+        if self.quiet:
+            name = self.statefile.profile
+            with self.__phase('fingerprint'):
+                if not name or not self.fingerprint.matches(self.__layered(name)):
+                    self.exit_code = 1
+            if self.metrics:
+                self.metrics.begin(name, ActionType.STATUS)
+                self.metrics.in_sync = not self.exit_code
+                self.metrics.write(self.metrics_file)
+            return
         self.__execute_command(ActionType.STATUS)
 
+    def rollback(self):
+        self.fingerprint.clear()
+        self.git_state.clear()
+        journal = Journal(self.statefile.dir)
+        results = journal.rollback()
+        if results:
+            Profile.print_action_results(self.log, 'Rollback', results)
+        if journal.switched:
+            self.statefile.profile = journal.profile
+            self.statefile.save()
+            profile = self.log.hl(self.statefile.profile or 'none')
+            self.log.out(f'\nCurrent profile restored to {profile}', True)
+        self.log.out(f'\n{self.log.hl("rollback")} completed successfully', True)
+
+    def push(self):
+        import concurrent.futures
+        if not self.hosts:
+            raise ValueError('Please provide at least one host to push to')
+
+        name = self.profile or self.statefile.profile
+        if not name:
+            raise ValueError('Please provide a profile name using "--profile" argument '
+                'or run "dotref init" first')
+        if name not in self.profs:
+            raise ValueError(f'Profile "{name}" not found')
+
+        merged = self.profs[name].merged()
+        cache = VarCache(self.statefile.dir / 'vars.json')
+        bundle = RemotePush.bundle(merged, Variables(merged.vars, cache))
+        cache.save()
+
+        pusher = RemotePush(self.ssh, self.remote_dir)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(self.hosts), 32)) as executor:
+            futures = [executor.submit(pusher.push, host, bundle) for host in self.hosts]
+
+        failed = 0
+        for i, (host, future) in enumerate(zip(self.hosts, futures)):
+            self.log.out(('\n' if i else '') + f'Host: {self.log.hl(host)}', True)
+            try:
+                results = future.result()
+            except Exception as e:
+                self.log.err(str(e))
+                failed += 1
+                continue
+
+            for kind, header in RemotePush.SECTIONS:
+                kind_results = [r for k, r in results if k == kind]
+                if kind_results:
+                    Profile.print_action_results(self.log, header, kind_results)
+
+            has_conflicts = any(r.state == ActionState.CONFLICT for _, r in results)
+            self.log.out(f'\n{self.log.hl("push")} completed successfully ' +
+                ('but conflicts were detected' if has_conflicts else 'and no conflicts were detected'), True)
+
+        if failed:
+            raise ValueError(f'Push failed on {failed} of {len(self.hosts)} hosts')
+
+    def switch(self):
+        if not self.profile:
+            raise ValueError('Please provide a profile name using "--profile" argument')
+
+        if self.profile not in self.profs:
+            raise ValueError(f'Profile "{self.profile}" not found')
+
+        old = self.profs.get(self.statefile.profile) if self.statefile.profile else None
+        new = self.profs[self.profile]
+
+        def switch(cache, ctx):
+            if ctx.journal:
+                ctx.journal.record_profile(self.statefile.profile)
+            return new.switch(old, self.log, cache, ctx)
+
+        self.__run_command(ActionType.SYNC, new, switch)
+
+        self.statefile.profile = self.profile
+        self.statefile.save()
+
+    def gc(self):
+        if not self.statefile.profile:
+            raise ValueError('Please run "dotref init" first to select a profile')
+        if self.statefile.profile not in self.profs:
+            raise ValueError(f'Profile "{self.statefile.profile}" not found')
+
+        merged = self.profs[self.statefile.profile].merged()
+        tree = TreeCache(self.statefile.dir / 'tree.json')
+        managed = set()
+        for link in merged.link:
+            pairs = link.expand(tree) if link.recursive or link.is_pattern() else [(link.src, link.dst)]
+            managed.update(os.path.abspath(os.path.expanduser(dst)) for _, dst in pairs)
+
+        repos = self.__repo_roots(merged)
+        roots = [os.path.expanduser(r) for r in self.gc_roots]
+        for repo in repos:
+            for root in roots:
+                root = os.path.realpath(root)
+                if root == repo or root.startswith(repo + os.sep) or repo == os.sep:
+                    raise ValueError(f'The dotfiles repository {repo} contains the scanned directory {root}, '
+                        'refusing to look for orphaned links')
+        scanner = SymlinkScanner(self.gc_depth, self.gc_excludes, max(self.jobs, 8))
+        orphans = [(link, target) for link, target in scanner.scan(roots, repos)
+            if any(target.startswith(repo + os.sep) for repo in repos) and link not in managed]
+
+        results = []
+        journal = self.__journal('gc') if self.gc_delete and orphans else None
+        try:
+            for link, target in orphans:
+                state = ActionState.ORPHANED
+                if self.gc_delete:
+                    if journal:
+                        journal.record(pathlib.Path(link))
+                    os.unlink(link)
+                    state = ActionState.UNLINKED
+                results.append(ActionResult(state, pathlib.Path(target), pathlib.Path(link)))
+        finally:
+            if journal:
+                journal.commit()
+        tree.save()
+
+        if results:
+            Profile.print_action_results(self.log, 'Orphaned links', results)
+        hint = ', use --delete to remove them' if orphans and not self.gc_delete else ''
+        self.log.out(f'\n{self.log.hl("gc")} completed successfully, {len(orphans)} orphaned links '
+            f'{"removed" if self.gc_delete else "found"}{hint}', True)
+
     def profiles(self):
         if self.profile:
             self.__show_single_profile()
         else:
             self.__show_all_profiles()
 
-    def __load_profiles(self):
-        filenames = [f for f in self.dotdir.glob('*.json') if f.is_file() and
-                self.statefile.filename.name != f.name and not f.name.startswith('.')]
+    def __journal(self, command):
+        """ Journal of a run, None with a warning when the state directory is read-only or unwritable """
+        journal = Journal(self.statefile.dir)
+        if journal.writable():
+            return journal
+        self.log.err(f'Warning: can\'t write the journal to "{journal.dir}", '
+            f'this {command} can\'t be rolled back')
+        return None
+
+    def __repo_roots(self, merged):
+        """ Git working trees of the dotdirs, or for dotdirs outside of git the deepest directory containing
+            them and the link sources, never just the parent of a dotdir that may be the checkout itself """
+        import subprocess
+        repos, others = set(), []
+        for d in self.dotdirs:
+            try:
+                repos.add(GitState(None, d).toplevel())
+            except (OSError, subprocess.CalledProcessError):
+                others.append(os.path.realpath(d))
+        if others:
+            sources = [os.path.realpath(pathlib.Path(link.src).parent if link.is_pattern() else link.src)
+                for link in merged.link]
+            sources = [s for s in sources if not any(s.startswith(repo + os.sep) for repo in repos)]
+            repos.add(os.path.commonpath(others + sources))
+        return sorted(repos)
 
-        profiles = {p.name: p for p in map(Profile, filenames)}
+    @staticmethod
+    def __env(merged):
+        return {v.env: os.environ.get(v.env) for v in merged.vars if v.env}
 
-        for name, profile in profiles.items():
-            parents = []
-            for parent in profile.extends:
-                if parent not in profiles:
-                    raise ProfileError(f'Profile "{name}" extends "{parent}" but it does not exist')
-                parents.append(profiles[parent])
-            profile.parents = parents
+    def __layered(self, name):
+        """ Fingerprint key, the same profile name can resolve differently with another set of layers """
+        return os.pathsep.join([name] + [os.path.abspath(d) for d in self.dotdirs[1:]])
 
-        return profiles
+    def __layer_items(self):
+        """ A profile added to a higher precedence layer may hide the one the fingerprint was taken with """
+        return [('dir', os.path.abspath(d)) for d in self.dotdirs] if len(self.dotdirs) > 1 else []
+
+    def __phase(self, name):
+        return self.metrics.phase(name) if self.metrics else contextlib.suppress()
 
     def __show_all_profiles(self):
         if not self.profs:
-            self.log.out(f'No profile files found in {self.log.hl(self.dotdir)} directory', True)
+            self.log.out(f'No profile files found in {", ".join(self.log.hl(d) for d in self.dotdirs)} '
+                f'{"directories" if len(self.dotdirs) > 1 else "directory"}', True)
         else:
             names = sorted([n for n in self.profs.keys()
                 if not self.statefile.profile or self.statefile.profile != n])
@@ -517,6 +3469,26 @@ class Dotref:
             raise ValueError(f'Profile "{self.profile}" not found')
         p.pretty_print(self.log)
 
+    def __scheduled_sync(self):
+        if not self.schedule.due():
+            self.log.out(f'Skipping scheduled {self.log.hl("sync")}, '
+                'backing off after failed or slow runs', True)
+            return
+
+        name = self.statefile.profile
+        if name and self.fingerprint.matches(self.__layered(name)):
+            self.log.out(f'Skipping scheduled {self.log.hl("sync")}, '
+                'nothing changed since the last one', True)
+            return
+
+        # Conflicts need a human and come back on every run, only errors and failed hooks are worth a backoff
+        start, ok = time.monotonic(), False
+        try:
+            self.__execute_command(ActionType.SYNC)
+            ok = not self.failed
+        finally:
+            self.schedule.record(time.monotonic() - start, ok)
+
     def __execute_command(self, command):
         if not self.statefile.profile:
             raise ValueError('Please run "dotref init" first to select a profile')
@@ -524,26 +3496,158 @@ class Dotref:
         if self.statefile.profile not in self.profs:
             raise ValueError(f'Profile "{self.statefile.profile}" not found')
 
-        self.profs[self.statefile.profile].action(command, self.log)
+        profile = self.profs[self.statefile.profile]
+        unchanged = None
+        if self.git and command != ActionType.UNLINK:
+            merged = profile.merged()
+            changes = self.git_state.changes(profile.name, Dotref.__env(merged))
+            if changes is not None:
+                unchanged = GitState.unchanged(merged, changes)
+
+        self.__run_command(command, profile, lambda cache, ctx:
+            profile.action(command, self.log, cache, ctx, unchanged), unchanged is not None)
+
+    def __run_command(self, command, profile, fn, partial=False):
+        cache = VarCache(self.statefile.dir / 'vars.json')
+        store = ObjectStore(self.statefile.dir / 'objects') if self.statefile.store else None
+        journal = self.__journal(command.name.lower()) if command != ActionType.STATUS else None
+        tree = TreeCache(self.statefile.dir / 'tree.json')
+        sinks = [JsonlSink(self.jsonl)] if self.jsonl else []
+        sinks += [FailFastSink()] if self.fail_fast else []
+        sinks += [self.metrics] if self.metrics else []
+        # A partial run doesn't check every destination, it can't take a new fingerprint but keeps a valid one
+        if not partial or not self.fingerprint.matches(self.__layered(profile.name)):
+            self.fingerprint.clear()
+        if command != ActionType.STATUS:
+            self.git_state.clear()
+        fs = None
+        if self.metrics:
+            # Counting only, without latency
+            fs = LatencyFileSystem(OsFileSystem())
+            self.metrics.operations = fs.counts
+        try:
+            engine = AsyncEngine(self.jobs) if self.jobs > 1 else SerialEngine()
+            hooks = HookRunner(self.statefile.dir / 'hooks.json')
+            pipeline = fn(cache, ApplyContext(store, journal, engine, tree, sinks, self.metrics, fs,
+                TemplateRenderer(self.jobs), hooks))
+            self.in_sync = pipeline.in_sync
+            self.failed = pipeline.has_failures
+            if self.failed:
+                self.exit_code = 1
+            if self.metrics and command != ActionType.UNLINK:
+                self.metrics.in_sync = pipeline.in_sync
+            if command != ActionType.UNLINK:
+                if pipeline.in_sync:
+                    if not partial and Fingerprint.applies(profile.merged()):
+                        self.fingerprint.save(self.__layered(profile.name),
+                            Fingerprint.collect(profile.merged(), tree) + self.__layer_items())
+                    if self.git and command == ActionType.SYNC:
+                        self.git_state.save(profile.name, Dotref.__env(profile.merged()))
+                elif self.check_exit_code:
+                    self.exit_code = 1
+        finally:
+            if journal:
+                journal.commit()
+            if self.metrics:
+                self.metrics.write(self.metrics_file)
+        cache.save()
+        tree.save()
+
+
+def complete(argv):
+    """ Fast shell completion backed by the profile index, never loads or validates profiles """
+    parser = argparse.ArgumentParser(prog='dotref __complete')
+    parser.add_argument('what', choices=['profiles'])
+    parser.add_argument('-d', '--dotdir', action='append')
+    parser.add_argument('-s', '--statefile', default='.dotref.json')
+    args, _ = parser.parse_known_args(argv)
+
+    dotdirs = [pathlib.Path(d) for d in args.dotdir or ['dotref']]
+    if not dotdirs[0].is_dir():
+        return
+
+    index = ProfileIndex(dotdirs, dotdirs[0] / args.statefile, readonly=True)
+    try:
+        names = sorted(index.load())
+    except OSError:
+        return
+
+    if names:
+        sys.stdout.write('\n'.join(names) + '\n')
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '__complete':
+        complete(sys.argv[2:])
+        return
+
     log = Logger()
 
     parser = argparse.ArgumentParser(description='Simple tool to manage dotfiles')
-    parser.add_argument('command', choices=['init', 'sync', 'unlink', 'status', 'profiles', 'version'],
+    parser.add_argument('command',
+        choices=['init', 'sync', 'unlink', 'status', 'switch', 'rollback', 'push', 'gc', 'profiles',
+            'version'],
         help='Command to execute')
+    parser.add_argument('hosts', nargs='*', metavar='HOST', help=f'Hosts for the {log.hl("push")} command')
     parser.add_argument('-p', '--profile',
         help=f'Name of the profile to use for {log.hl("init")} and {log.hl("profiles")} commands. \
                 Use {log.hl("profiles")} to see all available profiles.')
-    parser.add_argument('-d', '--dotdir', default='dotref',
-        help=f'Directory containing dotref profiles and state file (default: {log.muted("dotref")})')
+    parser.add_argument('-d', '--dotdir', action='append',
+        help=f'Directory containing dotref profiles and state file (default: {log.muted("dotref")}), \
+            repeat to layer several directories, the first one taking precedence and keeping the state file')
     parser.add_argument('-s', '--statefile', default='.dotref.json',
         help=f'Name of the state file in which dotref will keep current profile and settings \
                 (default: {log.muted(".dotref.json")} in the DOTDIR directory)')
+    parser.add_argument('--store', action='store_true',
+        help=f'Used with {log.hl("init")}: keep rendered templates in a content-addressed store inside the \
+                state directory and hardlink their destinations to it')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+        help=f'Number of concurrent file system operations, useful on network file systems \
+                (default: {log.muted("1")})')
+    parser.add_argument('--ssh', default=os.environ.get('DOTREF_SSH', 'ssh'),
+        help=f'SSH command used by {log.hl("push")} (default: {log.muted("ssh")} or DOTREF_SSH)')
+    parser.add_argument('--remote-dir', default='~/.local/share/dotref',
+        help=f'Directory on remote hosts where {log.hl("push")} keeps link sources \
+                (default: {log.muted("~/.local/share/dotref")})')
+    parser.add_argument('--fail-fast', action='store_true',
+        help='Stop at the first conflict instead of processing all entries')
+    parser.add_argument('--jsonl', metavar='FILE',
+        help='Also write every entry result as a JSON line to FILE')
+    parser.add_argument('--metrics-file', metavar='PATH',
+        help='Write run metrics to PATH in the Prometheus textfile collector format')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help=f'Used with {log.hl("status")}: print nothing and only compare a fingerprint of managed files \
+                recorded by the last {log.hl("sync")} or {log.hl("status")}, implies --exit-code')
+    parser.add_argument('--exit-code', action='store_true',
+        help=f'Exit with status 1 when {log.hl("status")} or {log.hl("sync")} finds entries out of sync')
+    parser.add_argument('--git', action='store_true',
+        help=f'Used with {log.hl("sync")} and {log.hl("status")}: only check entries whose sources or \
+                profiles changed in the git repository since the last {log.hl("sync")} with this option')
+    parser.add_argument('--schedule', action='store_true',
+        help=f'Used with {log.hl("sync")} when run periodically on many hosts: waits a per-host delay \
+                derived from the hostname, backs off after failed or slow runs and skips the run when \
+                nothing changed')
+    parser.add_argument('--splay', type=float, default=900, metavar='SECONDS',
+        help=f'Window over which --schedule spreads the hosts (default: {log.muted("900")})')
+    parser.add_argument('--delete', action='store_true',
+        help=f'Used with {log.hl("gc")}: remove orphaned links instead of only listing them')
+    parser.add_argument('--root', action='append', metavar='DIR',
+        help=f'Directory scanned by {log.hl("gc")}, can be repeated (default: {log.muted("~")})')
+    parser.add_argument('--depth', type=int, default=6,
+        help=f'How deep {log.hl("gc")} descends into the scanned directories (default: {log.muted("6")})')
+    parser.add_argument('--exclude', action='append', metavar='GLOB',
+        help=f'Directory name or path relative to the scanned directory to skip in {log.hl("gc")}, \
+                can be repeated; caches, VCS directories and node_modules are always skipped')
     parser.add_argument('-v', '--verbose', action='count', default=0, help='Produce more verbose output')
     args = parser.parse_args()
 
+    if args.hosts and args.command != 'push':
+        parser.error('hosts can only be given to the push command')
+    if args.schedule and args.command != 'sync':
+        parser.error('--schedule can only be used with the sync command')
+    if args.splay < 0:
+        parser.error('--splay must not be negative')
+
     if args.command == 'version':
         log.out(f'dotref {log.hl(__version__)}', True)
     else:
@@ -556,6 +3660,8 @@ def main():
                 raise
             else:
                 sys.exit(1)
+        if dotref.exit_code:
+            sys.exit(dotref.exit_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,17 @@
+import io
+import sys
+import contextlib
+import dotref
+from unittest import mock
+
+
+def run_dotref(*args):
+    """ Run the command line interface, returns exit code and output (stdout followed by stderr) """
+    stdout, stderr, code = io.StringIO(), io.StringIO(), 0
+    with mock.patch.object(sys, 'argv', ['dotref'] + list(args)), contextlib.redirect_stdout(stdout), \
+            contextlib.redirect_stderr(stderr):
+        try:
+            dotref.main()
+        except SystemExit as e:
+            code = e.code
+    return code, stdout.getvalue() + stderr.getvalue()
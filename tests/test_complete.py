@@ -0,0 +1,71 @@
+import os
+import io
+import sys
+import json
+import contextlib
+import pathlib
+import tempfile
+import shutil
+import dotref
+from unittest import TestCase, main, mock
+from dotref import ProfileIndex
+
+
+class TestComplete(TestCase):
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.dotdir = self.tmpdir / 'dotref'
+        self.dotdir.mkdir()
+        self.write('base.json', {'vars': {'a': '1', 'b': '2'}})
+        self.write('desktop.json', {'extends': ['base'], 'vars': {'c': '3'}})
+        self.write('.dotref.json', {'profile': 'base'})
+        (self.dotdir / 'broken.json').write_text('{ not json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, name, content):
+        with open(self.dotdir / name, 'w') as f:
+            json.dump(content, f)
+
+    def complete(self, args):
+        stdout = io.StringIO()
+        with mock.patch.object(sys, 'argv', ['dotref', '__complete'] + args):
+            with contextlib.redirect_stdout(stdout):
+                dotref.main()
+        return stdout.getvalue().split()
+
+    def test_index(self):
+        index = ProfileIndex([self.dotdir], self.dotdir / '.dotref.json')
+        profiles = index.load()
+        self.assertEqual(sorted(profiles), ['base', 'desktop'])
+
+        with mock.patch.object(ProfileIndex, '_ProfileIndex__scan', side_effect=AssertionError):
+            self.assertEqual(sorted(index.load()), ['base', 'desktop'])
+
+        self.write('server.json', {})
+        mtime = self.dotdir.stat().st_mtime_ns + 1
+        os.utime(self.dotdir, ns=(mtime, mtime))
+        self.assertEqual(sorted(index.load()), ['base', 'desktop', 'server'])
+
+    def test_cli(self):
+        self.assertEqual(self.complete(['profiles', '-d', str(self.dotdir)]), ['base', 'desktop'])
+        self.assertEqual(self.complete(['profiles', '-d', str(self.tmpdir / 'missing')]), [])
+
+    def test_cli_never_writes(self):
+        self.assertEqual(self.complete(['profiles', '-d', str(self.dotdir)]), ['base', 'desktop'])
+        self.assertFalse((self.dotdir / '.dotref.d').exists())
+
+        ProfileIndex([self.dotdir], self.dotdir / '.dotref.json').load()
+        index = self.dotdir / '.dotref.d' / 'index.json'
+        cached = index.read_text()
+        self.write('server.json', {})
+        mtime = self.dotdir.stat().st_mtime_ns + 1
+        os.utime(self.dotdir, ns=(mtime, mtime))
+        self.assertEqual(self.complete(['profiles', '-d', str(self.dotdir)]), ['base', 'desktop', 'server'])
+        self.assertEqual(index.read_text(), cached)
+
+
+if __name__ == '__main__':
+    main()
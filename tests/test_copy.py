@@ -0,0 +1,74 @@
+import os
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main, mock
+from dotref import CopyAction, ActionState, ActionType, copy_file
+
+
+class TestCopy(TestCase):
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.src = self.tmpdir / 'font.ttf'
+        self.dst = self.tmpdir / 'fonts' / 'font.ttf'
+        self.dst.parent.mkdir()
+        self.src.write_bytes(bytes(range(256)) * 1000 + b'\xff\xfe not utf-8')
+        os.chmod(self.src, 0o640)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_src_does_not_exist(self):
+        action = CopyAction('foo', {'src': 'missing', 'dst': 'bar'})
+        self.assertRaises(ValueError, action.apply, ActionType.STATUS)
+
+    def test_apply(self):
+        action = CopyAction('foo', {'src': str(self.src), 'dst': str(self.dst)})
+        self.assertEqual(action.apply(ActionType.STATUS).state, ActionState.MISSING)
+        self.assertEqual(action.apply(ActionType.UNLINK).state, ActionState.OK)
+
+        self.assertEqual(action.apply(ActionType.SYNC).state, ActionState.COPIED)
+        self.assertEqual(self.dst.read_bytes(), self.src.read_bytes())
+        self.assertEqual(self.dst.stat().st_mode & 0o777, 0o640)
+        self.assertEqual(self.dst.stat().st_mtime_ns, self.src.stat().st_mtime_ns)
+
+        with mock.patch('dotref.files_equal') as files_equal:
+            self.assertEqual(action.apply(ActionType.SYNC).state, ActionState.OK)
+            files_equal.assert_not_called()
+
+        os.utime(self.dst, ns=(0, 0))
+        self.assertEqual(action.apply(ActionType.STATUS).state, ActionState.OK)
+
+        os.chmod(self.dst, 0o600)
+        self.assertEqual(action.apply(ActionType.STATUS).state, ActionState.OK)
+        self.assertEqual(action.apply(ActionType.SYNC).state, ActionState.COPIED)
+        self.assertEqual(self.dst.stat().st_mode & 0o777, 0o640)
+
+        self.dst.write_bytes(b'changed')
+        self.assertEqual(action.apply(ActionType.STATUS).state, ActionState.DIFFERS)
+        self.assertEqual(action.apply(ActionType.UNLINK).state, ActionState.DIFFERS)
+        self.assertEqual(action.apply(ActionType.SYNC).state, ActionState.COPIED)
+
+        self.assertEqual(action.apply(ActionType.UNLINK).state, ActionState.UNLINKED)
+        self.assertFalse(self.dst.exists())
+
+    def test_conflict(self):
+        self.dst.mkdir()
+        action = CopyAction('foo', {'src': str(self.src), 'dst': str(self.dst)})
+        self.assertEqual(action.apply(ActionType.SYNC).state, ActionState.CONFLICT)
+
+    def test_fallbacks(self):
+        data = self.src.read_bytes()
+        self.assertIn(copy_file(self.src, self.dst), ('reflink', 'copy_file_range', 'sendfile', 'copy'))
+        self.assertEqual(self.dst.read_bytes(), data)
+
+        with mock.patch('fcntl.ioctl', side_effect=OSError), \
+                mock.patch('os.copy_file_range', side_effect=OSError, create=True), \
+                mock.patch('os.sendfile', return_value=0, create=True):
+            self.assertEqual(copy_file(self.src, self.dst), 'copy')
+        self.assertEqual(self.dst.read_bytes(), data)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+import io
+import json
+import pathlib
+import tempfile
+import shutil
+import threading
+import contextlib
+from unittest import TestCase, main
+from dotref import (AsyncEngine, SerialEngine, ApplyContext, Journal, LinkAction, TemplateAction,
+        ActionState, ActionType, MemoryFileSystem, LatencyFileSystem, Profile, Logger)
+
+
+class TestEngine(TestCase):
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_order_and_concurrency(self):
+        barrier = threading.Barrier(4, timeout=5)
+
+        def fn(i):
+            barrier.wait()
+            return i * 2
+
+        self.assertEqual(AsyncEngine(4).run(fn, range(8)), [i * 2 for i in range(8)])
+        self.assertEqual(SerialEngine().run(lambda i: i * 2, range(8)), [i * 2 for i in range(8)])
+
+    def create(self, name):
+        base = self.tmpdir / name
+        base.mkdir()
+        links, templates = [], []
+        for i in range(20):
+            src = base / f'src{i}'
+            src.write_text(f'$name {i}')
+            links.append(LinkAction('foo', {'src': str(src), 'dst': str(base / f'link{i}')}))
+            templates.append(TemplateAction('foo', {'src': str(src), 'dst': str(base / f'tpl{i}')}))
+        (base / 'link3').write_text('conflict')
+        return links, templates
+
+    def test_same_results(self):
+        vars = {'name': 'foo'}
+        serial_links, serial_templates = self.create('serial')
+        async_links, async_templates = self.create('async')
+        serial_ctx = ApplyContext(journal=Journal(self.tmpdir / 'serial_state'))
+        async_ctx = ApplyContext(journal=Journal(self.tmpdir / 'async_state'), engine=AsyncEngine(8))
+
+        for command in (ActionType.STATUS, ActionType.SYNC, ActionType.STATUS, ActionType.UNLINK):
+            serial = serial_ctx.engine.run(lambda a: a.apply(command, serial_ctx), serial_links)
+            serial += serial_ctx.engine.run(lambda a: a.apply(command, vars, serial_ctx), serial_templates)
+            concurrent = async_ctx.engine.run(lambda a: a.apply(command, async_ctx), async_links)
+            concurrent += async_ctx.engine.run(lambda a: a.apply(command, vars, async_ctx), async_templates)
+
+            self.assertEqual([r.state for r in serial], [r.state for r in concurrent])
+            self.assertEqual([r.right.name for r in serial], [r.right.name for r in concurrent])
+
+        self.assertEqual(len(async_ctx.journal.entries), len(serial_ctx.journal.entries))
+        self.assertIn(ActionState.CONFLICT, [r.state for r in serial])
+
+    def test_nested_creates(self):
+        filename = self.tmpdir / 'test.json'
+        filename.write_text(json.dumps({'create': [{'name': '/home/.ssh/sockets'}, {'name': '/home/other'},
+            {'name': '/home/.ssh', 'mode': '700'}]}))
+        fs = MemoryFileSystem()
+        fs.makedirs('/home')
+        ctx = ApplyContext(engine=AsyncEngine(4), fs=LatencyFileSystem(fs, latency=0.005))
+        with contextlib.redirect_stdout(io.StringIO()):
+            pipeline = Profile(filename).action(ActionType.SYNC, Logger(), ctx=ctx)
+
+        self.assertEqual(pipeline.counter.counts, {('create', ActionState.CREATED): 3})
+        self.assertEqual(fs.stat('/home/.ssh').st_mode & 0o777, 0o700)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+import os
+import json
+import time
+import pathlib
+import tempfile
+import shutil
+import dotref
+from tests import run_dotref
+from unittest import TestCase, main, mock
+
+
+class TestFingerprint(TestCase):
+
+    profile = """
+    {
+        "vars": { "name": { "env": "DOTREF_TEST_NAME", "default": "world" } },
+        "create": [ { "name": "dir" } ],
+        "link": [ { "src": "src", "dst": "dir/link" }, { "src": "files/*", "dst": "files_dst" } ],
+        "template": [ { "src": "test.tpl", "dst": "test.txt" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('dotref/test.json').write_text(self.profile)
+        pathlib.Path('src').write_text('src')
+        pathlib.Path('files').mkdir()
+        pathlib.Path('files/a').write_text('a')
+        pathlib.Path('test.tpl').write_text('Hello $name')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def assertQuickStatus(self, code):
+        self.assertEqual(run_dotref('status', '--quiet'), (code, ''))
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_quick_status(self):
+        run_dotref('init', '-p', 'test')
+        self.assertQuickStatus(1)
+        self.assertEqual(run_dotref('status', '--exit-code')[0], 1)
+
+        run_dotref('sync')
+        with mock.patch.object(dotref.Profile, '__init__', side_effect=AssertionError('profiles loaded')):
+            self.assertQuickStatus(0)
+        self.assertEqual(run_dotref('status', '--exit-code')[0], 0)
+        self.assertQuickStatus(0)
+
+        os.unlink('dir/link')
+        self.assertQuickStatus(1)
+        run_dotref('sync')
+        self.assertQuickStatus(0)
+
+        pathlib.Path('files/b').write_text('b')
+        self.assertQuickStatus(1)
+        run_dotref('sync')
+        self.assertQuickStatus(0)
+
+        time.sleep(0.01)
+        pathlib.Path('test.tpl').write_text('Bye $name')
+        self.assertQuickStatus(1)
+        self.assertEqual(run_dotref('status')[0], 0)
+        self.assertQuickStatus(1)
+        run_dotref('sync')
+        self.assertQuickStatus(0)
+
+        with mock.patch.dict(os.environ, {'DOTREF_TEST_NAME': 'there'}):
+            self.assertQuickStatus(1)
+
+        run_dotref('unlink')
+        self.assertQuickStatus(1)
+
+    def test_command_variables(self):
+        pathlib.Path('dotref/test.json').write_text('''{
+            "vars": { "name": { "command": "cat name" } },
+            "template": [ { "src": "test.tpl", "dst": "test.txt" } ]
+        }''')
+        pathlib.Path('name').write_text('world')
+        run_dotref('init', '-p', 'test')
+        run_dotref('sync')
+        self.assertEqual(run_dotref('status', '--exit-code')[0], 0)
+        # The command output isn't part of the fingerprint, so none is taken
+        self.assertQuickStatus(1)
+
+    def test_malformed(self):
+        filename = pathlib.Path('state.json')
+        fingerprint = dotref.Fingerprint(filename)
+        for items in ([['path', 'src']], [None], 42, [['path', None, None]]):
+            filename.write_text(json.dumps({'profile': 'test', 'items': items}))
+            self.assertFalse(fingerprint.matches('test'))
+
+
+if __name__ == '__main__':
+    main()
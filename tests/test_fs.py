@@ -0,0 +1,144 @@
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main
+from dotref import (MemoryFileSystem, LatencyFileSystem, ApplyContext, AsyncEngine, CreateAction, LinkAction,
+        CopyAction, TemplateAction, ActionState, ActionType, ObjectStore, Journal)
+
+
+class TestMemoryFileSystem(TestCase):
+
+    def setUp(self):
+        self.fs = MemoryFileSystem()
+        self.fs.makedirs('/home/user/src')
+        self.fs.write_bytes('/home/user/src/file', b'data')
+
+    def test_files(self):
+        self.assertTrue(self.fs.is_dir('/home/user'))
+        self.assertTrue(self.fs.is_file('/home/user/src/file'))
+        self.assertEqual(self.fs.read_bytes('/home/user/src/file'), b'data')
+        self.assertEqual(self.fs.stat('/home/user/src/file').st_size, 4)
+        self.assertFalse(self.fs.exists('/home/user/src/file/child'))
+        self.assertEqual([e.name for e in self.fs.scandir('/home/user/src')], ['file'])
+
+        self.fs.copy('/home/user/src/file', '/home/user/copy')
+        self.assertTrue(self.fs.same_content('/home/user/src/file', '/home/user/copy'))
+        self.fs.replace('/home/user/copy', '/home/user/moved')
+        self.assertFalse(self.fs.exists('/home/user/copy'))
+        self.assertTrue(self.fs.equals('/home/user/moved', b'data'))
+
+        with self.assertRaises(FileNotFoundError):
+            self.fs.write_bytes('/missing/file', b'')
+        with self.assertRaises(IsADirectoryError):
+            self.fs.unlink('/home/user')
+
+    def test_symlinks(self):
+        self.fs.symlink('/home/user/src', '/home/user/link', True)
+        self.fs.symlink('link/file', '/home/user/relative')
+        self.assertTrue(self.fs.is_symlink('/home/user/link'))
+        self.assertTrue(self.fs.is_dir('/home/user/link'))
+        self.assertEqual(self.fs.read_bytes('/home/user/relative'), b'data')
+        self.assertEqual(self.fs.resolve('/home/user/relative'), pathlib.Path('/home/user/src/file'))
+        self.assertTrue(self.fs.samefile('/home/user/link/file', '/home/user/src/file'))
+        self.assertEqual(self.fs.readlink('/home/user/link'), '/home/user/src')
+        self.assertEqual([(e.name, e.is_dir(), e.is_symlink()) for e in self.fs.scandir('/home/user')],
+                [('link', True, True), ('relative', False, True), ('src', True, False)])
+
+        self.fs.unlink('/home/user/link')
+        self.assertTrue(self.fs.is_symlink('/home/user/relative'))
+        self.assertFalse(self.fs.exists('/home/user/relative'))
+
+        self.fs.symlink('/home/user/loop', '/home/user/loop')
+        with self.assertRaises(OSError):
+            self.fs.stat('/home/user/loop')
+
+
+class TestActionsOnMemoryFileSystem(TestCase):
+
+    def setUp(self):
+        self.fs = self.populate(MemoryFileSystem())
+
+        def apply(a, command, ctx):
+            return a.apply(command, ctx)
+
+        self.actions = [
+            (CreateAction('test', {'name': '/home/.config'}), apply),
+            (LinkAction('test', {'src': '/src/dir', 'dst': '/home/.config/dir'}), apply),
+            (LinkAction('test', {'src': '/src/dir/*', 'dst': '/home/each'}),
+                lambda a, command, ctx: a.results(command, ctx)),
+            (CopyAction('test', {'src': '/src/dir/file0', 'dst': '/home/copy'}), apply),
+            (TemplateAction('test', {'src': '/src/test.tpl', 'dst': '/home/test.txt'}),
+                lambda a, c, ctx: a.apply(c, {'name': 'world'}, ctx)),
+        ]
+
+    @staticmethod
+    def populate(fs):
+        fs.makedirs('/src/dir')
+        for i in range(10):
+            fs.write_bytes(f'/src/dir/file{i}', f'file {i}'.encode())
+        fs.write_bytes('/src/test.tpl', b'Hello $name')
+        fs.makedirs('/home')
+        return fs
+
+    def run_actions(self, command, ctx):
+        results = []
+        for action, fn in self.actions:
+            result = fn(action, command, ctx)
+            results += result if isinstance(result, list) else [result]
+        return [r.state for r in results]
+
+    def test_sync(self):
+        fs = LatencyFileSystem(self.fs)
+        ctx = ApplyContext(fs=fs)
+        self.assertEqual(self.run_actions(ActionType.STATUS, ctx), [ActionState.MISSING] * 14)
+        self.assertEqual(self.run_actions(ActionType.SYNC, ctx), [ActionState.CREATED, ActionState.LINKED] +
+                [ActionState.LINKED] * 10 + [ActionState.COPIED, ActionState.RENDERED])
+        self.assertEqual(self.run_actions(ActionType.STATUS, ctx), [ActionState.OK] * 14)
+
+        self.assertEqual(self.fs.readlink('/home/.config/dir'), '/src/dir')
+        self.assertEqual(self.fs.read_bytes('/home/each/file3'), b'file 3')
+        self.assertEqual(self.fs.read_bytes('/home/copy'), b'file 0')
+        self.assertEqual(self.fs.read_bytes('/home/test.txt'), b'Hello world')
+        self.assertGreater(fs.counts['stat'], 0)
+        self.assertEqual(fs.counts['symlink'], 11)
+        self.assertEqual(fs.counts['write_bytes'], 1)
+
+        self.assertEqual(self.run_actions(ActionType.UNLINK, ctx), [ActionState.OK] +
+                [ActionState.UNLINKED] * 13)
+        self.assertEqual([e.name for e in self.fs.scandir('/home')], ['.config', 'each'])
+
+    def test_counts_are_deterministic(self):
+        counts = []
+        for engine in (None, AsyncEngine(4)):
+            fs = LatencyFileSystem(self.populate(MemoryFileSystem()), latency=0.001)
+            ctx = ApplyContext(fs=fs, engine=engine)
+            links = [LinkAction('test', {'src': f'/src/dir/file{i}', 'dst': f'/home/link{i}'})
+                    for i in range(10)]
+            results = ctx.engine.run(lambda a: a.apply(ActionType.SYNC, ctx), links)
+            self.assertEqual([r.state for r in results], [ActionState.LINKED] * 10)
+            counts.append(fs.counts)
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(counts[0]['symlink'], 10)
+
+    def test_store_and_journal(self):
+        fs = LatencyFileSystem(self.fs)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        state = pathlib.Path(tmpdir, 'state')
+        ctx = ApplyContext(ObjectStore(state / 'objects'), Journal(state), fs=fs)
+        self.fs.write_bytes('/home/test.txt', b'old')
+        self.assertEqual(self.run_actions(ActionType.SYNC, ctx)[-1], ActionState.RENDERED)
+
+        obj = self.fs.stat(ctx.store.object_path(ObjectStore.digest(b'Hello world')))
+        self.assertEqual(self.fs.stat('/home/test.txt').st_ino, obj.st_ino)
+        self.assertEqual(self.fs.stat('/home/test.txt').st_mode & 0o777, 0o444)
+        self.assertEqual(fs.counts['link'], 1)
+        entries = {e['path']: e for e in ctx.journal.entries}
+        self.assertEqual(entries['/home/.config']['type'], 'absent')
+        self.assertEqual(entries['/home/test.txt']['type'], 'file')
+        self.assertTrue(self.fs.is_file(ctx.store.object_path(entries['/home/test.txt']['digest'])))
+        self.assertFalse(state.exists())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import os
+import pathlib
+import tempfile
+import shutil
+from tests import run_dotref
+from unittest import TestCase, main, mock
+
+
+class TestGc(TestCase):
+
+    profile = """
+    {
+        "link": [ { "src": "managed", "dst": "../.managed" }, { "src": "files/*", "dst": "../.files" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        self.home = pathlib.Path(self.tmpdir).resolve() / 'home'
+        self.repo = self.home / 'dotfiles'
+        (self.repo / 'dotref').mkdir(parents=True)
+        (self.repo / 'files').mkdir()
+        (self.repo / 'dotref' / 'test.json').write_text(self.profile)
+        for name in ('managed', 'removed', 'files/a', 'deep', 'cached'):
+            (self.repo / name).write_text(name)
+        os.chdir(self.repo)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def link(self, path, target):
+        path = self.home / path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.symlink_to(target)
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_gc(self):
+        run_dotref('init', '-p', 'test')
+        run_dotref('sync')
+        self.link('.removed', self.repo / 'removed')
+        self.link('.config/app/gone', self.repo / 'gone')
+        self.link('.config/other', '/tmp')
+        self.link('.cache/app/cached', self.repo / 'cached')
+        self.link('projects/node_modules/x', self.repo / 'cached')
+        self.link('ignored/link', self.repo / 'cached')
+        self.link('a/b/c/d/deep', self.repo / 'deep')
+        (self.repo / 'internal').symlink_to(self.repo / 'managed')
+
+        args = ['gc', '--root', str(self.home), '--depth', '3', '--exclude', 'ignored']
+        output = run_dotref(*args)[1]
+        self.assertIn('Orphaned links:', output)
+        self.assertIn(f'[ORPHANED] {self.repo}/gone', output)
+        self.assertIn(f'[ORPHANED] {self.repo}/removed', output)
+        self.assertEqual(output.count('[ORPHANED]'), 2)
+        self.assertIn('gc completed successfully, 2 orphaned links found, use --delete to remove them',
+                output)
+
+        output = run_dotref(*args, '--delete')[1]
+        self.assertEqual(output.count('[UNLINKED]'), 2)
+        self.assertFalse(os.path.lexists(self.home / '.removed'))
+        self.assertTrue(os.path.lexists(self.home / '.managed'))
+        self.assertTrue(os.path.lexists(self.home / '.files' / 'a'))
+        self.assertTrue(os.path.lexists(self.home / 'a/b/c/d/deep'))
+        self.assertIn('0 orphaned links found', run_dotref(*args)[1])
+
+        run_dotref('rollback')
+        self.assertTrue(os.path.lexists(self.home / '.removed'))
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_gc_flat(self):
+        (self.repo / 'dotref' / 'test.json').unlink()
+        (self.repo / 'test.json').write_text('{ "link": [ { "src": "managed", "dst": "../.managed" } ] }')
+        run_dotref('-d', '.', 'init', '-p', 'test')
+        run_dotref('-d', '.', 'sync')
+        (self.home / 'tool').write_text('tool')
+        self.link('.local/bin/run', self.home / 'tool')
+        self.link('.removed', self.repo / 'removed')
+
+        output = run_dotref('-d', '.', 'gc', '--root', str(self.home))[1]
+        self.assertIn(f'[ORPHANED] {self.repo}/removed', output)
+        self.assertNotIn('tool', output)
+        self.assertEqual(output.count('[ORPHANED]'), 1)
+
+    def test_gc_refuses_repo_containing_root(self):
+        run_dotref('init', '-p', 'test')
+        code, output = run_dotref('gc', '--root', str(self.repo / 'files'))
+        self.assertNotEqual(code, 0)
+        self.assertIn('refusing to look for orphaned links', output)
+
+
+if __name__ == '__main__':
+    main()
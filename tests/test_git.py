@@ -0,0 +1,87 @@
+import os
+import pathlib
+import tempfile
+import shutil
+import subprocess
+from tests import run_dotref
+from unittest import TestCase, main, mock, skipUnless
+
+
+@skipUnless(shutil.which('git'), 'git is not installed')
+class TestGit(TestCase):
+
+    profile = """
+    {
+        "link": [ { "src": "src1", "dst": "home/link1" }, { "src": "files/*", "dst": "home/files" } ],
+        "template": [ { "src": "test.tpl", "dst": "home/test.txt" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('dotref/test.json').write_text(self.profile)
+        pathlib.Path('src1').write_text('src1')
+        pathlib.Path('files').mkdir()
+        pathlib.Path('files/a').write_text('a')
+        pathlib.Path('test.tpl').write_text('Hello')
+        pathlib.Path('home').mkdir()
+        pathlib.Path('.gitignore').write_text('home/\n.dotref*\n')
+        self.git('init', '-q')
+        self.git('add', '.')
+        self.git('commit', '-q', '-m', 'Initial')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def git(self, *args):
+        subprocess.run(['git', '-c', 'user.name=test', '-c', 'user.email=test@example.com'] + list(args),
+            check=True, stdout=subprocess.DEVNULL)
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_git_changes(self):
+        run_dotref('init', '-p', 'test')
+        output = run_dotref('sync', '--git')[1]
+        self.assertIn('[LINKED]   ./src1', output)
+        self.assertIn('sync completed successfully and', output)
+
+        self.assertEqual(run_dotref('sync', '--git')[1], 'Profile: test\n\n'
+            'sync completed successfully, 3 unchanged entries skipped and no conflicts were detected\n')
+        # A partial run keeps the fingerprint of the full one, as long as it's still valid
+        self.assertEqual(run_dotref('status', '--quiet'), (0, ''))
+
+        pathlib.Path('test.tpl').write_text('Bye')
+        output = run_dotref('sync', '--git')[1]
+        self.assertNotIn('Link:', output)
+        self.assertIn('[RENDERED] ./test.tpl', output)
+        self.assertIn('2 unchanged entries skipped', output)
+        self.assertEqual(run_dotref('status', '--quiet'), (1, ''))
+
+        self.git('checkout', '-q', 'test.tpl')
+        output = run_dotref('sync', '--git')[1]
+        self.assertIn('[RENDERED] ./test.tpl', output)
+        self.assertEqual(pathlib.Path('home/test.txt').read_text(), 'Hello')
+        self.assertIn('3 unchanged entries skipped', run_dotref('sync', '--git')[1])
+
+        pathlib.Path('files/b').write_text('b')
+        output = run_dotref('status', '--git')[1]
+        self.assertIn('[MISSING]  files/b', output)
+        self.assertIn('2 unchanged entries skipped', output)
+        run_dotref('sync', '--git')
+        self.git('add', 'files/b')
+        self.git('commit', '-q', '-m', 'Add b')
+        self.assertIn('2 unchanged entries skipped', run_dotref('sync', '--git')[1])
+        self.assertIn('3 unchanged entries skipped', run_dotref('sync', '--git')[1])
+
+        pathlib.Path('dotref/test.json').write_text(self.profile + ' ')
+        self.assertIn('0 unchanged entries skipped', run_dotref('sync', '--git')[1])
+
+        run_dotref('sync')
+        self.assertIn('sync completed successfully and', run_dotref('sync', '--git')[1])
+
+
+if __name__ == '__main__':
+    main()
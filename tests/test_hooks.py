@@ -0,0 +1,121 @@
+import os
+import json
+import pathlib
+import tempfile
+import shutil
+import dotref
+from tests import run_dotref
+from unittest import TestCase, main, mock
+
+
+class TestHooks(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('home').mkdir()
+        pathlib.Path('src').write_text('src')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def write_profile(self, hooks):
+        pathlib.Path('dotref/test.json').write_text(json.dumps({
+            'link': [{'src': 'src', 'dst': 'home/dst'}],
+            'create': [{'name': 'home/fonts'}],
+            'hooks': hooks,
+        }))
+
+    @staticmethod
+    def run_cli(*args):
+        """ run_dotref with trailing spaces of output lines removed """
+        code, output = run_dotref(*args)
+        return code, '\n'.join(line.rstrip() for line in output.splitlines())
+
+    @staticmethod
+    def lines(name):
+        return pathlib.Path(name).read_text().splitlines() if os.path.exists(name) else []
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_triggered_and_cached(self):
+        self.write_profile([
+            {'name': 'pre', 'when': 'pre', 'command': 'echo pre >> pre.log', 'watch': ['home/dst']},
+            {'name': 'reload', 'command': 'echo "$DOTREF_CHANGED" >> reload.log', 'watch': ['home/dst']},
+            {'name': 'after', 'command': 'test -s reload.log && echo after >> after.log',
+                'after': ['reload']},
+            {'name': 'fonts', 'command': 'echo fonts >> fonts.log', 'watch': ['home/fonts.conf']},
+        ])
+        self.run_cli('init', '-p', 'test')
+        code, out = self.run_cli('sync', '--exit-code')
+        self.assertEqual(code, 0)
+        self.assertIn('Hooks:\n    [RAN]      reload\n    [RAN]      after\n', out)
+        self.assertEqual(self.lines('pre.log'), ['pre'])
+        self.assertEqual(self.lines('reload.log'), [os.path.abspath('home/dst')])
+        self.assertEqual(self.lines('after.log'), ['after'])
+        self.assertEqual(self.lines('fonts.log'), [])
+
+        # The pre hook saw home/dst missing last time, then nothing changes and its inputs are the same
+        code, out = self.run_cli('sync')
+        self.assertNotIn('Hooks:', out)
+        self.assertIn('Pre hooks:\n    [RAN]      pre\n', out)
+        code, out = self.run_cli('sync')
+        self.assertIn('Pre hooks:\n    [OK]       pre\n', out)
+        self.assertEqual(len(self.lines('pre.log')), 2)
+
+        # Linked again with the same content: triggered but cached
+        self.run_cli('unlink')
+        code, out = self.run_cli('sync')
+        self.assertIn('Hooks:\n    [OK]       reload\n', out)
+        self.assertEqual(self.lines('reload.log'), [os.path.abspath('home/dst')])
+
+        pathlib.Path('src').write_text('changed')
+        self.run_cli('unlink')
+        self.run_cli('sync')
+        self.assertEqual(len(self.lines('reload.log')), 2)
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_timeout_and_failure(self):
+        self.write_profile([
+            {'name': 'slow', 'command': 'sleep 10', 'timeout': 0.3},
+            {'name': 'dependent', 'command': 'echo dependent >> dependent.log', 'after': ['slow']},
+            {'name': 'broken', 'command': 'echo oops; exit 3'},
+        ])
+        self.run_cli('init', '-p', 'test')
+        code, out = self.run_cli('sync')
+        self.assertEqual(code, 1)
+        self.assertIn('Hook "slow" timed out after 0.3 seconds', out)
+        self.assertIn('Hook "broken" failed with exit code 3:\noops', out)
+        self.assertIn('[FAILED]   dependent', out)
+        self.assertEqual(self.lines('dependent.log'), [])
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_parallel(self):
+        # Every hook waits until all of them have started, which only succeeds when they run concurrently
+        wait = 'for i in $(seq 200); do [ $(ls started.* | wc -l) -ge 4 ] && exit 0; sleep 0.05; done; exit 1'
+        self.write_profile([{'name': f'hook{i}', 'command': f'touch started.{i}; {wait}'} for i in range(4)])
+        self.run_cli('init', '-p', 'test')
+        code, out = self.run_cli('sync', '--exit-code')
+        self.assertEqual(code, 0)
+        self.assertEqual(out.count('[RAN]'), 4)
+
+    def test_cycle(self):
+        self.write_profile([{'name': 'a', 'command': 'true', 'after': ['b']},
+            {'name': 'b', 'command': 'true', 'after': ['a']}])
+        self.run_cli('init', '-p', 'test')
+        code, out = self.run_cli('sync')
+        self.assertEqual(code, 1)
+        self.assertIn('Hooks wait for each other: a, b', out)
+
+    def test_validation(self):
+        for hook in ({'name': 'a'}, {'name': 'a', 'command': 'true', 'when': 'later'},
+                {'name': 'a', 'command': 'true', 'watch': 'file'},
+                {'name': 'a', 'command': 'true', 'timeout': 0}):
+            with self.assertRaises(TypeError):
+                dotref.Hook('test', hook)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import os
+import json
+import pathlib
+import tempfile
+import shutil
+import dotref
+from tests import run_dotref
+from unittest import TestCase, main, mock
+
+
+class TestLayers(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        for repo in ('company', 'personal'):
+            pathlib.Path(repo, 'dotref').mkdir(parents=True)
+        pathlib.Path('personal/home').mkdir()
+
+        self.write('company', 'base', {'link': [{'src': 'bashrc', 'dst': 'home/.bashrc'}]})
+        self.write('company', 'desktop', {'extends': ['base'], 'link': [{'src': 'i3', 'dst': 'home/.i3'}]})
+        self.write('company', 'unused', {'link': 'broken'})
+        self.write('personal', 'base', {'extends': ['base'],
+            'link': [{'src': 'vimrc', 'dst': 'home/.vimrc'}]})
+        self.write('personal', 'laptop', {'extends': ['desktop']})
+        for name in ('company/bashrc', 'company/i3', 'personal/vimrc'):
+            pathlib.Path(name).write_text(name)
+        os.chdir('personal')
+        self.dotdirs = ['-d', 'dotref', '-d', '../company/dotref']
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, repo, name, profile):
+        pathlib.Path(self.tmpdir, repo, 'dotref', f'{name}.json').write_text(json.dumps(profile))
+
+    def test_resolution(self):
+        run_dotref('init', '-p', 'laptop', *self.dotdirs)
+        self.assertEqual(run_dotref('sync', *self.dotdirs)[0], 0)
+        self.assertTrue(pathlib.Path('dotref/.dotref.json').is_file())
+
+        # The personal "base" extends the company one, lower layer sources are relative to their repository
+        self.assertEqual(os.readlink('home/.i3'), os.path.join(self.tmpdir, 'company/i3'))
+        self.assertEqual(os.readlink('home/.bashrc'), os.path.join(self.tmpdir, 'company/bashrc'))
+        self.assertEqual(os.readlink('home/.vimrc'), os.path.join(self.tmpdir, 'personal/vimrc'))
+
+        profiles = dotref.ProfileSet([pathlib.Path('dotref'), pathlib.Path('../company/dotref')],
+            pathlib.Path('dotref/.dotref.json'))
+        self.assertEqual(list(profiles), ['base', 'desktop', 'laptop', 'unused'])
+        self.assertEqual([str(p.filename) for p in profiles['laptop'].ancestors()], ['dotref/laptop.json',
+            '../company/dotref/desktop.json', 'dotref/base.json', '../company/dotref/base.json'])
+        self.assertRaises(dotref.ProfileError, profiles.__getitem__, 'unused')
+
+    def test_cycle_across_layers(self):
+        self.write('company', 'base', {'extends': ['laptop']})
+        run_dotref('init', '-p', 'laptop', *self.dotdirs)
+        code, _ = run_dotref('sync', *self.dotdirs)
+        self.assertEqual(code, 1)
+
+    def test_cached_index(self):
+        run_dotref('init', '-p', 'laptop', *self.dotdirs)
+        run_dotref('status', *self.dotdirs)
+        with mock.patch.object(dotref.ProfileIndex, '_ProfileIndex__scan', side_effect=AssertionError):
+            self.assertEqual(run_dotref('status', *self.dotdirs)[0], 0)
+
+        self.write('company', 'server', {})
+        mtime = os.stat('../company/dotref').st_mtime_ns + 1
+        os.utime('../company/dotref', ns=(mtime, mtime))
+        with mock.patch.object(dotref.ProfileIndex, '_ProfileIndex__scan', return_value={}) as scan:
+            run_dotref('status', *self.dotdirs)
+        self.assertEqual(scan.call_count, 1)
+
+    def test_quick_status_shadowing(self):
+        run_dotref('init', '-p', 'laptop', *self.dotdirs)
+        run_dotref('sync', *self.dotdirs)
+        self.assertEqual(run_dotref('status', '--quiet', *self.dotdirs), (0, ''))
+
+        self.write('personal', 'desktop', {})
+        mtime = os.stat('dotref').st_mtime_ns + 1
+        os.utime('dotref', ns=(mtime, mtime))
+        self.assertEqual(run_dotref('status', '--quiet', *self.dotdirs), (1, ''))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,9 @@
+import os
 import pathlib
 import tempfile
 import shutil
-from unittest import TestCase, main
-from dotref import LinkAction, ActionState, ActionType
+from unittest import TestCase, main, mock
+from dotref import LinkAction, ActionState, ActionType, ApplyContext, TreeCache
 
 
 class TestLink(TestCase):
@@ -73,6 +74,59 @@ class TestLink(TestCase):
 
         self.apply(src, dst)
 
+    def test_invalid(self):
+        self.assertRaises(TypeError, LinkAction, 'foo', {'src': 'a', 'dst': 'b', 'recursive': 'yes'})
+        self.assertRaises(TypeError, LinkAction, 'foo', {'src': 'a*/b', 'dst': 'b'})
+
+    def test_pattern(self):
+        src_dir = pathlib.Path(self.tmpdir) / 'scripts'
+        dst_dir = pathlib.Path(self.tmpdir) / 'bin'
+        src_dir.mkdir()
+        for name in ('a.sh', 'b.sh', 'c.txt', '.hidden.sh'):
+            (src_dir / name).write_text(name)
+
+        action = LinkAction('foo', {'src': str(src_dir / '*.sh'), 'dst': str(dst_dir)})
+        ctx = ApplyContext()
+        self.assertEqual([(r.state, r.right.name) for r in action.results(ActionType.STATUS, ctx)],
+                [(ActionState.MISSING, 'a.sh'), (ActionState.MISSING, 'b.sh')])
+
+        self.assertEqual([r.state for r in action.results(ActionType.SYNC, ctx)], [ActionState.LINKED] * 2)
+        self.assertTrue((dst_dir / 'a.sh').samefile(src_dir / 'a.sh'))
+        self.assertFalse((dst_dir / 'c.txt').exists())
+
+        self.assertEqual([r.state for r in action.results(ActionType.STATUS, ctx)], [ActionState.OK] * 2)
+        results = action.results(ActionType.UNLINK, ctx)
+        self.assertEqual([r.state for r in results], [ActionState.UNLINKED] * 2)
+        self.assertEqual(os.listdir(dst_dir), [])
+
+    def test_recursive(self):
+        src_dir = pathlib.Path(self.tmpdir) / 'nvim'
+        dst_dir = pathlib.Path(self.tmpdir) / 'config' / 'nvim'
+        (src_dir / 'lua' / 'plugins').mkdir(parents=True)
+        for name in ('init.lua', 'lua/opts.lua', 'lua/plugins/a.lua'):
+            (src_dir / name).write_text(name)
+
+        action = LinkAction('foo', {'src': str(src_dir), 'dst': str(dst_dir), 'recursive': True})
+        tree_file = pathlib.Path(self.tmpdir) / 'tree.json'
+        ctx = ApplyContext(tree=TreeCache(tree_file))
+        results = action.results(ActionType.SYNC, ctx)
+        self.assertEqual([(r.state, str(r.right.relative_to(dst_dir))) for r in results],
+                [(ActionState.LINKED, 'init.lua'), (ActionState.LINKED, 'lua/opts.lua'),
+                (ActionState.LINKED, 'lua/plugins/a.lua')])
+        self.assertFalse((dst_dir / 'lua').is_symlink())
+        self.assertTrue((dst_dir / 'lua/plugins/a.lua').samefile(src_dir / 'lua/plugins/a.lua'))
+        ctx.tree.save()
+
+        with mock.patch('os.scandir', wraps=os.scandir) as scandir:
+            results = action.results(ActionType.STATUS, ApplyContext(tree=TreeCache(tree_file)))
+            self.assertEqual([r.state for r in results], [ActionState.OK] * 3)
+            scanned = [str(c.args[0]) for c in scandir.call_args_list]
+            self.assertNotIn(os.path.abspath(src_dir), scanned)
+
+        (src_dir / 'new.lua').write_text('new')
+        results = action.results(ActionType.STATUS, ApplyContext(tree=TreeCache(tree_file)))
+        self.assertEqual(len(results), 4)
+
     def test_apply_conflict(self):
         src = pathlib.Path(self.tmpdir) / 'src.file'
         dst = pathlib.Path(self.tmpdir) / 'dst.file'
@@ -0,0 +1,81 @@
+import os
+import pathlib
+import tempfile
+import shutil
+from dotref import Metrics
+from tests import run_dotref
+from unittest import TestCase, main
+
+
+class TestMetrics(TestCase):
+
+    profile = """
+    {
+        "vars": { "name": "world" },
+        "link": [ { "src": "src", "dst": "dst" }, { "src": "src", "dst": "conflict" } ],
+        "template": [ { "src": "test.tpl", "dst": "test.txt" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('dotref/test.json').write_text(self.profile)
+        pathlib.Path('src').write_text('src')
+        pathlib.Path('conflict').write_text('conflict')
+        pathlib.Path('test.tpl').write_text('Hello $name')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def read_metrics(self):
+        samples = {}
+        for line in pathlib.Path('dotref.prom').read_text().splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    @staticmethod
+    def entries(samples, command, kind, state):
+        return samples[f'dotref_entries{{command="{command}",profile="test",kind="{kind}",state="{state}"}}']
+
+    def test_metrics_file(self):
+        run_dotref('init', '-p', 'test')
+        run_dotref('status', '--metrics-file', 'dotref.prom')
+        samples = self.read_metrics()
+        self.assertEqual(self.entries(samples, 'status', 'link', 'MISSING'), 1)
+        self.assertEqual(self.entries(samples, 'status', 'link', 'CONFLICT'), 1)
+        self.assertEqual(self.entries(samples, 'status', 'link', 'LINKED'), 0)
+        self.assertEqual(samples['dotref_rendered_bytes'], 0)
+        self.assertIn('dotref_phase_duration_seconds{phase="load"}', samples)
+        self.assertIn('dotref_phase_duration_seconds{phase="merge"}', samples)
+        self.assertIn('dotref_phase_duration_seconds{phase="apply"}', samples)
+
+        run_dotref('sync', '--metrics-file', 'dotref.prom')
+        samples = self.read_metrics()
+        self.assertEqual(self.entries(samples, 'sync', 'link', 'LINKED'), 1)
+        self.assertEqual(self.entries(samples, 'sync', 'template', 'RENDERED'), 1)
+        self.assertEqual(samples['dotref_rendered_bytes'], len('Hello world'))
+        self.assertEqual(samples['dotref_in_sync{command="sync",profile="test"}'], 0)
+        self.assertGreater(samples['dotref_fs_operations{op="lstat"}'], 0)
+        self.assertEqual(samples['dotref_fs_operations{op="symlink"}'], 1)
+        self.assertEqual([f for f in os.listdir('.') if f.endswith('.tmp')], [])
+        self.assertEqual(os.stat('dotref.prom').st_mode & 0o777, 0o644)
+
+        os.unlink('conflict')
+        run_dotref('sync')
+        run_dotref('status', '--quiet', '--metrics-file', 'dotref.prom')
+        samples = self.read_metrics()
+        self.assertEqual(samples['dotref_in_sync{command="status",profile="test"}'], 1)
+        self.assertIn('dotref_phase_duration_seconds{phase="fingerprint"}', samples)
+
+    def test_escape(self):
+        self.assertEqual(Metrics.escape('a"b\\c\nd'), 'a\\"b\\\\c\\nd')
+
+
+if __name__ == '__main__':
+    main()
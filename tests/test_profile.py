@@ -94,6 +94,80 @@ class TestProfile(TestCase):
         self.assertEqual(p.template[0].src, 'tpl')
         self.assertEqual(p.template[0].dst, 'bar')
 
+    def test_merged_shares_entries(self):
+        fname_root = pathlib.Path(self.tmpdir, 'root.json')
+        fname_child = pathlib.Path(self.tmpdir, 'child.json')
+        self.writeFile(fname_root, '{"link": [{"src": "a", "dst": "b"}], "vars": {"x": "root"}}')
+        self.writeFile(fname_child, '{"link": [{"src": "a", "dst": "b"}, {"src": "c", "dst": "d"}], \
+                "vars": {"x": "child", "y": "child"}}')
+
+        prof_child = Profile(fname_child)
+        prof_root = Profile(fname_root)
+        prof_root.parents = [prof_child]
+
+        merged = prof_root.merged()
+        self.assertEqual([(v.name, v.value) for v in merged.vars], [('x', 'root'), ('y', 'child')])
+        self.assertEqual([(link.src, link.dst) for link in merged.link], [('a', 'b'), ('c', 'd')])
+        self.assertIs(merged.link[0], prof_root.link[0])
+        self.assertIs(merged.link[1], prof_child.link[1])
+        self.assertEqual(len(prof_root.link), 1)
+        self.assertFalse(hasattr(merged.link[0], '__dict__'))
+
+    def create_profiles(self, extends):
+        profiles = {}
+        for name in extends:
+            fname = pathlib.Path(self.tmpdir, f'{name}.json')
+            self.writeFile(fname, f'{{"vars": {{"{name}": "{name}", "x": "{name}"}}}}')
+            profiles[name] = Profile(fname)
+        for name, parents in extends.items():
+            profiles[name].parents = [profiles[p] for p in parents]
+        return profiles
+
+    def test_diamond(self):
+        profiles = self.create_profiles({'root': ['a', 'b'], 'a': ['base'], 'b': ['base', 'c'],
+                'base': [], 'c': []})
+        self.assertEqual([p.name for p in profiles['root'].ancestors()], ['root', 'a', 'base', 'b', 'c'])
+        self.assertEqual([(v.name, v.value) for v in profiles['b'].merged().vars],
+                [('b', 'b'), ('x', 'b'), ('base', 'base'), ('c', 'c')])
+        self.assertIs(profiles['root'].ancestors()[2], profiles['a'].ancestors()[1])
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            Logger().print_tree(profiles['root'], lambda p: p.name, lambda p: p.parents)
+        self.assertEqual(stdout.getvalue(), """root
++-- a
+|   +-- base
++-- b
+    +-- base
+    +-- c
+""")
+
+    def test_inheritance_cycle(self):
+        profiles = self.create_profiles({'root': ['a'], 'a': ['b'], 'b': ['a']})
+        with self.assertRaises(ProfileError) as e:
+            Profile.resolve(profiles.values())
+        self.assertEqual(str(e.exception), 'Profile "a" inherits from itself: a -> b -> a')
+
+        profiles = self.create_profiles({'root': ['root']})
+        with self.assertRaises(ProfileError) as e:
+            profiles['root'].merged()
+        self.assertEqual(str(e.exception), 'Profile "root" inherits from itself: root -> root')
+
+    def test_deep_chain(self):
+        depth = 1000
+        profiles = self.create_profiles({f'p{i}': [f'p{i + 1}'] if i < depth - 1 else []
+                for i in range(depth)})
+        Profile.resolve(profiles.values())
+
+        merged = profiles['p0'].merged()
+        self.assertEqual(len(merged.vars), depth + 1)
+        self.assertEqual(merged.vars[1].value, 'p0')
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            Logger().print_tree(profiles['p0'], lambda p: p.name, lambda p: p.parents)
+        self.assertEqual(len(stdout.getvalue().splitlines()), depth)
+
     @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
     def test_pretty_print(self):
         fname_root = pathlib.Path(self.tmpdir, 'root.json')
@@ -0,0 +1,90 @@
+import os
+import io
+import sys
+import contextlib
+import pathlib
+import tempfile
+import shutil
+import dotref
+from unittest import TestCase, main, mock
+
+
+class TestPush(TestCase):
+
+    profile = """
+    {
+        "vars": { "name": "remote" },
+        "create": [ { "name": "~/config", "mode": "700" } ],
+        "link": [ { "src": "bashrc", "dst": "~/.bashrc" }, { "src": "scripts", "dst": "~/bin" } ],
+        "template": [ { "src": "test.tpl", "dst": "~/config/test.txt" } ]
+    }
+    """
+
+    fake_ssh = """#!/bin/sh
+export HOME="$FAKE_SSH_HOMES/$1"
+mkdir -p "$HOME"
+cd "$HOME"
+shift
+exec sh -c "$1"
+"""
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('dotref/desktop.json').write_text(self.profile)
+        pathlib.Path('bashrc').write_text('bashrc')
+        pathlib.Path('scripts').mkdir()
+        pathlib.Path('scripts/hello').write_text('hello')
+        pathlib.Path('test.tpl').write_text('Hello $name')
+
+        self.ssh = self.tmpdir / 'fake_ssh'
+        self.ssh.write_text(self.fake_ssh)
+        self.ssh.chmod(0o755)
+        self.homes = self.tmpdir / 'homes'
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def push(self, hosts):
+        stdout = io.StringIO()
+        argv = ['dotref', 'push'] + hosts + ['-p', 'desktop', '--ssh', str(self.ssh)]
+        env = {'FAKE_SSH_HOMES': str(self.homes), 'NO_COLOR': '1'}
+        with mock.patch.object(sys, 'argv', argv), mock.patch.dict(os.environ, env):
+            with contextlib.redirect_stdout(stdout):
+                dotref.main()
+        return stdout.getvalue()
+
+    def test_push(self):
+        output = self.push(['alpha', 'beta'])
+        self.assertIn('Host: alpha\n\nCreate:\n    [CREATED]  ~/config', output)
+        self.assertIn('Host: beta', output)
+        self.assertIn('[LINKED]   ./bashrc   ->  ~/.bashrc', output)
+        self.assertIn('[RENDERED] ./test.tpl  ->  ~/config/test.txt', output)
+
+        for host in ('alpha', 'beta'):
+            home = self.homes / host
+            self.assertEqual((home / 'config' / 'test.txt').read_text(), 'Hello remote')
+            self.assertEqual((home / 'config').stat().st_mode & 0o777, 0o700)
+            self.assertTrue((home / '.bashrc').is_symlink())
+            self.assertEqual((home / '.bashrc').read_text(), 'bashrc')
+            self.assertEqual((home / 'bin' / 'hello').read_text(), 'hello')
+
+        pathlib.Path('test.tpl').write_text('Hello again $name')
+        output = self.push(['alpha'])
+        self.assertIn('[OK]       ./bashrc', output)
+        self.assertIn('[RENDERED] ./test.tpl', output)
+        self.assertEqual((self.homes / 'alpha' / 'config' / 'test.txt').read_text(), 'Hello again remote')
+
+    def test_push_failure(self):
+        self.ssh.write_text('#!/bin/sh\necho "connection refused" >&2\nexit 255\n')
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(io.StringIO()) as stderr:
+            self.push(['alpha'])
+        self.assertIn('connection refused', stderr.getvalue())
+
+
+if __name__ == '__main__':
+    main()
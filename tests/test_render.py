@@ -0,0 +1,98 @@
+import os
+import io
+import contextlib
+import pathlib
+import tempfile
+import shutil
+import concurrent.futures
+from unittest import TestCase, main, mock
+import dotref
+from dotref import (Profile, Logger, ActionType, ActionState, ApplyContext, AsyncEngine, TemplateRenderer,
+        TemplateVarError, OsFileSystem, LatencyFileSystem)
+from tests import run_dotref
+
+
+class TestTemplateRenderer(TestCase):
+
+    profile = """
+    {
+        "vars": {
+            "name": "world",
+            "greeting": { "command": "echo Hello" },
+            "unused": { "command": "exit 1" }
+        },
+        "template": [
+            { "src": "tpl0", "dst": "out0" },
+            { "src": "tpl1", "dst": "out1" },
+            { "src": "tpl2", "dst": "out2" }
+        ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('test.json').write_text(self.profile)
+        pathlib.Path('tpl0').write_text('$name\n' * 1000)
+        pathlib.Path('tpl1').write_text('$greeting $name\n')
+        pathlib.Path('tpl2').write_text('plain\n')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_profile(self, command, renderer, engine=None, fs=None):
+        with contextlib.redirect_stdout(io.StringIO()):
+            pipeline = Profile(pathlib.Path('test.json')).action(command, Logger(),
+                    ctx=ApplyContext(engine=engine, renderer=renderer, fs=fs))
+        return [state for (_, state), count in sorted(pipeline.counter.counts.items()) for _ in range(count)]
+
+    def test_process_pool(self):
+        for engine in (None, AsyncEngine(2)):
+            for name in ('out0', 'out1', 'out2'):
+                if os.path.exists(name):
+                    os.unlink(name)
+            with mock.patch.object(concurrent.futures, 'ProcessPoolExecutor',
+                    wraps=concurrent.futures.ProcessPoolExecutor) as pool:
+                self.assertEqual(self.run_profile(ActionType.SYNC, TemplateRenderer(2, 0), engine),
+                    [ActionState.RENDERED] * 3)
+            pool.assert_called_once_with(2)
+            self.assertEqual(pathlib.Path('out0').read_text(), 'world\n' * 1000)
+            self.assertEqual(pathlib.Path('out1').read_text(), 'Hello world\n')
+            self.assertEqual(pathlib.Path('out2').read_text(), 'plain\n')
+
+        self.assertEqual(self.run_profile(ActionType.STATUS, TemplateRenderer(2, 0)), [ActionState.OK] * 3)
+
+    def test_missing_variable(self):
+        pathlib.Path('tpl2').write_text('$missing\n')
+        with self.assertRaises(TemplateVarError):
+            self.run_profile(ActionType.SYNC, TemplateRenderer(2, 0))
+        self.assertEqual(pathlib.Path('out1').read_text(), 'Hello world\n')
+        self.assertFalse(os.path.exists('out2'))
+
+    def test_small_profiles_stay_in_process(self):
+        with mock.patch.object(concurrent.futures, 'ProcessPoolExecutor', side_effect=AssertionError):
+            self.assertEqual(self.run_profile(ActionType.SYNC, TemplateRenderer(2)),
+                [ActionState.RENDERED] * 3)
+        self.assertEqual(pathlib.Path('out1').read_text(), 'Hello world\n')
+
+    def test_no_extra_file_system_calls(self):
+        counts = []
+        for renderer in (TemplateRenderer(), TemplateRenderer(4)):
+            fs = LatencyFileSystem(OsFileSystem())
+            self.run_profile(ActionType.STATUS, renderer, fs=fs)
+            counts.append(fs.counts)
+        self.assertEqual(counts[0], counts[1])
+
+    def test_jobs(self):
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('test.json').rename('dotref/test.json')
+        run_dotref('init', '-p', 'test')
+        with mock.patch.object(dotref, 'TemplateRenderer', wraps=TemplateRenderer) as renderer:
+            run_dotref('sync', '-j', '3')
+        renderer.assert_called_once_with(3)
+
+
+if __name__ == '__main__':
+    main()
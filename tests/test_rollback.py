@@ -0,0 +1,84 @@
+import os
+import json
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main
+from dotref import (Journal, ApplyContext, CreateAction, LinkAction, TemplateAction, ActionState,
+        ActionType)
+from tests import run_dotref
+
+
+class TestRollback(TestCase):
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.statedir = self.tmpdir / 'state'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_nothing_to_rollback(self):
+        self.assertRaises(ValueError, Journal(self.statedir).rollback)
+
+    def test_rollback(self):
+        src = self.tmpdir / 'src'
+        tpl = self.tmpdir / 'src.tpl'
+        src.write_text('hello')
+        tpl.write_text('Hello $foo')
+
+        created = self.tmpdir / 'a' / 'b'
+        link = self.tmpdir / 'link'
+        rendered = self.tmpdir / 'rendered'
+        rendered.write_text('Original')
+        os.chmod(rendered, 0o600)
+
+        create = CreateAction('foo', {'name': str(created)})
+        link_action = LinkAction('foo', {'src': str(src), 'dst': str(link)})
+        template = TemplateAction('foo', {'src': str(tpl), 'dst': str(rendered)})
+
+        journal = Journal(self.statedir)
+        ctx = ApplyContext(journal=journal)
+        self.assertEqual(create.apply(ActionType.SYNC, ctx)[0], ActionState.CREATED)
+        self.assertEqual(link_action.apply(ActionType.SYNC, ctx)[0], ActionState.LINKED)
+        self.assertEqual(template.apply(ActionType.SYNC, {'foo': 'bar'}, ctx)[0], ActionState.RENDERED)
+        self.assertEqual(journal.commit(), 1)
+
+        journal = Journal(self.statedir)
+        ctx = ApplyContext(journal=journal)
+        self.assertEqual(template.apply(ActionType.SYNC, {'foo': 'baz'}, ctx)[0], ActionState.RENDERED)
+        self.assertEqual(link_action.apply(ActionType.SYNC, ctx)[0], ActionState.OK)
+        self.assertEqual(journal.commit(), 2)
+        self.assertEqual(len(journal.entries), 1)
+
+        results = Journal(self.statedir).rollback()
+        self.assertEqual([r[0] for r in results], [ActionState.RESTORED])
+        self.assertEqual(rendered.read_text(), 'Hello bar')
+
+        Journal(self.statedir).rollback()
+        self.assertEqual(rendered.read_text(), 'Original')
+        self.assertEqual(rendered.stat().st_mode & 0o777, 0o600)
+        self.assertFalse(os.path.lexists(link))
+        self.assertFalse((self.tmpdir / 'a').exists())
+        self.assertEqual(Journal(self.statedir).generations(), [])
+
+    def test_unwritable_journal(self):
+        cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        self.addCleanup(os.chdir, cwd)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('src').write_text('src')
+        pathlib.Path('dotref/test.json').write_text(json.dumps({'link': [{'src': 'src', 'dst': 'dst'}]}))
+        run_dotref('init', '-p', 'test')
+        # Stands in for a read-only or shared state directory, permissions don't stop root
+        pathlib.Path('dotref/.dotref.d').mkdir(exist_ok=True)
+        pathlib.Path('dotref/.dotref.d/generations').write_text('')
+
+        code, output = run_dotref('sync')
+        self.assertEqual(code, 0)
+        self.assertIn('this sync can\'t be rolled back', output)
+        self.assertTrue(os.path.islink('dst'))
+
+
+if __name__ == '__main__':
+    main()
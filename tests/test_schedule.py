@@ -0,0 +1,103 @@
+import os
+import json
+import pathlib
+import tempfile
+import shutil
+import dotref
+from tests import run_dotref
+from unittest import TestCase, main, mock
+
+
+class TestSchedule(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('home').mkdir()
+        pathlib.Path('src').write_text('src')
+        pathlib.Path('dotref/test.json').write_text(json.dumps({'link': [{'src': 'src', 'dst': 'home/dst'}]}))
+        self.schedule = dotref.Schedule(pathlib.Path('state'), 600, 'host')
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_delay(self):
+        delays = [self.schedule.delay(f'host{i}') for i in range(1000)]
+        self.assertEqual(delays, [self.schedule.delay(f'host{i}') for i in range(1000)])
+        self.assertTrue(all(0 <= d < 600 for d in delays))
+        # Hosts are spread over the whole window
+        self.assertEqual(len({int(d // 60) for d in delays}), 10)
+        self.assertEqual(dotref.Schedule(pathlib.Path('state'), 0).delay('host'), 0)
+
+    def test_backoff_after_failures(self):
+        skipped = []
+        for ok in (False, False, False, True, True, True):
+            self.schedule.record(1, ok)
+            skipped.append(0)
+            while not self.schedule.due():
+                skipped[-1] += 1
+        # Successful runs still skip one run while most of the recent runs failed
+        self.assertEqual(skipped, [1, 3, 7, 1, 1, 0])
+        self.assertEqual(len(self.schedule.runs), 6)
+
+    def test_hosts(self):
+        other = dotref.Schedule(pathlib.Path('state'), 600, 'other')
+        self.assertEqual(self.schedule.delay(), self.schedule.delay('host'))
+        self.assertNotEqual(self.schedule.filename, other.filename)
+        for _ in range(3):
+            self.schedule.record(1, False)
+        other.record(1, True)
+        self.assertFalse(self.schedule.due())
+        self.assertTrue(other.due())
+        self.assertEqual(other.runs, [(1, True)])
+
+    def test_backoff_after_slow_run(self):
+        for duration in (1, 1.2, 0.9, 5):
+            self.assertTrue(self.schedule.due())
+            self.schedule.record(duration, True)
+        self.assertFalse(self.schedule.due())
+        self.assertTrue(self.schedule.due())
+
+    def test_sync(self):
+        run_dotref('init', '-p', 'test')
+        with mock.patch.object(dotref.time, 'sleep') as sleep:
+            code, out = run_dotref('sync', '--schedule', '--splay', '60')
+        self.assertEqual(code, 0)
+        self.assertTrue(0 <= sleep.call_args[0][0] < 60)
+        self.assertTrue(os.path.islink('home/dst'))
+
+        code, out = run_dotref('sync', '--schedule', '--splay', '0')
+        self.assertIn('nothing changed since the last one', out)
+
+        os.unlink('home/dst')
+        code, out = run_dotref('sync', '--schedule', '--splay', '0')
+        self.assertNotIn('Skipping', out)
+        self.assertTrue(os.path.islink('home/dst'))
+
+        self.assertEqual(run_dotref('status', '--schedule')[0], 2)
+
+    def test_sync_keeps_running_after_conflict(self):
+        run_dotref('init', '-p', 'test')
+        pathlib.Path('home/dst').write_text('conflict')
+        for _ in range(3):
+            code, out = run_dotref('sync', '--schedule', '--splay', '0')
+            self.assertIn('CONFLICT', out)
+            self.assertNotIn('backing off', out)
+
+    def test_sync_backs_off_after_failure(self):
+        hooks = [{'name': 'fail', 'command': 'exit 1', 'when': 'pre'}]
+        pathlib.Path('dotref/test.json').write_text(json.dumps({'hooks': hooks}))
+        run_dotref('init', '-p', 'test')
+        code, out = run_dotref('sync', '--schedule', '--splay', '0')
+        self.assertIn('FAILED', out)
+        code, out = run_dotref('sync', '--schedule', '--splay', '0')
+        self.assertIn('backing off', out)
+        code, out = run_dotref('sync', '--schedule', '--splay', '0')
+        self.assertIn('FAILED', out)
+
+
+if __name__ == '__main__':
+    main()
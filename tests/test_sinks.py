@@ -0,0 +1,83 @@
+import os
+import io
+import json
+import contextlib
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main, mock
+from dotref import (Profile, Logger, ActionType, ActionState, ApplyContext, AsyncEngine, JsonlSink,
+        FailFastSink, ConflictError)
+
+
+class TestSinks(TestCase):
+
+    profile = """
+    {
+        "link": [
+            { "src": "src1", "dst": "dst1" },
+            { "src": "src2", "dst": "dst2" },
+            { "src": "src3", "dst": "dst3" }
+        ],
+        "template": [ { "src": "src1", "dst": "tpl1" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        for name in ('src1', 'src2', 'src3'):
+            pathlib.Path(name).write_text(name)
+        pathlib.Path('dst2').write_text('conflict')
+        pathlib.Path('test.json').write_text(self.profile)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    def run_profile(self, *sinks, engine=None):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            pipeline = Profile(pathlib.Path('test.json')).action(ActionType.SYNC, Logger(),
+                    ctx=ApplyContext(engine=engine, sinks=list(sinks)))
+        return pipeline, stdout.getvalue()
+
+    def test_counts(self):
+        pipeline, _ = self.run_profile()
+        self.assertTrue(pipeline.has_conflicts)
+        self.assertEqual(pipeline.counter.counts[('link', ActionState.LINKED)], 2)
+        self.assertEqual(pipeline.counter.counts[('link', ActionState.CONFLICT)], 1)
+        self.assertEqual(pipeline.counter.counts[('template', ActionState.RENDERED)], 1)
+
+    def test_jsonl(self):
+        self.run_profile(JsonlSink('results.jsonl'))
+        lines = [json.loads(line) for line in pathlib.Path('results.jsonl').read_text().splitlines()]
+        self.assertEqual([(r['kind'], r['state'], r['dst']) for r in lines], [
+            ('link', 'LINKED', 'dst1'),
+            ('link', 'CONFLICT', 'dst2'),
+            ('link', 'LINKED', 'dst3'),
+            ('template', 'RENDERED', 'tpl1'),
+        ])
+        self.assertTrue(all(r['profile'] == 'test' and r['command'] == 'sync' for r in lines))
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_fail_fast(self):
+        for engine in (None, AsyncEngine(2)):
+            for name in ('dst1', 'dst3'):
+                if os.path.lexists(name):
+                    os.unlink(name)
+            stdout = io.StringIO()
+            with contextlib.redirect_stdout(stdout), self.assertRaises(ConflictError):
+                Profile(pathlib.Path('test.json')).action(ActionType.SYNC, Logger(),
+                        ctx=ApplyContext(engine=engine, sinks=[JsonlSink('results.jsonl'), FailFastSink()]))
+
+            self.assertTrue(stdout.getvalue().startswith('Profile: test\n\nLink:\n'))
+            self.assertIn('[CONFLICT]', stdout.getvalue())
+            self.assertNotIn('Template:', stdout.getvalue())
+            self.assertFalse(os.path.exists('tpl1'))
+            self.assertEqual(len(pathlib.Path('results.jsonl').read_text().splitlines()), 2)
+
+
+if __name__ == '__main__':
+    main()
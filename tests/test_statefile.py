@@ -1,8 +1,10 @@
+import os
+import fcntl
 import pathlib
 import tempfile
 import shutil
 import json
-from unittest import TestCase, main
+from unittest import TestCase, main, mock
 from dotref import StateFile
 
 
@@ -40,6 +42,53 @@ class TestStateFile(TestCase):
         with open(path, 'r') as f:
             self.assertEqual(f.read(), '{"profile": "bar"}')
 
+        self.assertEqual(os.listdir(self.tmpdir), ['valid.json'])
+
+    def test_lock(self):
+        sf = StateFile(pathlib.Path(self.tmpdir) / 'state.json')
+
+        def try_lock(operation):
+            with open(sf.lockfile, 'a') as f:
+                try:
+                    fcntl.flock(f.fileno(), operation | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+                return True
+
+        with sf.lock():
+            self.assertTrue(try_lock(fcntl.LOCK_SH))
+            self.assertFalse(try_lock(fcntl.LOCK_EX))
+
+        with sf.lock(exclusive=True):
+            self.assertFalse(try_lock(fcntl.LOCK_SH))
+
+        self.assertTrue(try_lock(fcntl.LOCK_EX))
+
+    def test_lock_without_write_access(self):
+        sf = StateFile(pathlib.Path(self.tmpdir) / 'missing' / 'state.json')
+        with sf.lock():
+            pass
+        with self.assertRaisesRegex(OSError, 'needs write access'):
+            with sf.lock(exclusive=True):
+                pass
+
+    def test_mode(self):
+        path = pathlib.Path(self.tmpdir) / 'state.json'
+        sf = StateFile(path)
+        sf.profile = 'foo'
+        umask = os.umask(0o022)
+        try:
+            with mock.patch('dotref.UMASK', 0o022):
+                sf.save()
+        finally:
+            os.umask(umask)
+        self.assertEqual(path.stat().st_mode & 0o777, 0o644)
+
+        path.chmod(0o600)
+        sf.save()
+        self.assertEqual(path.stat().st_mode & 0o777, 0o600)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,111 @@
+import os
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main, mock
+from dotref import file_equals, ObjectStore, ApplyContext, TemplateAction, ActionState, ActionType
+
+
+class TestStore(TestCase):
+
+    def setUp(self):
+        self.tmpdir = pathlib.Path(tempfile.mkdtemp())
+        self.store = ObjectStore(self.tmpdir / 'objects')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def linked(self, path, data):
+        obj = self.store.object_path(ObjectStore.digest(data))
+        return obj.exists() and os.path.samefile(path, obj) and file_equals(path, data)
+
+    def test_put_link(self):
+        digest = self.store.put(b'hello')
+        self.assertEqual(digest, ObjectStore.digest(b'hello'))
+        self.assertEqual(self.store.put(b'hello'), digest)
+
+        dst = self.tmpdir / 'dst'
+        self.store.link(digest, dst)
+        self.assertTrue(self.linked(dst, b'hello'))
+        self.assertEqual(dst.stat().st_mode & 0o777, 0o444)
+        self.assertEqual(dst.read_bytes(), b'hello')
+
+        other = self.tmpdir / 'other'
+        other.write_bytes(b'hello')
+        self.assertFalse(self.linked(other, b'hello'))
+        self.assertTrue(file_equals(other, b"hello"))
+
+    def test_template(self):
+        vars = {'foo': 'bar'}
+        src = self.tmpdir / 'src.tpl'
+        dst = self.tmpdir / 'dst'
+        src.write_text('Hello $foo')
+
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst)})
+        state, _, _ = action.apply(ActionType.SYNC, vars, ApplyContext(self.store))
+        self.assertEqual(state, ActionState.RENDERED)
+        self.assertEqual(dst.read_text(), 'Hello bar')
+        self.assertTrue(self.linked(dst, b'Hello bar'))
+
+        state, _, _ = action.apply(ActionType.STATUS, vars, ApplyContext(self.store))
+        self.assertEqual(state, ActionState.OK)
+
+        state, _, _ = action.apply(ActionType.STATUS, {'foo': 'baz'}, ApplyContext(self.store))
+        self.assertEqual(state, ActionState.DIFFERS)
+
+        state, _, _ = action.apply(ActionType.SYNC, {'foo': 'baz'}, ApplyContext(self.store))
+        self.assertEqual(state, ActionState.RENDERED)
+        self.assertEqual(dst.read_text(), 'Hello baz')
+        self.assertEqual(self.store.object_path(ObjectStore.digest(b'Hello bar')).read_text(), 'Hello bar')
+
+        state, _, _ = action.apply(ActionType.UNLINK, {'foo': 'baz'}, ApplyContext(self.store))
+        self.assertEqual(state, ActionState.UNLINKED)
+        self.assertFalse(dst.exists())
+
+    def test_modified_in_place(self):
+        src = self.tmpdir / 'src.tpl'
+        src.write_text('Hello')
+        actions = [TemplateAction('foo', {'src': str(src), 'dst': str(self.tmpdir / name)})
+            for name in ('a', 'b')]
+        for action in actions:
+            action.apply(ActionType.SYNC, {}, ApplyContext(self.store))
+
+        # Only possible after a chmod or as root, the shared object changes with it
+        a = self.tmpdir / 'a'
+        a.chmod(0o644)
+        with open(a, 'ab') as f:
+            f.write(b'!')
+        self.assertFalse(self.linked(a, b'Hello'))
+        self.assertEqual([a.apply(ActionType.STATUS, {}, ApplyContext(self.store))[0] for a in actions],
+            [ActionState.DIFFERS] * 2)
+
+        for action in actions:
+            action.apply(ActionType.SYNC, {}, ApplyContext(self.store))
+        self.assertEqual((self.tmpdir / 'b').read_bytes(), b'Hello')
+        self.assertTrue(self.linked(self.tmpdir / 'a', b'Hello'))
+
+    def test_mode(self):
+        src = self.tmpdir / 'src.tpl'
+        dst = self.tmpdir / 'netrc'
+        src.write_text('machine $host')
+        dst.write_text('old')
+        dst.chmod(0o600)
+
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst)})
+        for host in ('a', 'b'):
+            state, _, _ = action.apply(ActionType.SYNC, {'host': host}, ApplyContext(self.store))
+            self.assertEqual(state, ActionState.RENDERED)
+            self.assertEqual(dst.read_text(), f'machine {host}')
+            self.assertEqual(dst.stat().st_mode & 0o777, 0o600)
+            self.assertFalse(self.linked(dst, f'machine {host}'.encode()))
+
+        umask = os.umask(0o077)
+        self.addCleanup(os.umask, umask)
+        with mock.patch('dotref.UMASK', 0o077):
+            dst.unlink()
+            action.apply(ActionType.SYNC, {'host': 'c'}, ApplyContext(self.store))
+        self.assertEqual(dst.stat().st_mode & 0o777, 0o600)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+import os
+import io
+import json
+import contextlib
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main, mock
+from dotref import Profile, Logger, ActionType
+from tests import run_dotref
+
+
+class TestSwitch(TestCase):
+
+    laptop_profile = """
+    {
+        "vars": { "name": "laptop" },
+        "create": [ { "name": "shared_dir" } ],
+        "link": [ { "src": "shared", "dst": "shared_link" }, { "src": "laptop", "dst": "laptop_link" } ],
+        "template": [ { "src": "test.tpl", "dst": "test.txt" } ]
+    }
+    """
+
+    server_profile = """
+    {
+        "vars": { "name": "server" },
+        "create": [ { "name": "shared_dir" } ],
+        "link": [ { "src": "shared", "dst": "shared_link" }, { "src": "server", "dst": "server_link" } ],
+        "template": [ { "src": "test.tpl", "dst": "test.txt" } ]
+    }
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmpdir)
+        for name in ('shared', 'laptop', 'server'):
+            pathlib.Path(name).write_text(name)
+        pathlib.Path('test.tpl').write_text('Hello $name')
+        pathlib.Path('laptop.json').write_text(self.laptop_profile)
+        pathlib.Path('server.json').write_text(self.server_profile)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.dict(os.environ, {'NO_COLOR': '1'})
+    def test_switch(self):
+        laptop = Profile(pathlib.Path('laptop.json'))
+        server = Profile(pathlib.Path('server.json'))
+
+        log = Logger()
+        with contextlib.redirect_stdout(io.StringIO()):
+            laptop.action(ActionType.SYNC, log)
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            server.switch(laptop, log)
+
+        self.assertEqual(stdout.getvalue(), """Profile: laptop -> server
+
+Removed:
+    [UNLINKED] ./laptop  ->  ./laptop_link
+
+Link:
+    [LINKED]   ./server  ->  ./server_link
+
+Template:
+    [RENDERED] ./test.tpl  ->  ./test.txt
+
+switch completed successfully, 2 shared entries left untouched and no conflicts were detected
+""")
+        self.assertFalse(os.path.lexists('laptop_link'))
+        self.assertTrue(pathlib.Path('server_link').samefile('server'))
+        self.assertTrue(pathlib.Path('shared_link').samefile('shared'))
+        self.assertEqual(pathlib.Path('test.txt').read_text(), 'Hello server')
+
+    def test_rollback_restores_profile(self):
+        pathlib.Path('dotref').mkdir()
+        for name in ('laptop', 'server'):
+            pathlib.Path(f'{name}.json').rename(f'dotref/{name}.json')
+        run_dotref('init', '-p', 'laptop')
+        run_dotref('sync')
+        run_dotref('switch', '-p', 'server')
+        self.assertEqual(json.loads(pathlib.Path('dotref/.dotref.json').read_text())['profile'], 'server')
+
+        code, output = run_dotref('rollback')
+        self.assertIn('Current profile restored to laptop', output)
+        self.assertEqual(json.loads(pathlib.Path('dotref/.dotref.json').read_text())['profile'], 'laptop')
+        self.assertTrue(os.path.islink('laptop_link'))
+        self.assertFalse(os.path.lexists('server_link'))
+        self.assertEqual(run_dotref('status', '--exit-code')[0], 0)
+
+    def test_switch_recursive(self):
+        pathlib.Path('dotref').mkdir()
+        pathlib.Path('tree/sub').mkdir(parents=True)
+        pathlib.Path('tree/a').write_text('a')
+        pathlib.Path('tree/sub/b').write_text('b')
+        for name, recursive in (('flat', False), ('deep', True)):
+            link = {'src': 'tree', 'dst': 'tree_link', 'recursive': recursive}
+            pathlib.Path(f'dotref/{name}.json').write_text(json.dumps({'link': [link]}))
+        run_dotref('init', '-p', 'flat')
+        run_dotref('sync')
+        self.assertTrue(os.path.islink('tree_link'))
+
+        code, output = run_dotref('switch', '-p', 'deep')
+        self.assertIn('0 shared entries left untouched', output)
+        self.assertFalse(os.path.islink('tree_link'))
+        self.assertTrue(os.path.islink('tree_link/a'))
+        self.assertTrue(os.path.islink('tree_link/sub/b'))
+        self.assertEqual(run_dotref('status', '--exit-code')[0], 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
+import os
 import pathlib
 import tempfile
 import shutil
 from unittest import TestCase, main
-from dotref import TemplateAction, ActionState, ActionType, TemplateVarError
+from dotref import (TemplateAction, ActionState, ActionType, TemplateVarError, Variables, Variable,
+        file_equals)
 
 
 class TestTemplate(TestCase):
@@ -70,6 +72,39 @@ class TestTemplate(TestCase):
         self.assertEqual(state, ActionState.UNLINKED)
         self.assertFalse(dst.exists())
 
+    def test_status_read_only(self):
+        vars = {'foo': 'vara'}
+        src = pathlib.Path(self.tmpdir) / 'src.tpl'
+        dst = pathlib.Path(self.tmpdir) / 'dst'
+        with open(src, 'w') as f:
+            f.write('Hello $foo')
+
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst)})
+        state, _, _ = action.apply(ActionType.SYNC, vars)
+        self.assertEqual(state, ActionState.RENDERED)
+        os.chmod(dst, 0o444)
+
+        state, _, _ = action.apply(ActionType.STATUS, vars)
+        self.assertEqual(state, ActionState.OK)
+
+        state, _, _ = action.apply(ActionType.STATUS, {'foo': 'varb'})
+        self.assertEqual(state, ActionState.DIFFERS)
+
+        state, _, _ = action.apply(ActionType.STATUS, {'foo': 'longer'})
+        self.assertEqual(state, ActionState.DIFFERS)
+
+    def test_file_equals(self):
+        path = pathlib.Path(self.tmpdir) / 'file'
+        data = bytes(range(256)) * 100
+        path.write_bytes(data)
+
+        self.assertTrue(file_equals(path, data, chunk_size=1000))
+        self.assertFalse(file_equals(path, data[:-1] + b'x', chunk_size=1000))
+        self.assertFalse(file_equals(path, data + b'x'))
+
+        path.write_bytes(b'')
+        self.assertTrue(file_equals(path, b''))
+
     def test_apply_conflict(self):
         vars = {'foo': 'vara', 'bar': 'varb'}
         src = pathlib.Path(self.tmpdir) / 'src.tpl'
@@ -82,6 +117,44 @@ class TestTemplate(TestCase):
         state, _, _ = action.apply(ActionType.STATUS, vars)
         self.assertEqual(state, ActionState.CONFLICT)
 
+    def test_bytes(self):
+        src = pathlib.Path(self.tmpdir) / 'src.tpl'
+        dst = pathlib.Path(self.tmpdir) / 'dst'
+        src.write_bytes(b'\xff\xfe latin $name $$ ${name}\n')
+
+        vars = Variables([Variable('foo', 'name', 'caf\u00e9')])
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst), 'encoding': 'latin-1'})
+        state, _, _ = action.apply(ActionType.SYNC, vars)
+        self.assertEqual(state, ActionState.RENDERED)
+        self.assertEqual(dst.read_bytes(), b'\xff\xfe latin caf\xe9 $ caf\xe9\n')
+        self.assertEqual(vars.encodings, {'latin-1': {'name': b'caf\xe9'}})
+
+        state, _, _ = action.apply(ActionType.STATUS, vars)
+        self.assertEqual(state, ActionState.OK)
+
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst), 'encoding': 'utf-8'})
+        state, _, _ = action.apply(ActionType.STATUS, vars)
+        self.assertEqual(state, ActionState.DIFFERS)
+
+        src.write_bytes(b'$ invalid')
+        self.assertRaises(ValueError, action.apply, ActionType.SYNC, vars)
+
+    def test_line_endings(self):
+        src = pathlib.Path(self.tmpdir) / 'src.tpl'
+        dst = pathlib.Path(self.tmpdir) / 'dst'
+        src.write_bytes(b'crlf $name\r\nold mac\rlf\n')
+
+        vars = Variables([Variable('foo', 'name', 'value\r\n')])
+        action = TemplateAction('foo', {'src': str(src), 'dst': str(dst)})
+        self.assertEqual(action.apply(ActionType.SYNC, vars)[0], ActionState.RENDERED)
+        # Only the template is normalized, variable values are inserted as they are
+        self.assertEqual(dst.read_bytes(), b'crlf value\r\n\nold mac\nlf\n')
+
+    def test_encoding_validation(self):
+        for encoding in (1, 'no-such-encoding', 'utf-16'):
+            with self.assertRaises(TypeError):
+                TemplateAction('foo', {'src': 'src', 'dst': 'dst', 'encoding': encoding})
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,69 @@
+import os
+import pathlib
+import tempfile
+import shutil
+from unittest import TestCase, main, mock
+from dotref import Variable, Variables, VarCache
+
+
+class TestVariables(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_invalid(self):
+        self.assertRaises(TypeError, Variable, 'foo', 'a', 42)
+        self.assertRaises(TypeError, Variable, 'foo', 'a', {})
+        self.assertRaises(TypeError, Variable, 'foo', 'a', {'env': 'A', 'command': 'b'})
+        self.assertRaises(TypeError, Variable, 'foo', 'a', {'env': 42})
+        self.assertRaises(TypeError, Variable, 'foo', 'a', {'env': 'A', 'ttl': 5})
+        self.assertRaises(TypeError, Variable, 'foo', 'a', {'command': 'true', 'ttl': -1})
+
+    @mock.patch.dict(os.environ, {'DOTREF_TEST_HOME': '/home/test'})
+    def test_derived(self):
+        variables = Variables([
+            Variable('foo', 'home', {'env': 'DOTREF_TEST_HOME'}),
+            Variable('foo', 'config', {'value': '$home/.config'}),
+            Variable('foo', 'missing', {'env': 'DOTREF_TEST_MISSING', 'default': 'none'}),
+            Variable('foo', 'echo', {'command': 'echo hello'}),
+            Variable('foo', 'literal', '$home'),
+            Variable('foo', 'loop', {'value': '$loop'}),
+        ])
+
+        self.assertEqual(variables['config'], '/home/test/.config')
+        self.assertEqual(variables['missing'], 'none')
+        self.assertEqual(variables['echo'], 'hello')
+        self.assertEqual(variables['literal'], '$home')
+        self.assertRaises(ValueError, variables.__getitem__, 'loop')
+        self.assertRaises(KeyError, variables.__getitem__, 'undefined')
+
+    def test_lazy_memoized(self):
+        marker = pathlib.Path(self.tmpdir) / 'marker'
+        variables = Variables([Variable('foo', 'a', {'command': f'echo x >> {marker}; echo a'})])
+        self.assertFalse(marker.exists())
+
+        self.assertEqual(variables['a'], 'a')
+        self.assertEqual(variables['a'], 'a')
+        with open(marker, 'r') as f:
+            self.assertEqual(f.read(), 'x\n')
+
+    def test_ttl_cache(self):
+        marker = pathlib.Path(self.tmpdir) / 'marker'
+        cache_file = pathlib.Path(self.tmpdir) / 'state' / 'vars.json'
+        var = Variable('foo', 'a', {'command': f'echo x >> {marker}; echo a', 'ttl': 3600})
+
+        cache = VarCache(cache_file)
+        self.assertEqual(Variables([var], cache)['a'], 'a')
+        cache.save()
+        self.assertTrue(cache_file.exists())
+
+        self.assertEqual(Variables([var], VarCache(cache_file))['a'], 'a')
+        with open(marker, 'r') as f:
+            self.assertEqual(f.read(), 'x\n')
+
+
+if __name__ == '__main__':
+    main()